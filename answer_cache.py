@@ -0,0 +1,121 @@
+"""
+Cache câu trả lời của LLM cho câu hỏi lặp lại hoặc gần giống nhau.
+
+Một câu trả lời được dùng lại khi:
+- embedding câu hỏi có cosine >= threshold so với câu hỏi đã trả lời, và
+- retrieval trả về đúng các chunk ID như lần trước (cùng ngữ cảnh),
+- entry chưa quá TTL và index chưa được build lại (file VERSION không đổi,
+  kiểm tra tối đa mỗi version_check_interval giây; ReloadableIndex còn xoá cache
+  ngay khi thay index).
+
+Câu trả lời được lưu dưới dạng danh sách token để phát lại đúng như stream
+của ollama. Embedding câu hỏi lấy từ cache của database nên đã có sẵn sau
+bước retrieval, lookup chỉ tốn 1 phép nhân ma trận-vector.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+import metrics
+from database import VECTOR_DB_PATH, normalize_query, read_index_version
+
+class AnswerCache:
+    def __init__(self, embeddings, threshold: float = 0.95, max_entries: int = 512,
+                 ttl: float = 3600.0, index_path: str = VECTOR_DB_PATH, version_check_interval: float = 5.0):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.index_path = index_path
+        # key (câu hỏi đã chuẩn hoá) -> (vector, chunk_ids, tokens, thời điểm lưu), thứ tự LRU
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = read_index_version(index_path)
+        self.version_check_interval = version_check_interval
+        self._next_version_check = time.monotonic() + version_check_interval
+        self.hits = 0
+        self.misses = 0
+
+    def _embed(self, query: str) -> np.ndarray:
+        vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def _check_version(self):
+        # Đọc file VERSION tối đa mỗi version_check_interval giây, không phải mỗi lookup
+        now = time.monotonic()
+        if now < self._next_version_check:
+            return
+        self._next_version_check = now + self.version_check_interval
+        version = read_index_version(self.index_path)
+        if version != self._version:
+            self.clear()
+            self._version = version
+
+    def lookup(self, query: str, chunk_ids: Optional[Sequence[str]]) -> Optional[List[str]]:
+        """Trả về token của câu trả lời đã lưu, hoặc None nếu miss"""
+        if not chunk_ids:
+            return None
+        chunk_ids = tuple(chunk_ids)
+        self._check_version()
+        key = normalize_query(query)
+        now = time.monotonic()
+
+        candidates = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] != chunk_ids or now - entry[3] > self.ttl:
+                entry = None
+                candidates = [
+                    (k, e) for k, e in self._entries.items()
+                    if e[1] == chunk_ids and now - e[3] <= self.ttl
+                ]
+
+        # Embed ngoài lock: cache miss của model không chặn lookup/put của phiên khác
+        if candidates:
+            vector = self._embed(query)
+            similarities = np.stack([e[0] for _, e in candidates]) @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                key, entry = candidates[best]
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                metrics.ANSWER_CACHE.inc(result="miss")
+                return None
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self.hits += 1
+        metrics.ANSWER_CACHE.inc(result="hit")
+        return list(entry[2])
+
+    def put(self, query: str, chunk_ids: Optional[Sequence[str]], tokens: List[str]):
+        if not chunk_ids or not tokens:
+            return
+        vector = self._embed(query)
+        now = time.monotonic()
+        with self._lock:
+            key = normalize_query(query)
+            self._entries[key] = (vector, tuple(chunk_ids), list(tokens), now)
+            self._entries.move_to_end(key)
+            # Bỏ entry hết hạn trước, sau đó bỏ entry ít dùng nhất
+            for old_key in [k for k, e in self._entries.items() if now - e[3] > self.ttl]:
+                del self._entries[old_key]
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+def replay(tokens: List[str]):
+    """Phát lại câu trả lời đã cache theo đúng định dạng chunk của ollama.chat(stream=True)"""
+    for token in tokens:
+        yield {"message": {"content": token}}
@@ -0,0 +1,533 @@
+"""
+Benchmark hiệu năng RAG-MCP, chạy hoàn toàn offline.
+
+    python bench.py retrieval --queries bench_queries.txt --repeat 5
+    python bench.py e2e --queries bench_queries.txt --concurrency 4 --token-delay 0.02
+    python bench.py ingest --pages 20 --workers 4
+    python bench.py index --synthetic 100000
+    python bench.py batch --repeat 5
+    python bench.py devices --clients 200 --commands 20 --tick 0.01
+
+- retrieval: replay câu hỏi qua MCPDispatcher (routing, handler/retrieval, prepare)
+- e2e: như trên + LLM giả lập (FakeOllamaServer stream token với độ trễ cấu hình được),
+  đo time-to-first-token, tổng thời gian và throughput
+- ingest: tạo corpus PDF tổng hợp (trang có text + logo nhỏ, và trang scan) rồi đo
+  pages/s của đường text thuần và đường OCR trong ingest.py, kèm số trang theo từng
+  cách trích xuất (--extraction auto/ocr/native) và số ảnh đã OCR / bỏ qua
+- batch: hybrid search từng câu một so với hybrid_search_batch (cache embedding bị xoá
+  trước mỗi lần chạy để đo cả transformer)
+- devices: nhiều client gửi lệnh bật/tắt/toggle đồng thời tới DeviceMCPServer
+  (SimulatedGPIO), đo latency và số lần ghi GPIO so với số lệnh
+- index: recall@k và latency của các loại index (IVF, PQ, HNSW, SQ8) so với flat,
+  trên vector của index hiện có hoặc vector tổng hợp (--synthetic N)
+
+Kết quả in ra p50/p95/p99 từng stage; thêm --json FILE để lưu lại so sánh regression.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+DEFAULT_QUERIES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_queries.txt")
+CANNED_ANSWER = (
+    "Theo tài liệu, Trường Đại học Cần Thơ là cơ sở đào tạo và nghiên cứu khoa học "
+    "trọng điểm của vùng Đồng bằng sông Cửu Long, có bộ nhận diện thương hiệu riêng. "
+)
+
+def load_queries(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+def summarize(samples):
+    """samples: list giây -> dict thống kê (ms)"""
+    if not samples:
+        return {"n": 0}
+    values = np.asarray(samples) * 1000
+    return {
+        "n": len(values),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+    }
+
+def print_report(title, stages, extra=None):
+    print(f"\n=== {title} ===")
+    print(f"{'stage':<22}{'n':>6}{'mean':>11}{'p50':>11}{'p95':>11}{'p99':>11}  (ms)")
+    for stage, stats in stages.items():
+        if not stats.get("n"):
+            continue
+        print(f"{stage:<22}{stats['n']:>6}{stats['mean_ms']:>11.2f}{stats['p50_ms']:>11.2f}"
+              f"{stats['p95_ms']:>11.2f}{stats['p99_ms']:>11.2f}")
+    for key, value in (extra or {}).items():
+        print(f"{key}: {value}")
+
+# --- LLM GIẢ LẬP ---
+
+class _FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _write_chunk(self, payload):
+        data = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        fake = self.server.fake
+        fake.requests += 1
+        model = body.get("model", "fake")
+        is_chat = self.path == "/api/chat"
+
+        def message(content, done):
+            payload = {"model": model, "created_at": "1970-01-01T00:00:00Z", "done": done}
+            if is_chat:
+                payload["message"] = {"role": "assistant", "content": content}
+            else:
+                payload["response"] = content
+            if done:
+                payload["done_reason"] = "stop"
+            return payload
+
+        # Request không có prompt (warm-up/keep_alive) hoặc không stream -> trả 1 JSON
+        if not body.get("stream", True) or (not is_chat and not body.get("prompt")):
+            data = json.dumps(message("", True)).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        time.sleep(fake.ttft_delay)
+        for token in fake.tokens():
+            self._write_chunk(message(token, False))
+            time.sleep(fake.token_delay)
+        self._write_chunk(message("", True))
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+class FakeOllamaServer:
+    """Server HTTP giả lập /api/chat và /api/generate của Ollama, stream token soạn sẵn"""
+
+    def __init__(self, n_tokens=50, token_delay=0.02, ttft_delay=0.1, host="127.0.0.1", port=0):
+        self.n_tokens = n_tokens
+        self.token_delay = token_delay
+        self.ttft_delay = ttft_delay
+        self.requests = 0
+        self._httpd = ThreadingHTTPServer((host, port), _FakeOllamaHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def tokens(self):
+        words = CANNED_ANSWER.split()
+        for i in range(self.n_tokens):
+            yield words[i % len(words)] + " "
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+# --- BENCHMARKS ---
+
+def bench_retrieval(queries, repeat=3):
+    import main
+
+    dispatcher, retriever = main.dispatcher, main.index.current
+    # Warm-up: load model embedding, docstore, BM25 trước khi đo
+    dispatcher.prepare(queries[0], retriever)
+
+    samples = {"route": [], "handler": [], "prepare": []}
+    t_total = time.perf_counter()
+    for _ in range(repeat):
+        for query in queries:
+            t0 = time.perf_counter()
+            selected_tool, _ = dispatcher.smart_route(query)
+            samples["route"].append(time.perf_counter() - t0)
+
+            handler = dispatcher.tools[selected_tool]["handler"]
+            t0 = time.perf_counter()
+            if selected_tool == "rag_search":
+                handler(query, retriever)
+            else:
+                handler(query)
+            t_handler = time.perf_counter() - t0
+            samples["handler"].append(t_handler)
+            samples.setdefault(f"handler:{selected_tool}", []).append(t_handler)
+
+            t0 = time.perf_counter()
+            dispatcher.prepare(query, retriever)
+            samples["prepare"].append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - t_total
+
+    n_queries = len(queries) * repeat
+    result = {
+        "stages": {stage: summarize(values) for stage, values in samples.items()},
+        "queries": n_queries,
+        "throughput_qps": round(n_queries / elapsed, 2),
+    }
+    print_report("Retrieval", result["stages"], {"throughput (queries/s, route+handler+prepare)": result["throughput_qps"]})
+    return result
+
+def bench_batch(queries, repeat=3):
+    import main
+
+    dispatcher, retriever = main.dispatcher, main.index.current
+    embeddings = retriever.vectorstore.embedding_function
+    queries = queries * repeat
+    # Warm-up: load model embedding, docstore, BM25 trước khi đo
+    dispatcher.hybrid_search(queries[0], retriever)
+
+    embeddings.clear()
+    t0 = time.perf_counter()
+    for query in queries:
+        dispatcher.hybrid_search(query, retriever)
+    sequential = time.perf_counter() - t0
+
+    embeddings.clear()
+    t0 = time.perf_counter()
+    dispatcher.hybrid_search_batch(queries, retriever)
+    batched = time.perf_counter() - t0
+
+    result = {
+        "queries": len(queries),
+        "sequential_s": round(sequential, 4),
+        "batch_s": round(batched, 4),
+        "sequential_qps": round(len(queries) / sequential, 2),
+        "batch_qps": round(len(queries) / batched, 2),
+    }
+    print(f"\n=== Batch retrieval ({len(queries)} câu hỏi) ===")
+    print(f"từng câu : {sequential:.3f}s ({result['sequential_qps']} câu/s)")
+    print(f"batch    : {batched:.3f}s ({result['batch_qps']} câu/s, x{sequential / batched:.1f})")
+    return result
+
+def bench_e2e(queries, repeat=1, concurrency=4, n_tokens=50, token_delay=0.02, ttft_delay=0.1, answer_cache=False):
+    import main
+    from engine import AsyncRAGEngine
+
+    async def run(server):
+        engine = AsyncRAGEngine(main.dispatcher, main.index, main.OLLAMA_MODEL, main.OLLAMA_OPTIONS,
+                                max_concurrency=concurrency, ollama_host=server.url,
+                                answer_cache=main.answer_cache if answer_cache else None)
+        samples = {"prepare": [], "ttft": [], "total": []}
+        n_tokens_total = 0
+
+        async def one(query):
+            nonlocal n_tokens_total
+            t0 = time.perf_counter()
+            first = None
+            async for event in engine.answer(query):
+                if "token" in event:
+                    n_tokens_total += 1
+                    if first is None:
+                        first = time.perf_counter() - t0
+                elif event.get("done"):
+                    samples["prepare"].append(event["prep_s"])
+            samples["ttft"].append(first if first is not None else time.perf_counter() - t0)
+            samples["total"].append(time.perf_counter() - t0)
+
+        # Warm-up
+        await one(queries[0])
+        for values in samples.values():
+            values.clear()
+        n_tokens_total = 0
+        if engine.answer_cache is not None:
+            engine.answer_cache.clear()
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(q) for _ in range(repeat) for q in queries))
+        elapsed = time.perf_counter() - t0
+        engine.close()
+        return samples, n_tokens_total, elapsed
+
+    with FakeOllamaServer(n_tokens, token_delay, ttft_delay) as server:
+        samples, n_tokens_total, elapsed = asyncio.run(run(server))
+
+    n_requests = len(queries) * repeat
+    result = {
+        "stages": {stage: summarize(values) for stage, values in samples.items()},
+        "requests": n_requests,
+        "concurrency": concurrency,
+        "throughput_rps": round(n_requests / elapsed, 2),
+        "tokens_per_s": round(n_tokens_total / elapsed, 1),
+    }
+    extra = {
+        "throughput (requests/s)": result["throughput_rps"],
+        "tokens/s": result["tokens_per_s"],
+        "concurrency": concurrency,
+    }
+    if answer_cache:
+        result["answer_cache"] = main.answer_cache.stats()
+        extra["answer cache (hit/miss)"] = f"{result['answer_cache']['hits']}/{result['answer_cache']['misses']}"
+    print_report("End-to-end (LLM giả lập)", result["stages"], extra)
+    return result
+
+def make_synthetic_corpus(out_dir, n_pages=10):
+    """Tạo 2 PDF: text.pdf (có text layer) và scanned.pdf (mỗi trang là 1 ảnh chụp)"""
+    import fitz
+
+    lines = [
+        "Trường Đại học Cần Thơ - Bản tin nội bộ",
+        "Quy định sử dụng logo và bộ nhận diện thương hiệu.",
+        "Hướng dẫn vận hành máy móc trong phòng thí nghiệm.",
+    ]
+    # Logo nhỏ ở đầu mỗi trang như PDF thật (ảnh trang trí, không cần OCR)
+    logo = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 48, 48), False)
+    logo.clear_with(180)
+    text_doc = fitz.open()
+    for page_num in range(n_pages):
+        page = text_doc.new_page()
+        body = "\n".join(f"{line} (trang {page_num + 1}, mục {i + 1})" for i in range(8) for line in lines)
+        page.insert_textbox(fitz.Rect(50, 50, 550, 800), body, fontsize=11)
+        page.insert_image(fitz.Rect(520, 10, 545, 35), pixmap=logo)
+    text_path = os.path.join(out_dir, "text.pdf")
+    text_doc.save(text_path)
+
+    scanned_doc = fitz.open()
+    for page in text_doc:
+        pix = page.get_pixmap(matrix=fitz.Matrix(150 / 72, 150 / 72))  # gồm cả logo
+        scanned_page = scanned_doc.new_page(width=page.rect.width, height=page.rect.height)
+        scanned_page.insert_image(scanned_page.rect, pixmap=pix)
+    scanned_path = os.path.join(out_dir, "scanned.pdf")
+    scanned_doc.save(scanned_path)
+
+    text_doc.close()
+    scanned_doc.close()
+    return text_path, scanned_path
+
+def bench_ingest(n_pages=10, workers=1, extraction="auto"):
+    import ingest
+
+    # Đo OCR thật, không để cache làm sai kết quả
+    ingest.configure_ocr_cache(None)
+    result = {"pages": n_pages, "workers": workers, "extraction": extraction}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        text_path, scanned_path = make_synthetic_corpus(tmp_dir, n_pages)
+        for name, path in [("text", text_path), ("ocr", scanned_path)]:
+            t0 = time.perf_counter()
+            stats = {}
+            try:
+                n_docs = sum(1 for _ in ingest.iter_page_documents([path], workers=workers,
+                                                                   mode=extraction, stats=stats))
+            except Exception as e:
+                print(f"⚠️ Bỏ qua đường {name}: {e}")
+                continue
+            elapsed = time.perf_counter() - t0
+            result[name] = {
+                "seconds": round(elapsed, 3),
+                "pages_per_s": round(n_pages / elapsed, 2),
+                "documents": n_docs,
+                "paths": dict(stats.get(os.path.basename(path), {})),
+            }
+
+    print(f"\n=== Ingest ({n_pages} trang/đường, {workers} workers, {extraction}) ===")
+    for name in ("text", "ocr"):
+        if name in result:
+            stats = result[name]
+            print(f"{name:<6} {stats['pages_per_s']:>8.2f} pages/s  ({stats['seconds']:.2f}s, {stats['documents']} documents)")
+            print(f"       {ingest.format_extraction_stats(stats['paths'])}")
+    return result
+
+def bench_devices(clients=100, commands=20, tick=0.01, write_delay=0.002, seed=0):
+    import random
+    from mcp_server_example import DeviceMCPServer, SimulatedGPIO
+
+    rng = random.Random(seed)
+
+    async def run():
+        gpio = SimulatedGPIO(write_delay)
+        server = DeviceMCPServer(gpio, tick=tick)
+        devices = list(server.devices)
+        latencies = []
+
+        async def client():
+            for _ in range(commands):
+                tool = rng.choice(["turn_on", "turn_off", "toggle"])
+                t0 = time.perf_counter()
+                response = await server.handle_request(tool, {"device": rng.choice(devices)})
+                latencies.append(time.perf_counter() - t0)
+                assert response.get("success"), response
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(clients)))
+        return server, gpio, latencies, time.perf_counter() - t0
+
+    server, gpio, latencies, elapsed = asyncio.run(run())
+    result = {
+        "clients": clients,
+        "commands": server.commands,
+        "gpio_writes": gpio.writes,
+        "pin_changes": gpio.pin_changes,
+        "commands_per_s": round(server.commands / elapsed, 1),
+        "latency": summarize(latencies),
+    }
+    print_report(f"Devices ({clients} clients, tick {tick * 1000:g} ms, GPIO {write_delay * 1000:g} ms/lần ghi)",
+                 {"command": result["latency"]}, {
+                     "commands/s": result["commands_per_s"],
+                     "lệnh / lần ghi GPIO": f"{server.commands} / {gpio.writes} (x{server.commands / max(gpio.writes, 1):.1f})",
+                 })
+    return result
+
+# Cấu hình so sánh mặc định: (tham số build, danh sách tham số search)
+INDEX_SWEEP = [
+    ({"index_type": "flat"}, [{}]),
+    ({"index_type": "sq8"}, [{}]),
+    ({"index_type": "ivf-flat"}, [{"nprobe": n} for n in (1, 4, 16, 64)]),
+    ({"index_type": "ivf-pq"}, [{"nprobe": n} for n in (4, 16, 64)]),
+    ({"index_type": "hnsw"}, [{"ef_search": n} for n in (16, 32, 64, 128)]),
+]
+
+def load_index_vectors(index_path):
+    """Lấy lại vector đã lưu trong index.faiss (flat, sq8, hnsw; IVF cần direct map)"""
+    import faiss
+
+    index = faiss.read_index(os.path.join(index_path, "index.faiss"))
+    try:
+        faiss.extract_index_ivf(index).make_direct_map()
+    except RuntimeError:
+        pass
+    return index.reconstruct_n(0, index.ntotal)
+
+def make_synthetic_vectors(n, dim=384, n_clusters=256, seed=0):
+    """Vector chuẩn hoá L2 có cấu trúc cụm, gần với phân bố embedding câu"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, n_clusters, n)] + 0.6 * rng.normal(size=(n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def bench_index(index_path="faiss_index", synthetic=0, n_queries=200, k=10, seed=0):
+    import faiss
+    from index_config import apply_search_params, build_index, describe, make_params, training_size
+
+    vectors = make_synthetic_vectors(synthetic, seed=seed) if synthetic else load_index_vectors(index_path)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    rng = np.random.default_rng(seed + 1)
+    queries = vectors[rng.integers(0, len(vectors), n_queries)]
+    queries = queries + 0.05 * rng.normal(size=queries.shape).astype(np.float32)
+    k = min(k, len(vectors))
+
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+
+    rows = []
+    for build_overrides, search_sweep in INDEX_SWEEP:
+        params = make_params(**build_overrides)
+        t0 = time.perf_counter()
+        index, params = build_index(vectors[:training_size(params) or 1], params)
+        index.add(vectors)
+        build_s = time.perf_counter() - t0
+        size_mb = faiss.serialize_index(index).nbytes / 2**20
+
+        for search_overrides in search_sweep:
+            search_params = make_params(params, **search_overrides)
+            apply_search_params(index, search_params)
+            latencies, hits = [], 0
+            # Từng query một như khi phục vụ thật
+            for i in range(len(queries)):
+                t0 = time.perf_counter()
+                _, found = index.search(queries[i:i + 1], k)
+                latencies.append(time.perf_counter() - t0)
+                hits += len(set(found[0]) & set(truth[i]))
+            rows.append({
+                "index": describe(search_params),
+                "params": search_params,
+                f"recall@{k}": round(hits / (len(queries) * k), 4),
+                "latency": summarize(latencies),
+                "build_s": round(build_s, 3),
+                "size_mb": round(size_mb, 2),
+            })
+
+    print(f"\n=== Index ({len(vectors)} vectors, {vectors.shape[1]} chiều, {len(queries)} queries) ===")
+    print(f"{'index':<44}{f'recall@{k}':>10}{'p50':>9}{'p95':>9}  (ms){'build':>9}{'MB':>9}")
+    for row in rows:
+        print(f"{row['index']:<44}{row[f'recall@{k}']:>10.3f}{row['latency']['p50_ms']:>9.3f}"
+              f"{row['latency']['p95_ms']:>9.3f}      {row['build_s']:>8.2f}s{row['size_mb']:>9.2f}")
+    return {"vectors": len(vectors), "queries": len(queries), "k": k, "results": rows}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark RAG-MCP (offline)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("retrieval", help="Routing + retrieval + dựng prompt")
+    p.add_argument("--queries", default=DEFAULT_QUERIES)
+    p.add_argument("--repeat", type=int, default=3)
+
+    p = sub.add_parser("batch", help="Hybrid search từng câu so với theo batch")
+    p.add_argument("--queries", default=DEFAULT_QUERIES)
+    p.add_argument("--repeat", type=int, default=3)
+
+    p = sub.add_parser("e2e", help="Toàn bộ pipeline với LLM giả lập")
+    p.add_argument("--queries", default=DEFAULT_QUERIES)
+    p.add_argument("--repeat", type=int, default=1)
+    p.add_argument("--concurrency", type=int, default=4)
+    p.add_argument("--tokens", type=int, default=50, help="Số token LLM giả lập trả về")
+    p.add_argument("--token-delay", type=float, default=0.02, help="Giây giữa 2 token")
+    p.add_argument("--ttft-delay", type=float, default=0.1, help="Giây trước token đầu tiên (prefill)")
+    p.add_argument("--answer-cache", action="store_true", help="Bật cache câu trả lời (nên dùng với --repeat > 1)")
+
+    p = sub.add_parser("ingest", help="pages/s của đường text và OCR trên corpus tổng hợp")
+    p.add_argument("--pages", type=int, default=10)
+    p.add_argument("--workers", type=int, default=1)
+    p.add_argument("--extraction", choices=("auto", "ocr", "native"), default="auto")
+
+    p = sub.add_parser("devices", help="Lệnh điều khiển thiết bị đồng thời trên GPIO giả lập")
+    p.add_argument("--clients", type=int, default=100)
+    p.add_argument("--commands", type=int, default=20, help="Số lệnh mỗi client gửi lần lượt")
+    p.add_argument("--tick", type=float, default=0.01, help="Cửa sổ gom lệnh (giây)")
+    p.add_argument("--write-delay", type=float, default=0.002, help="Độ trễ mỗi lần ghi GPIO (giây)")
+
+    p = sub.add_parser("index", help="Recall@k vs latency của các loại index so với flat")
+    p.add_argument("--index", default="faiss_index", help="Lấy vector từ index này")
+    p.add_argument("--synthetic", type=int, default=0, help="Dùng N vector tổng hợp thay vì index hiện có")
+    p.add_argument("--queries", type=int, default=200)
+    p.add_argument("-k", type=int, default=10)
+
+    for p in sub.choices.values():
+        p.add_argument("--json", default=None, help="Ghi kết quả ra file JSON")
+
+    args = parser.parse_args()
+    if args.command == "retrieval":
+        result = bench_retrieval(load_queries(args.queries), args.repeat)
+    elif args.command == "batch":
+        result = bench_batch(load_queries(args.queries), args.repeat)
+    elif args.command == "e2e":
+        result = bench_e2e(load_queries(args.queries), args.repeat, args.concurrency,
+                           args.tokens, args.token_delay, args.ttft_delay, args.answer_cache)
+    elif args.command == "devices":
+        result = bench_devices(args.clients, args.commands, args.tick, args.write_delay)
+    elif args.command == "ingest":
+        result = bench_ingest(args.pages, args.workers, args.extraction)
+    else:
+        result = bench_index(args.index, args.synthetic, args.queries, args.k)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,130 @@
+"""
+Chỉ mục từ khoá BM25 cho hybrid search (BM25 + FAISS, gộp bằng reciprocal-rank fusion).
+
+Build lúc ingest, lưu cạnh faiss_index dưới dạng JSON (không dùng pickle).
+Khi phục vụ, file JSON chỉ được đọc ở lần search từ khoá đầu tiên (LazyBM25Index).
+"""
+
+import json
+import math
+import os
+import re
+import threading
+import unicodedata
+
+import numpy as np
+
+BM25_FILE = "bm25.json"
+_WORD_RE = re.compile(r"\w+")
+
+def tokenize(text):
+    """Tách token cho tiếng Việt: từng âm tiết + cặp âm tiết liền nhau.
+
+    Từ tiếng Việt thường gồm 2 âm tiết ("đại học", "thương hiệu"), nên thêm
+    bigram giúp khớp đúng từ ghép mà không cần bộ tách từ riêng.
+    """
+    syllables = _WORD_RE.findall(unicodedata.normalize("NFC", text).casefold())
+    bigrams = [f"{a}_{b}" for a, b in zip(syllables, syllables[1:])]
+    return syllables + bigrams
+
+class BM25Index:
+    def __init__(self, ids, doc_lens, postings, k1=1.5, b=0.75):
+        self.ids = ids
+        self.doc_lens = np.asarray(doc_lens, dtype=np.float32)
+        self.k1 = k1
+        self.b = b
+        self.avg_len = float(self.doc_lens.mean()) if len(ids) else 0.0
+        # Mẫu số chuẩn hoá độ dài của từng doc chỉ phụ thuộc corpus -> tính 1 lần
+        self._norm = self.k1 * (1 - self.b + self.b * self.doc_lens / self.avg_len) if len(ids) else self.doc_lens.copy()
+        # term -> (mảng vị trí doc, mảng tần suất)
+        self.postings = {
+            term: (np.asarray(docs, dtype=np.int32), np.asarray(tfs, dtype=np.float32))
+            for term, (docs, tfs) in postings.items()
+        }
+
+    @classmethod
+    def build(cls, items, k1=1.5, b=0.75):
+        """items: iterable (chunk_id, text)"""
+        ids, doc_lens, postings = [], [], {}
+        for doc_idx, (chunk_id, text) in enumerate(items):
+            tokens = tokenize(text)
+            ids.append(chunk_id)
+            doc_lens.append(len(tokens))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, tf in counts.items():
+                docs, tfs = postings.setdefault(token, ([], []))
+                docs.append(doc_idx)
+                tfs.append(tf)
+        return cls(ids, doc_lens, postings, k1=k1, b=b)
+
+    def search(self, query, k=20):
+        """Trả về [(chunk_id, score)] theo score giảm dần"""
+        n_docs = len(self.ids)
+        if not n_docs:
+            return []
+
+        scores = np.zeros(n_docs, dtype=np.float32)
+        norm = self._norm
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            docs, tfs = posting
+            idf = math.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + norm[docs])
+
+        hits = np.flatnonzero(scores)
+        if not len(hits):
+            return []
+        top = hits[np.argsort(-scores[hits], kind="stable")[:k]]
+        return [(self.ids[i], float(scores[i])) for i in top]
+
+    def save(self, path):
+        data = {
+            "k1": self.k1,
+            "b": self.b,
+            "ids": self.ids,
+            "doc_lens": self.doc_lens.astype(int).tolist(),
+            "postings": {
+                term: [docs.tolist(), tfs.astype(int).tolist()]
+                for term, (docs, tfs) in self.postings.items()
+            },
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["ids"], data["doc_lens"], data["postings"], k1=data["k1"], b=data["b"])
+
+class LazyBM25Index:
+    """BM25Index đọc từ file ở lần search đầu tiên (parse JSON không làm chậm lúc khởi động/reload)"""
+
+    def __init__(self, path):
+        self.path = path
+        self._index = None
+        self._lock = threading.Lock()
+
+    def get(self) -> BM25Index:
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    self._index = BM25Index.load(self.path)
+        return self._index
+
+    def search(self, query, k=20):
+        return self.get().search(query, k)
+
+def reciprocal_rank_fusion(*rankings, k=60):
+    """Gộp nhiều danh sách ID đã xếp hạng: score = Σ 1 / (k + rank)"""
+    fused = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking):
+            fused[chunk_id] = fused.get(chunk_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,226 @@
+"""
+Chia chunk theo cấu trúc tài liệu cho ingest.
+
+- extract_page_text: dựng text trang từ block của PyMuPDF (get_text("dict")), mỗi
+  block là 1 đoạn (cách nhau bằng dòng trống), dòng tiêu đề (cỡ chữ lớn hơn hẳn
+  thân bài, hoặc ngắn và in đậm) được đánh dấu "# "
+- strip_furniture: bỏ đoạn ngắn ở đầu/cuối trang lặp lại trên phần lớn các trang
+  của 1 file (header, footer, số trang, logo đã OCR)
+- StructuredSplitter: gom đoạn thành chunk <= chunk_size, cắt tại tiêu đề; chunk
+  tiếp nối 1 mục được gắn lại tiêu đề của mục đó; đoạn quá dài mới cắt theo ký tự
+- ChunkDeduplicator: bỏ chunk giống hệt (hash) hoặc gần giống (MinHash + LSH) trong
+  cùng 1 file trước khi embed
+"""
+
+import hashlib
+import re
+import unicodedata
+import zlib
+from collections import Counter
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+HEADING_PREFIX = "# "
+HEADING_SIZE_RATIO = 1.2      # cỡ chữ tiêu đề >= 1.2 x cỡ chữ thân bài của trang
+MAX_HEADING_CHARS = 120
+FURNITURE_MAX_CHARS = 200
+FURNITURE_MIN_PAGES = 3
+FURNITURE_PAGE_RATIO = 0.5    # đoạn xuất hiện trên >= 50% số trang của file
+FURNITURE_EDGE_BLOCKS = 2     # chỉ xét 2 đoạn đầu + 2 đoạn cuối mỗi trang
+FURNITURE_MASK_MAX_CHARS = 40 # chỉ đoạn ngắn dạng số trang/ngày tháng mới bỏ qua chữ số khi so
+SHINGLE_WORDS = 5
+NUM_PERM = 64
+LSH_BANDS = 16                # 16 band x 4 hàng: cặp có Jaccard ~0.5 trở lên mới thành ứng viên
+NEAR_DUPLICATE_THRESHOLD = 0.85
+
+_BOLD_FLAG = 16
+_DIGITS = re.compile(r"\d+")
+# "3", "- 3 -", "Trang 3/10", "Page 3 of 10"
+_PAGE_NUMBER = re.compile(r"[\W_]*(?:(?:trang|page|tr\.?)\s*)?\d+(?:\s*(?:/|of|trên)\s*\d+)?[\W_]*")
+# "12/03/2024", "ngày 5 tháng 3 năm 2024"
+_DATE = re.compile(r"\d{1,2}\s*[/.-]\s*\d{1,2}\s*[/.-]\s*\d{2,4}|ngày\s*\d{1,2}\s*tháng\s*\d{1,2}\s*năm\s*\d{4}")
+_WORDS = re.compile(r"\w+")
+
+# --- TEXT THEO BLOCK ---
+
+def _block_lines(block):
+    """[(text dòng, cỡ chữ lớn nhất, có phải toàn bộ in đậm)] của 1 block text"""
+    lines = []
+    for line in block.get("lines", []):
+        spans = [span for span in line["spans"] if span["text"].strip()]
+        if not spans:
+            continue
+        text = " ".join("".join(span["text"] for span in spans).split())
+        lines.append((text, max(span["size"] for span in spans),
+                      all(span["flags"] & _BOLD_FLAG for span in spans)))
+    return lines
+
+def extract_page_text(page) -> str:
+    """Text của trang theo đoạn (block), dòng tiêu đề có tiền tố "# " """
+    blocks = [_block_lines(block) for block in page.get_text("dict")["blocks"] if block.get("type") == 0]
+    blocks = [lines for lines in blocks if lines]
+    if not blocks:
+        return ""
+
+    # Cỡ chữ thân bài = cỡ chữ phổ biến nhất tính theo số ký tự
+    sizes = Counter()
+    for lines in blocks:
+        for text, size, _ in lines:
+            sizes[round(size, 1)] += len(text)
+    body_size = sizes.most_common(1)[0][0]
+
+    paragraphs = []
+    for lines in blocks:
+        text = " ".join(line[0] for line in lines)
+        is_heading = len(lines) <= 2 and len(text) <= MAX_HEADING_CHARS and not text.endswith((".", ",", ";")) and (
+            max(line[1] for line in lines) >= body_size * HEADING_SIZE_RATIO or all(line[2] for line in lines)
+        )
+        paragraphs.append(HEADING_PREFIX + text if is_heading else text)
+    return "\n\n".join(paragraphs)
+
+def split_paragraphs(text: str) -> List[str]:
+    return [paragraph.strip() for paragraph in re.split(r"\n\s*\n", text) if paragraph.strip()]
+
+# --- HEADER / FOOTER LẶP LẠI ---
+
+def _furniture_key(paragraph: str) -> str:
+    key = " ".join(unicodedata.normalize("NFC", paragraph).casefold().split())
+    # Số trang, ngày tháng thay đổi theo trang -> thay chữ số bằng "#", nhưng chỉ với
+    # đoạn ngắn có dạng số trang/ngày tháng; đoạn khác (điều khoản đánh số, dòng bảng
+    # phí, tiêu đề "Chương 1", "Chương 2") phải giống hệt mới coi là lặp lại
+    if (paragraph.startswith(HEADING_PREFIX) or len(key) > FURNITURE_MASK_MAX_CHARS
+            or not (_PAGE_NUMBER.fullmatch(key) or _DATE.search(key))):
+        return key
+    return _DIGITS.sub("#", key)
+
+def _edge_positions(n: int) -> set:
+    """Vị trí các đoạn ở đầu/cuối trang - nơi có thể là header/footer"""
+    return set(range(min(n, FURNITURE_EDGE_BLOCKS))) | set(range(max(0, n - FURNITURE_EDGE_BLOCKS), n))
+
+def _is_furniture_candidate(paragraphs: List[str], i: int, edges: set) -> bool:
+    return i in edges and len(paragraphs[i]) <= FURNITURE_MAX_CHARS
+
+def strip_furniture(pages: List[Document], stats: Optional[Counter] = None) -> List[Document]:
+    """Bỏ đoạn ngắn ở đầu/cuối trang lặp lại trên phần lớn các trang (các trang cùng 1 file)"""
+    if len(pages) < FURNITURE_MIN_PAGES:
+        return pages
+    page_paragraphs = [split_paragraphs(page.page_content) for page in pages]
+    page_edges = [_edge_positions(len(paragraphs)) for paragraphs in page_paragraphs]
+    counts = Counter(
+        key
+        for paragraphs, edges in zip(page_paragraphs, page_edges)
+        for key in {_furniture_key(paragraphs[i]) for i in range(len(paragraphs))
+                    if _is_furniture_candidate(paragraphs, i, edges)}
+    )
+    min_pages = max(FURNITURE_MIN_PAGES, int(len(pages) * FURNITURE_PAGE_RATIO + 0.5))
+    furniture = {key for key, n in counts.items() if n >= min_pages}
+    if not furniture:
+        return pages
+
+    cleaned = []
+    for page, paragraphs, edges in zip(pages, page_paragraphs, page_edges):
+        kept = [
+            p for i, p in enumerate(paragraphs)
+            if not _is_furniture_candidate(paragraphs, i, edges) or _furniture_key(p) not in furniture
+        ]
+        if stats is not None:
+            stats["furniture_removed"] += len(paragraphs) - len(kept)
+        if kept:
+            cleaned.append(Document(page_content="\n\n".join(kept), metadata=page.metadata))
+    return cleaned
+
+# --- CHIA CHUNK ---
+
+class StructuredSplitter:
+    def __init__(self, chunk_size: int = 1500, chunk_overlap: int = 150):
+        self.chunk_size = chunk_size
+        # Chỉ dùng cho đoạn dài hơn chunk_size; chunk gom theo đoạn thì không cần overlap
+        self._fallback = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+    def split_document(self, page: Document, heading: Optional[str] = None) -> tuple[List[Document], Optional[str]]:
+        """Chia 1 trang -> (chunks, tiêu đề đang mở ở cuối trang, để trang sau dùng tiếp)"""
+        chunks = []
+        parts = []
+        size = 0
+
+        def flush():
+            nonlocal parts, size
+            body = [p for p in parts if not p.startswith(HEADING_PREFIX)]
+            if body:
+                # Chunk không bắt đầu bằng tiêu đề -> gắn lại tiêu đề của mục cho ngữ cảnh
+                if heading and not parts[0].startswith(HEADING_PREFIX):
+                    parts.insert(0, HEADING_PREFIX + heading)
+                metadata = dict(page.metadata)
+                if heading:
+                    metadata["heading"] = heading
+                chunks.append(Document(page_content="\n\n".join(parts), metadata=metadata))
+            # Tiêu đề chưa có nội dung (cuối trang) bị bỏ ở đây, trang sau gắn lại qua `heading`
+            parts, size = [], 0
+
+        for paragraph in split_paragraphs(page.page_content):
+            if paragraph.startswith(HEADING_PREFIX):
+                flush()
+                heading = paragraph[len(HEADING_PREFIX):]
+                parts, size = [paragraph], len(paragraph)
+                continue
+            pieces = [paragraph] if len(paragraph) <= self.chunk_size else self._fallback.split_text(paragraph)
+            for piece in pieces:
+                if parts and size + len(piece) + 2 > self.chunk_size:
+                    flush()
+                parts.append(piece)
+                size += len(piece) + 2
+        flush()
+        return chunks, heading
+
+# --- LỌC CHUNK TRÙNG ---
+
+def _text_key(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", text).casefold().split())
+
+class ChunkDeduplicator:
+    """Nhận diện chunk trùng (ingest dùng 1 instance cho mỗi file): giống hệt (sau chuẩn hoá) hoặc
+    Jaccard ước lượng bằng MinHash trên shingle 5 từ >= threshold"""
+
+    def __init__(self, threshold: float = NEAR_DUPLICATE_THRESHOLD, num_perm: int = NUM_PERM,
+                 bands: int = LSH_BANDS, seed: int = 0):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = np.random.default_rng(seed)
+        # Multiply-shift hashing trên uint64 (tràn số là có chủ đích)
+        self._a = rng.integers(1, 2 ** 63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+        self._b = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+        self._exact = set()
+        self._signatures = []
+        self._buckets: Dict[tuple, List[int]] = {}
+
+    def signature(self, text: str) -> np.ndarray:
+        words = _WORDS.findall(_text_key(text))
+        n = SHINGLE_WORDS
+        shingles = {" ".join(words[i:i + n]) for i in range(max(1, len(words) - n + 1))}
+        hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+        with np.errstate(over="ignore"):
+            return ((hashes[:, None] * self._a + self._b) >> np.uint64(32)).min(axis=0)
+
+    def check(self, text: str) -> Optional[str]:
+        """"exact" / "near" nếu trùng chunk đã thấy, None nếu mới (và ghi nhớ chunk này)"""
+        digest = hashlib.sha1(_text_key(text).encode("utf-8")).digest()
+        if digest in self._exact:
+            return "exact"
+
+        signature = self.signature(text)
+        keys = [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+        candidates = {i for key in keys for i in self._buckets.get(key, ())}
+        for i in candidates:
+            if np.mean(self._signatures[i] == signature) >= self.threshold:
+                return "near"
+
+        self._exact.add(digest)
+        index = len(self._signatures)
+        self._signatures.append(signature)
+        for key in keys:
+            self._buckets.setdefault(key, []).append(index)
+        return None
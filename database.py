@@ -1,18 +1,489 @@
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_huggingface import HuggingFaceEmbeddings
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import Future
+from bm25 import BM25_FILE, BM25Index, LazyBM25Index
+from docstore import DOCSTORE_FILE, SQLiteDocstore
 from functools import lru_cache
+from index_config import apply_search_params, load_index_params
+import atexit
+import faiss
+import metrics
+import numpy as np
 import os
+import pickle
+import shutil
+import threading
+import time
+import unicodedata
 
 # Get absolute path to faiss_index
 VECTOR_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "faiss_index")
+EMBEDDING_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+EMBEDDING_DIM = 384
+# Cache embedding câu hỏi, giữ qua các lần khởi động (không phụ thuộc index)
+QUERY_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "query_cache.npz")
+QUERY_CACHE_SIZE = 4096
+# Đổi mỗi lần index được build lại, để các cache phụ thuộc index tự xoá
+INDEX_VERSION_FILE = "VERSION"
+# Các collection (shard) build độc lập: indexes/<tên>/, cùng định dạng với faiss_index.
+# Collection "default" là faiss_index ở trên
+COLLECTIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "indexes")
+DEFAULT_COLLECTION = "default"
 
 @lru_cache(maxsize=1)
 def get_embeddings():
-    return HuggingFaceEmbeddings(
-        model_name="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
-    )
-
-def load_db():
-    embeddings = get_embeddings()
-    # Load từ local lên, cho phép giải nén an toàn
-    return FAISS.load_local(VECTOR_DB_PATH, embeddings, allow_dangerous_deserialization=True)
\ No newline at end of file
+    return HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+
+class LazyEmbeddings(Embeddings):
+    """Chỉ load sentence-transformer ở lần embed đầu tiên"""
+
+    def embed_documents(self, texts):
+        return get_embeddings().embed_documents(texts)
+
+    def embed_query(self, text):
+        return get_embeddings().embed_query(text)
+
+def normalize_query(text):
+    """Key cho cache: chuẩn hoá Unicode (NFC), bỏ hoa/thường, gộp khoảng trắng, bỏ dấu câu ở 2 đầu"""
+    text = unicodedata.normalize("NFC", text).casefold()
+    return " ".join(text.split()).strip(" ?!.,;:")
+
+class CachedEmbeddings(Embeddings):
+    """Bọc 1 Embeddings, cache embed_query theo LRU để câu hỏi lặp lại không phải chạy transformer"""
+
+    def __init__(self, base: Embeddings, max_size=QUERY_CACHE_SIZE, persist_path=None, dim=EMBEDDING_DIM):
+        self.base = base
+        self.max_size = max_size
+        self.persist_path = persist_path
+        # Số chiều vector của model; file cache khác số chiều (embedding khác) bị bỏ qua
+        self.dim = dim
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        # key -> Future của lần embed đang chạy; thread khác hỏi cùng câu thì chờ kết quả đó
+        self._inflight = {}
+        self._lock = threading.Lock()
+        if persist_path:
+            self.load()
+            atexit.register(self.save)
+
+    def embed_documents(self, texts):
+        return self.base.embed_documents(texts)
+
+    def embed_query(self, text):
+        key = normalize_query(text)
+        with self._lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                metrics.QUERY_CACHE.inc(result="hit")
+                return vector
+            # Routing và retrieval chạy song song cùng 1 câu hỏi -> chỉ embed 1 lần
+            pending = self._inflight.get(key)
+            if pending is None:
+                future = self._inflight[key] = Future()
+                self.misses += 1
+            else:
+                self.hits += 1
+        if pending is not None:
+            metrics.QUERY_CACHE.inc(result="hit")
+            return pending.result()
+        metrics.QUERY_CACHE.inc(result="miss")
+
+        try:
+            with metrics.stage("query_embedding"):
+                vector = self.base.embed_query(text)
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._cache[key] = vector
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+            del self._inflight[key]
+        future.set_result(vector)
+        return vector
+
+    def embed_queries(self, texts):
+        """Embed nhiều câu hỏi: lấy từ cache những câu đã có, phần còn lại chạy 1 batch"""
+        keys = [normalize_query(text) for text in texts]
+        vectors = {}
+        with self._lock:
+            for key in keys:
+                vector = self._cache.get(key)
+                if vector is not None:
+                    self._cache.move_to_end(key)
+                    vectors[key] = vector
+            hits = sum(1 for key in keys if key in vectors)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        metrics.QUERY_CACHE.inc(hits, result="hit")
+        metrics.QUERY_CACHE.inc(len(keys) - hits, result="miss")
+
+        # Câu trùng nhau trong batch chỉ embed 1 lần
+        missing = {key: text for key, text in zip(keys, texts) if key not in vectors}
+        if missing:
+            with metrics.stage("query_embedding"):
+                new_vectors = self.base.embed_documents(list(missing.values()))
+            with self._lock:
+                for key, vector in zip(missing, new_vectors):
+                    vectors[key] = vector
+                    self._cache[key] = vector
+                    self._cache.move_to_end(key)
+                while len(self._cache) > self.max_size:
+                    self._cache.popitem(last=False)
+        return [vectors[key] for key in keys]
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._cache)}
+
+    def load(self):
+        if not os.path.exists(self.persist_path):
+            return
+        try:
+            with np.load(self.persist_path, allow_pickle=False) as data:
+                if str(data["model"]) != EMBEDDING_MODEL or "dim" not in data.files or int(data["dim"]) != self.dim:
+                    return
+                keys, vectors = data["keys"], data["vectors"]
+            if vectors.ndim != 2 or vectors.shape[1] != self.dim:
+                return
+        except (OSError, KeyError, ValueError) as e:
+            print(f"⚠️ Bỏ qua query cache lỗi: {e}")
+            return
+        with self._lock:
+            for key, vector in zip(keys.tolist(), vectors.tolist()):
+                self._cache[key] = vector
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def save(self):
+        with self._lock:
+            if not self._cache:
+                return
+            keys = np.array(list(self._cache.keys()))
+            vectors = np.array(list(self._cache.values()), dtype=np.float32)
+        if vectors.ndim != 2 or vectors.shape[1] != self.dim:
+            return
+        # Tên file tạm riêng cho mỗi process: main.py và engine.py thoát cùng lúc không ghi đè nhau
+        tmp_path = f"{self.persist_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, model=np.array(EMBEDDING_MODEL), dim=np.array(self.dim), keys=keys, vectors=vectors)
+        os.replace(tmp_path, self.persist_path)
+
+@lru_cache(maxsize=1)
+def get_query_embeddings():
+    """Embeddings dùng cho vectorstore khi phục vụ: model load lười + cache câu hỏi"""
+    return CachedEmbeddings(LazyEmbeddings(), persist_path=QUERY_CACHE_PATH)
+
+class _PickledDocstore:
+    """Giải nén index.pkl (docstore + index_to_docstore_id) khi được truy cập lần đầu"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._data = None
+
+    def get(self):
+        if self._data is None:
+            with self._lock:
+                if self._data is None:
+                    with open(self.path, "rb") as f:
+                        self._data = pickle.load(f)
+        return self._data
+
+class LazyDocstore(Docstore, AddableMixin):
+    def __init__(self, source: _PickledDocstore):
+        self._source = source
+
+    def search(self, search):
+        return self._source.get()[0].search(search)
+
+    def add(self, texts):
+        self._source.get()[0].add(texts)
+
+    def delete(self, ids):
+        self._source.get()[0].delete(ids)
+
+class LazyIndexToDocstoreId(MutableMapping):
+    def __init__(self, source: _PickledDocstore):
+        self._source = source
+
+    def __getitem__(self, key):
+        return self._source.get()[1][key]
+
+    def __setitem__(self, key, value):
+        self._source.get()[1][key] = value
+
+    def __delitem__(self, key):
+        del self._source.get()[1][key]
+
+    def __iter__(self):
+        return iter(self._source.get()[1])
+
+    def __len__(self):
+        return len(self._source.get()[1])
+
+def read_index_mmap(path):
+    """Đọc index FAISS bằng mmap; nếu loại index/bản faiss không hỗ trợ thì đọc thường"""
+    io_flags = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+    try:
+        return faiss.read_index(path, io_flags)
+    except RuntimeError:
+        return faiss.read_index(path)
+
+def load_db(lazy=True, path=VECTOR_DB_PATH):
+    embeddings = get_query_embeddings()
+    if not lazy:
+        get_embeddings()
+    index_file = os.path.join(path, "index.faiss")
+    index = read_index_mmap(index_file) if lazy else faiss.read_index(index_file)
+    # nprobe/efSearch của index IVF/HNSW (index_params.json)
+    apply_search_params(index, load_index_params(path))
+
+    sqlite_path = os.path.join(path, DOCSTORE_FILE)
+    if os.path.exists(sqlite_path):
+        # Chỉ giữ trong RAM bảng vị trí -> ID; text/metadata đọc theo ID khi search
+        docstore = SQLiteDocstore(sqlite_path, readonly=True)
+        return FAISS(embeddings, index, docstore, docstore.load_index_map())
+
+    # Index cũ dạng index.pkl (chạy `python docstore.py` để chuyển sang SQLite).
+    # Docstore chỉ giải nén khi có kết quả search đầu tiên
+    source = _PickledDocstore(os.path.join(path, "index.pkl"))
+    if not lazy:
+        source.get()
+    return FAISS(embeddings, index, LazyDocstore(source), LazyIndexToDocstoreId(source))
+
+def load_db_for_update(embeddings, path=VECTOR_DB_PATH):
+    """Load index để sửa (incremental ingest).
+
+    Docstore được sửa trên bản sao docstore.sqlite.tmp; save_db() thay thế
+    file gốc khi xong, nên tiến trình đang đọc index cũ không bị ảnh hưởng.
+    """
+    index = faiss.read_index(os.path.join(path, "index.faiss"))
+    sqlite_path = os.path.join(path, DOCSTORE_FILE)
+    tmp_path = sqlite_path + ".tmp"
+
+    if os.path.exists(sqlite_path):
+        shutil.copyfile(sqlite_path, tmp_path)
+        docstore = SQLiteDocstore(tmp_path)
+        index_to_docstore_id = docstore.load_index_map()
+    else:
+        with open(os.path.join(path, "index.pkl"), "rb") as f:
+            legacy_docstore, index_to_docstore_id = pickle.load(f)
+        docstore = SQLiteDocstore.from_documents(tmp_path, legacy_docstore._dict)
+    return FAISS(embeddings, index, docstore, index_to_docstore_id)
+
+def new_docstore(path=VECTOR_DB_PATH):
+    """Docstore rỗng để build index mới, ghi vào file tạm cho tới khi save_db()"""
+    os.makedirs(path, exist_ok=True)
+    return SQLiteDocstore.from_documents(os.path.join(path, DOCSTORE_FILE) + ".tmp", {})
+
+def save_db(vectorstore, path=VECTOR_DB_PATH):
+    """Lưu index.faiss + docstore.sqlite, thay file cũ bằng os.replace.
+
+    Docstore của vectorstore bị đóng sau khi lưu.
+    """
+    os.makedirs(path, exist_ok=True)
+    index_file = os.path.join(path, "index.faiss")
+    sqlite_path = os.path.join(path, DOCSTORE_FILE)
+
+    docstore = vectorstore.docstore
+    if not isinstance(docstore, SQLiteDocstore):
+        # Vd. InMemoryDocstore từ FAISS.from_documents
+        docstore = SQLiteDocstore.from_documents(sqlite_path + ".tmp", docstore._dict)
+    docstore.save_index_map(vectorstore.index_to_docstore_id)
+    docstore.close()
+
+    faiss.write_index(vectorstore.index, index_file + ".tmp")
+    os.replace(index_file + ".tmp", index_file)
+    if os.path.abspath(docstore.path) != os.path.abspath(sqlite_path):
+        os.replace(docstore.path, sqlite_path)
+
+    # index.pkl cũ không còn khớp với index mới
+    legacy_path = os.path.join(path, "index.pkl")
+    if os.path.exists(legacy_path):
+        os.remove(legacy_path)
+
+def write_index_version(path=VECTOR_DB_PATH):
+    """Ghi version mới cho index (gọi sau khi đã lưu xong mọi file của index)"""
+    version = str(time.time_ns())
+    version_file = os.path.join(path, INDEX_VERSION_FILE)
+    with open(version_file + ".tmp", "w") as f:
+        f.write(version)
+    os.replace(version_file + ".tmp", version_file)
+    return version
+
+def read_index_version(path=VECTOR_DB_PATH):
+    """Version hiện tại của index (None nếu index chưa có file VERSION)"""
+    try:
+        with open(os.path.join(path, INDEX_VERSION_FILE)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def build_keyword_index(path=VECTOR_DB_PATH):
+    """Build lại BM25 từ docstore.sqlite đã lưu và ghi bm25.json cạnh index"""
+    docstore = SQLiteDocstore(os.path.join(path, DOCSTORE_FILE), readonly=True)
+    try:
+        keyword_index = BM25Index.build(
+            (chunk_id, doc.page_content) for chunk_id, doc in docstore.iter_documents()
+        )
+    finally:
+        docstore.close()
+    keyword_index.save(os.path.join(path, BM25_FILE))
+    return keyword_index
+
+def load_keyword_index(path=VECTOR_DB_PATH):
+    """BM25 index nếu có (index build trước khi có BM25 thì trả về None); file chỉ được
+    đọc ở lần search từ khoá đầu tiên"""
+    bm25_path = os.path.join(path, BM25_FILE)
+    if not os.path.exists(bm25_path):
+        return None
+    return LazyBM25Index(bm25_path)
+
+def collection_path(name):
+    """Thư mục index của 1 collection"""
+    if name == DEFAULT_COLLECTION:
+        return VECTOR_DB_PATH
+    if not name or name in (".", "..") or os.path.basename(name) != name:
+        raise ValueError(f"Tên collection không hợp lệ: {name!r}")
+    return os.path.join(COLLECTIONS_PATH, name)
+
+def list_collections():
+    """Tên các collection đã build (có index.faiss)"""
+    names = [DEFAULT_COLLECTION] if os.path.exists(os.path.join(VECTOR_DB_PATH, "index.faiss")) else []
+    if os.path.isdir(COLLECTIONS_PATH):
+        names += sorted(
+            name for name in os.listdir(COLLECTIONS_PATH)
+            if name != DEFAULT_COLLECTION and os.path.exists(os.path.join(COLLECTIONS_PATH, name, "index.faiss"))
+        )
+    return names
+
+def vector_search_ids(vectorstore, query, k=20):
+    """Search FAISS, trả về [(chunk_id, khoảng cách L2)] thay vì Document"""
+    vector = np.array([vectorstore.embedding_function.embed_query(query)], dtype=np.float32)
+    with metrics.stage("faiss_search"):
+        distances, positions = vectorstore.index.search(vector, k)
+    return [
+        (vectorstore.index_to_docstore_id[int(pos)], float(dist))
+        for dist, pos in zip(distances[0], positions[0]) if pos != -1
+    ]
+
+def vector_search_ids_batch(vectorstore, queries, k=20):
+    """Như vector_search_ids cho nhiều câu hỏi: 1 lần embed (batch) + 1 lần index.search"""
+    if not queries:
+        return []
+    embedding_function = vectorstore.embedding_function
+    if hasattr(embedding_function, "embed_queries"):
+        vectors = embedding_function.embed_queries(queries)
+    else:
+        with metrics.stage("query_embedding"):
+            vectors = embedding_function.embed_documents(queries)
+    matrix = np.asarray(vectors, dtype=np.float32)
+    with metrics.stage("faiss_search"):
+        distances, positions = vectorstore.index.search(matrix, k)
+    return [
+        [
+            (vectorstore.index_to_docstore_id[int(pos)], float(dist))
+            for dist, pos in zip(row_distances, row_positions) if pos != -1
+        ]
+        for row_distances, row_positions in zip(distances, positions)
+    ]
+
+def search_batch(vectorstore, queries, k=3):
+    """Retrieval cho N câu hỏi -> mỗi câu 1 list [(Document, khoảng cách L2)] đã xếp hạng.
+
+    Embed, search FAISS và đọc docstore đều chỉ 1 lần cho cả batch.
+    """
+    rankings = vector_search_ids_batch(vectorstore, queries, k)
+    ids = list(dict.fromkeys(chunk_id for ranking in rankings for chunk_id, _ in ranking))
+    documents = get_documents_by_id(vectorstore, ids)
+    return [
+        [(documents[chunk_id], score) for chunk_id, score in ranking if chunk_id in documents]
+        for ranking in rankings
+    ]
+
+def get_documents_by_id(vectorstore, ids):
+    """{chunk_id: Document} cho các ID tìm thấy; dùng 1 query SQL nếu docstore hỗ trợ"""
+    docstore = vectorstore.docstore
+    with metrics.stage("docstore_fetch"):
+        if hasattr(docstore, "search_many"):
+            found = docstore.search_many(ids)
+        else:
+            found = {chunk_id: docstore.search(chunk_id) for chunk_id in ids}
+    return {chunk_id: doc for chunk_id, doc in found.items() if isinstance(doc, Document)}
+
+def get_documents(vectorstore, ids):
+    """Lấy Document theo ID, giữ thứ tự"""
+    found = get_documents_by_id(vectorstore, ids)
+    return [found[chunk_id] for chunk_id in ids if chunk_id in found]
+
+def measure_startup(query="Đại học Cần Thơ là gì?"):
+    """Đo thời gian khởi động: load_db, query đầu tiên (load model) và query kế tiếp"""
+    timings = {}
+    t0 = time.perf_counter()
+    vectorstore = load_db()
+    timings["load_db"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    vectorstore.similarity_search(query, k=3)
+    timings["first_query"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    vectorstore.similarity_search(query, k=3)
+    timings["warm_query"] = time.perf_counter() - t0
+    return timings
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Đo thời gian khởi động, hoặc retrieval hàng loạt với --queries")
+    parser.add_argument("--queries", default=None, help="File câu hỏi (mỗi dòng 1 câu) để search theo batch")
+    parser.add_argument("-k", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--output", default=None, help="Ghi kết quả ra file JSON lines (mặc định: in ra màn hình)")
+    args = parser.parse_args()
+
+    if args.queries is None:
+        for stage, seconds in measure_startup().items():
+            print(f"⏱️ {stage}: {seconds * 1000:.1f} ms")
+        print(f"📦 Query cache: {get_query_embeddings().stats()}")
+    else:
+        with open(args.queries, "r", encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+        vectorstore = load_db()
+        out = open(args.output, "w", encoding="utf-8") if args.output else None
+        t0 = time.perf_counter()
+        for start in range(0, len(queries), args.batch_size):
+            batch = queries[start:start + args.batch_size]
+            for query, results in zip(batch, search_batch(vectorstore, batch, args.k)):
+                record = {
+                    "query": query,
+                    "results": [
+                        {"id": doc.id, "score": score, "metadata": doc.metadata, "content": doc.page_content}
+                        for doc, score in results
+                    ],
+                }
+                line = json.dumps(record, ensure_ascii=False)
+                if out:
+                    out.write(line + "\n")
+                else:
+                    print(line)
+        if out:
+            out.close()
+        elapsed = time.perf_counter() - t0
+        print(f"✅ {len(queries)} câu hỏi trong {elapsed:.2f}s ({len(queries) / max(elapsed, 1e-9):.1f} câu/s)")
@@ -1,17 +1,20 @@
 import ollama
-from database import load_db
+from context import ContextBuilder
+from database import get_query_embeddings
+from index_reload import ReloadableIndex
 import sys
 import time
 
 # 1. LOAD DB RA NGOÀI VÒNG LẶP: Chỉ load 1 lần duy nhất khi khởi động script
 print("🚀 Đang khởi tạo hệ thống và load dữ liệu...")
+t_init = time.perf_counter()
 try:
-    vectorstore = load_db()
-    retriever = vectorstore.as_retriever(
-        search_type="similarity",
-        search_kwargs={"k": 3} # Giảm k xuống 3 để nhanh hơn nếu tài liệu chất lượng
-    )
-    print("✅ Hệ thống sẵn sàng!")
+    index = ReloadableIndex(search_kwargs={"k": 3})  # Giảm k xuống 3 để nhanh hơn nếu tài liệu chất lượng
+    # Chạy lại ingest.py thì index mới được load nền và thay vào, không cần khởi động lại
+    index.watch(2.0)
+    # Model 0.5b: ngữ cảnh ngắn để prefill nhanh
+    context_builder = ContextBuilder(get_query_embeddings(), max_tokens=384)
+    print(f"✅ Hệ thống sẵn sàng! ({time.perf_counter() - t_init:.3f}s)")
 except Exception as e:
     print(f"❌ Lỗi: {e}")
     sys.exit(1)
@@ -28,14 +31,15 @@ def ask_bot():
         # Hiển thị trạng thái ngay lập tức
         print("🔍 Đang tìm tài liệu...", end="\r", flush=True)
       
-        docs = retriever.invoke(user_query)
+        snapshot = index.current
+        if snapshot is None:
+            print("⏳ Chưa có index, hãy chạy ingest.py (index được load tự động khi xong).")
+            continue
+        docs = snapshot.invoke(user_query)
    
         t_retrieve = time.perf_counter() - t_start
 
-        context_text = "\n\n".join(
-            d.page_content[:400].strip()
-            for d in docs if d.page_content.strip()
-        )
+        context_text = context_builder.build(user_query, docs)
 
         full_prompt = f"""Trả lời ngắn gọn dựa trên tài liệu:
 {context_text}
@@ -49,9 +53,9 @@ Câu hỏi: {user_query}"""
                 messages=[{"role": "user", "content": full_prompt}],
                 stream=True,
                 options={
-                    "temperature": 0.4, 
-                    "keep_alive": "-1",
-                }
+                    "temperature": 0.4,
+                },
+                keep_alive=-1  # keep_alive là tham số của request, không phải option của model
             )
 
             for chunk in stream:
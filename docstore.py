@@ -0,0 +1,155 @@
+"""
+Docstore lưu trên SQLite thay cho index.pkl.
+
+Text và metadata của chunk nằm trên đĩa, chỉ được đọc theo ID cho các kết quả
+top-k mà FAISS trả về, nên RAM chỉ tỉ lệ với index chứ không tỉ lệ với corpus,
+và không còn phải unpickle (không an toàn) khi khởi động.
+"""
+
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_core.documents import Document
+from urllib.request import pathname2url
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+DOCSTORE_FILE = "docstore.sqlite"
+
+class SQLiteDocstore(Docstore, AddableMixin):
+    """Docstore dạng bảng chunks(id, content, metadata) + index_map(pos, id)"""
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        if readonly:
+            uri = "file:" + pathname2url(os.path.abspath(path)) + "?mode=ro"
+            self._conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS chunks (
+                    id TEXT PRIMARY KEY,
+                    content TEXT NOT NULL,
+                    metadata TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS index_map (
+                    pos INTEGER PRIMARY KEY,
+                    id TEXT NOT NULL
+                );
+            """)
+        # Một connection dùng chung cho nhiều thread (retrieval chạy trong thread pool)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _to_document(chunk_id, content, metadata):
+        return Document(id=chunk_id, page_content=content, metadata=json.loads(metadata))
+
+    def search(self, search):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content, metadata FROM chunks WHERE id = ?", (search,)
+            ).fetchone()
+        if row is None:
+            # Giống InMemoryDocstore: trả về chuỗi thay vì raise
+            return f"ID {search} not found."
+        return self._to_document(search, *row)
+
+    def search_many(self, ids):
+        """Lấy nhiều chunk trong 1 query -> {id: Document}"""
+        ids = list(ids)
+        found = {}
+        # Giới hạn số tham số của SQLite (mặc định 999)
+        for start in range(0, len(ids), 900):
+            batch = ids[start:start + 900]
+            placeholders = ",".join("?" * len(batch))
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT id, content, metadata FROM chunks WHERE id IN ({placeholders})", batch
+                ).fetchall()
+            for chunk_id, content, metadata in rows:
+                found[chunk_id] = self._to_document(chunk_id, content, metadata)
+        return found
+
+    def add(self, texts):
+        rows = [
+            (chunk_id, doc.page_content, json.dumps(doc.metadata, ensure_ascii=False))
+            for chunk_id, doc in texts.items()
+        ]
+        try:
+            with self._lock, self._conn:
+                self._conn.executemany(
+                    "INSERT INTO chunks (id, content, metadata) VALUES (?, ?, ?)", rows
+                )
+        except sqlite3.IntegrityError as e:
+            raise ValueError(f"Tried to add ids that already exist: {e}")
+
+    def delete(self, ids):
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM chunks WHERE id = ?", [(i,) for i in ids])
+
+    def iter_documents(self):
+        """Duyệt toàn bộ chunk theo thứ tự trong index -> (id, Document)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT c.id, c.content, c.metadata FROM index_map m "
+                "JOIN chunks c ON c.id = m.id ORDER BY m.pos"
+            ).fetchall()
+        for chunk_id, content, metadata in rows:
+            yield chunk_id, self._to_document(chunk_id, content, metadata)
+
+    def load_index_map(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT pos, id FROM index_map").fetchall()
+        return dict(rows)
+
+    def save_index_map(self, index_to_docstore_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM index_map")
+            self._conn.executemany(
+                "INSERT INTO index_map (pos, id) VALUES (?, ?)", index_to_docstore_id.items()
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+    @classmethod
+    def from_documents(cls, path, documents):
+        """Tạo docstore mới từ {id: Document} (vd. InMemoryDocstore._dict)"""
+        if os.path.exists(path):
+            os.remove(path)
+        docstore = cls(path)
+        docstore.add(documents)
+        return docstore
+
+def migrate_pickle_docstore(index_path):
+    """Chuyển index.pkl cũ sang docstore.sqlite (chỉ cần chạy 1 lần)"""
+    import pickle
+
+    with open(os.path.join(index_path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+
+    final_path = os.path.join(index_path, DOCSTORE_FILE)
+    tmp_path = final_path + ".tmp"
+    store = SQLiteDocstore.from_documents(tmp_path, docstore._dict)
+    store.save_index_map(index_to_docstore_id)
+    store.close()
+    os.replace(tmp_path, final_path)
+    os.remove(os.path.join(index_path, "index.pkl"))
+    return len(index_to_docstore_id)
+
+if __name__ == "__main__":
+    index_path = sys.argv[1] if len(sys.argv) > 1 else "faiss_index"
+    n = migrate_pickle_docstore(index_path)
+    print(f"✅ Đã chuyển {n} chunks từ index.pkl sang {DOCSTORE_FILE}")
+
+    # Index cũ chưa có BM25 cho hybrid search
+    from database import build_keyword_index, write_index_version
+    build_keyword_index(index_path)
+    write_index_version(index_path)
+    print("✅ Đã build bm25.json")
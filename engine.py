@@ -0,0 +1,237 @@
+"""
+Engine asyncio phục vụ nhiều phiên chat đồng thời quanh MCPDispatcher.
+
+- Routing + retrieval (CPU-bound: embed query, FAISS, BM25) chạy trong thread pool,
+  song song với việc load model (ollama generate rỗng + keep_alive); khi routing
+  semantic chưa chắc chắn thì retrieval của tool hạng 2 cũng chạy trước
+- Token LLM được stream qua ollama.AsyncClient
+- Số request xử lý cùng lúc bị giới hạn bởi semaphore (max_concurrency)
+- Câu hỏi lặp lại (cùng ngữ cảnh retrieval) được trả lời từ AnswerCache, không gọi LLM
+- Chạy lại ingest.py thì index được reload nền, phiên chat không bị ngắt
+
+Chạy server: python engine.py --port 8765 --max-concurrency 8
+Giao thức: mỗi dòng client gửi là 1 câu hỏi; server trả về các dòng JSON
+{"token": "..."} rồi {"done": true, ...} khi trả lời xong.
+"""
+
+import argparse
+import asyncio
+import contextvars
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Dict, Optional
+
+import ollama
+
+import metrics
+from answer_cache import AnswerCache
+from index_reload import current_retriever
+
+class AsyncRAGEngine:
+    def __init__(self, dispatcher, retriever, model: str, options: Optional[Dict[str, Any]] = None,
+                 max_concurrency: int = 8, retrieval_workers: int = 4, ollama_host: Optional[str] = None,
+                 answer_cache: Optional[AnswerCache] = None, cache_tools=("rag_search",),
+                 keep_alive="30m", warm_interval: float = 60.0):
+        self.dispatcher = dispatcher
+        self.retriever = retriever
+        self.model = model
+        self.options = options or {}
+        self.max_concurrency = max_concurrency
+        self.answer_cache = answer_cache
+        self.cache_tools = set(cache_tools)
+        self.keep_alive = keep_alive
+        self.warm_interval = warm_interval
+        self._next_warm = 0.0
+        self._warm_task = None
+        self.client = ollama.AsyncClient(host=ollama_host)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._pool = ThreadPoolExecutor(max_workers=retrieval_workers, thread_name_prefix="rag-retrieval")
+
+    async def prepare(self, query: str):
+        """Routing + handler (gồm retrieval) trong thread pool -> (tool, confidence, prompt)"""
+        loop = asyncio.get_running_loop()
+        # Copy context để các stage chạy trong thread vẫn ghi vào trace của request
+        ctx = contextvars.copy_context()
+        # ReloadableIndex -> snapshot hiện tại; request giữ snapshot này tới khi xong dù index được reload
+        retriever = current_retriever(self.retriever)
+        return await loop.run_in_executor(self._pool, ctx.run, self.dispatcher.prepare_pipelined, query, retriever)
+
+    async def warm_model(self):
+        """Load model vào RAM của ollama nếu lâu rồi chưa warm (gọi song song với prepare)"""
+        now = time.monotonic()
+        if now < self._next_warm:
+            return
+        self._next_warm = now + self.warm_interval
+        t0 = time.perf_counter()
+        try:
+            await self.client.generate(model=self.model, prompt="", keep_alive=self.keep_alive)
+            # Dùng chung cho mọi request nên ghi thẳng vào histogram, không vào trace
+            metrics.STAGE_SECONDS.observe(time.perf_counter() - t0, stage="llm_warmup")
+        except Exception as e:
+            self._next_warm = 0.0
+            print(f"⚠️ Không load trước được model {self.model}: {e}")
+
+    async def answer(self, query: str) -> AsyncIterator[Dict[str, Any]]:
+        """Trả lời 1 câu hỏi, yield {"token": ...} rồi {"done": True, ...}"""
+        async with self._semaphore:
+            with metrics.start_trace(query=query) as trace:
+                t_start = time.perf_counter()
+                # Load model chạy song song với routing/retrieval; chat bên dưới tự chờ model sẵn sàng
+                if time.monotonic() >= self._next_warm:
+                    self._warm_task = asyncio.create_task(self.warm_model())
+                selected_tool, confidence, prompt = await self.prepare(query)
+                t_prep = time.perf_counter() - t_start
+                trace.attrs["tool"] = selected_tool
+
+                chunk_ids = trace.attrs.get("chunk_ids")
+                cacheable = self.answer_cache is not None and selected_tool in self.cache_tools
+                # lookup/put có thể embed câu hỏi -> chạy trong thread pool, không chặn event loop
+                loop = asyncio.get_running_loop()
+                cached = None
+                if cacheable:
+                    cached = await loop.run_in_executor(self._pool, self.answer_cache.lookup, query, chunk_ids)
+
+                if cached is not None:
+                    for token in cached:
+                        yield {"token": token}
+                else:
+                    t_llm = time.perf_counter()
+                    stream = await self.client.chat(
+                        model=self.model,
+                        messages=[{"role": "user", "content": prompt}],
+                        stream=True,
+                        options=self.options,
+                        keep_alive=self.keep_alive,
+                    )
+                    first_token = True
+                    tokens = []
+                    async for chunk in stream:
+                        if first_token:
+                            metrics.record("llm_ttft", time.perf_counter() - t_llm)
+                            first_token = False
+                        tokens.append(chunk['message']['content'])
+                        yield {"token": tokens[-1]}
+                    metrics.record("llm_generation", time.perf_counter() - t_llm)
+                    if cacheable:
+                        await loop.run_in_executor(self._pool, self.answer_cache.put, query, chunk_ids, tokens)
+
+                yield {
+                    "done": True,
+                    "tool": selected_tool,
+                    "confidence": confidence,
+                    "prep_s": round(t_prep, 4),
+                    "total_s": round(time.perf_counter() - t_start, 4),
+                    "cached": cached is not None,
+                    "trace_id": trace.id,
+                }
+
+    async def handle_session(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """1 kết nối TCP = 1 phiên chat, các câu hỏi trong phiên xử lý lần lượt"""
+        peer = writer.get_extra_info("peername")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                query = line.decode("utf-8", errors="replace").strip()
+                if not query:
+                    continue
+                if query.lower() in ['exit', 'quit']:
+                    break
+
+                try:
+                    async for event in self.answer(query):
+                        writer.write((json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8"))
+                        await writer.drain()
+                except (ConnectionError, asyncio.CancelledError):
+                    raise
+                except Exception as e:
+                    writer.write((json.dumps({"error": str(e), "done": True}, ensure_ascii=False) + "\n").encode("utf-8"))
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            print(f"👋 Phiên {peer} kết thúc")
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8765):
+        server = await asyncio.start_server(self.handle_session, host, port)
+        print(f"✅ RAG engine đang chạy tại {host}:{port} (tối đa {self.max_concurrency} request đồng thời)")
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Async RAG-MCP server cho nhiều người dùng")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-concurrency", type=int, default=8,
+                        help="Số request được xử lý cùng lúc (các request khác xếp hàng)")
+    parser.add_argument("--retrieval-workers", type=int, default=4,
+                        help="Số thread cho routing/retrieval")
+    parser.add_argument("--ollama-host", default=None)
+    parser.add_argument("--route", choices=["keyword", "semantic"], default="keyword")
+    parser.add_argument("--route-threshold", type=float, default=0.45)
+    parser.add_argument("--metrics-port", type=int, default=None, help="Mở /metrics (Prometheus) trên port này")
+    parser.add_argument("--trace-log", default=None, help="Ghi trace từng request (JSON lines) vào file")
+    parser.add_argument("--answer-cache-threshold", type=float, default=0.95)
+    parser.add_argument("--answer-cache-ttl", type=float, default=3600)
+    parser.add_argument("--no-answer-cache", action="store_true")
+    parser.add_argument("--mcp", action="append", default=[], metavar="NAME=ENDPOINT",
+                        help="Kết nối MCP server, vd. sensor_server=tcp://127.0.0.1:9101 (lặp lại được)")
+    parser.add_argument("--collections", default=None,
+                        help="Search trên các collection này (cách nhau bằng dấu phẩy, 'all' = tất cả)")
+    parser.add_argument("--filter", action="append", default=[], metavar="KEY=VALUE",
+                        help="Chỉ lấy chunk có metadata khớp, vd. source=a.pdf")
+    parser.add_argument("--context-tokens", type=int, default=None,
+                        help="Số token tối đa của ngữ cảnh tài liệu gửi cho LLM")
+    parser.add_argument("--reload-interval", type=float, default=2.0,
+                        help="Kiểm tra index mới (file VERSION) mỗi N giây, 0 = tắt reload")
+    args = parser.parse_args()
+    if args.metrics_port:
+        metrics.serve_metrics(args.metrics_port)
+    metrics.configure_trace_log(args.trace_log)
+
+    # Import main để dùng chung dispatcher/retriever đã khởi tạo
+    import main
+    if args.route == "semantic":
+        main.dispatcher.enable_semantic_routing(threshold=args.route_threshold)
+    for spec in args.mcp:
+        name, _, endpoint = spec.partition("=")
+        main.dispatcher.register_mcp_server(name, {"endpoint": endpoint})
+    if args.context_tokens:
+        main.dispatcher.context_builder.max_tokens = args.context_tokens
+    if args.collections:
+        from sharding import parse_filter
+        main.dispatcher.enable_sharding(None if args.collections == "all" else args.collections.split(","),
+                                        parse_filter(args.filter))
+    main.answer_cache.threshold = args.answer_cache_threshold
+    main.answer_cache.ttl = args.answer_cache_ttl
+    if args.reload_interval > 0:
+        if main.dispatcher.shards is not None:
+            main.dispatcher.shards.on_reload(main.clear_answer_cache)
+        main.dispatcher.watch_indexes(main.index, args.reload_interval)
+
+    async def run():
+        engine = AsyncRAGEngine(
+            main.dispatcher, main.index, main.OLLAMA_MODEL, main.OLLAMA_OPTIONS,
+            max_concurrency=args.max_concurrency,
+            retrieval_workers=args.retrieval_workers,
+            ollama_host=args.ollama_host,
+            answer_cache=None if args.no_answer_cache else main.answer_cache,
+            keep_alive=main.OLLAMA_KEEP_ALIVE,
+        )
+        # Model load trước khi có phiên đầu tiên
+        engine._warm_task = asyncio.create_task(engine.warm_model())
+        try:
+            await engine.serve(args.host, args.port)
+        finally:
+            engine.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,170 @@
+"""
+Các loại index FAISS cho corpus lớn: flat (chính xác), ivf-flat, ivf-pq, hnsw, sq8.
+
+Tham số build (nlist, pq_m, ...) và tham số search (nprobe, ef_search) được lưu
+vào index_params.json cạnh index.faiss; database.load_db đọc file này và áp
+tham số search khi load, nên phía phục vụ không cần biết index thuộc loại nào.
+
+Đổi tham số search không cần build lại index:
+    python index_config.py --nprobe 16
+"""
+
+import argparse
+import json
+import math
+import os
+
+import faiss
+import numpy as np
+
+INDEX_PARAMS_FILE = "index_params.json"
+INDEX_TYPES = ("flat", "ivf-flat", "ivf-pq", "hnsw", "sq8")
+DEFAULT_PARAMS = {
+    "index_type": "flat",
+    "nlist": 0,            # 0 = tự chọn theo số vector train (~4*sqrt(n))
+    "nprobe": 8,
+    "pq_m": 16,            # số sub-vector của PQ (384 chiều -> 24 chiều/sub-vector)
+    "pq_bits": 8,
+    "hnsw_m": 32,
+    "ef_construction": 80,
+    "ef_search": 64,
+}
+# Tham số quyết định cấu trúc index, đổi thì phải build lại
+BUILD_KEYS = ("index_type", "nlist", "pq_m", "pq_bits", "hnsw_m", "ef_construction")
+# FAISS.delete của LangChain cần index xoá xong thì các vector còn lại dồn vị trí
+# như IndexFlat; IVF giữ nguyên ID cũ, HNSW không hỗ trợ xoá -> phải build lại
+REMOVABLE_TYPES = {"flat", "sq8"}
+# Số điểm train tối thiểu cho mỗi centroid (faiss cảnh báo nếu ít hơn)
+MIN_POINTS_PER_CENTROID = 39
+MAX_TRAINING_SIZE = 50000
+
+def make_params(base=None, **overrides):
+    """Gộp DEFAULT_PARAMS, base (vd. params đã lưu) và các giá trị override khác None"""
+    params = dict(DEFAULT_PARAMS)
+    params.update(base or {})
+    params.update({key: value for key, value in overrides.items() if value is not None})
+    if params["index_type"] not in INDEX_TYPES:
+        raise ValueError(f"index_type phải là một trong {INDEX_TYPES}, nhận được {params['index_type']!r}")
+    return params
+
+def needs_rebuild(stored, overrides):
+    """Có tham số build nào được yêu cầu khác với index hiện có không"""
+    return any(
+        overrides.get(key) is not None and overrides[key] != stored.get(key)
+        for key in BUILD_KEYS
+    )
+
+def training_size(params):
+    """Số vector cần giữ lại để train trước khi thêm vào index (0 = không cần train)"""
+    index_type = params["index_type"]
+    if index_type in ("flat", "hnsw"):
+        return 0
+    if index_type == "sq8":
+        return 1000
+    n_centroids = params["nlist"] or 256
+    if index_type == "ivf-pq":
+        n_centroids = max(n_centroids, 2 ** params["pq_bits"])
+    return min(n_centroids * MIN_POINTS_PER_CENTROID, MAX_TRAINING_SIZE)
+
+def fit_params(params, n_train):
+    """Điều chỉnh nlist/pq_bits theo số vector train thực tế (corpus nhỏ)"""
+    params = dict(params)
+    if params["index_type"] in ("ivf-flat", "ivf-pq"):
+        nlist = params["nlist"] or int(4 * math.sqrt(n_train))
+        params["nlist"] = max(1, min(nlist, n_train // MIN_POINTS_PER_CENTROID))
+    params = fit_search_params(params)
+    if params["index_type"] == "ivf-pq":
+        # k-means của PQ cần ít nhất 2^bits điểm
+        params["pq_bits"] = max(1, min(params["pq_bits"], int(math.log2(max(n_train, 2)))))
+    return params
+
+def fit_search_params(params):
+    """Giới hạn nprobe theo nlist của index (đã train, hoặc vừa fit ở trên)"""
+    params = dict(params)
+    if params["index_type"] in ("ivf-flat", "ivf-pq") and params["nlist"]:
+        params["nprobe"] = max(1, min(params["nprobe"], params["nlist"]))
+    return params
+
+def _pq_subvectors(dim, pq_m):
+    """Số sub-vector lớn nhất <= pq_m mà chia hết số chiều"""
+    return next(m for m in range(min(pq_m, dim), 0, -1) if dim % m == 0)
+
+def make_index(dim, params):
+    """Tạo index rỗng (metric L2 như IndexFlatL2 trước đây)"""
+    index_type = params["index_type"]
+    if index_type == "flat":
+        return faiss.IndexFlatL2(dim)
+    if index_type == "sq8":
+        return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit)
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, params["hnsw_m"])
+        index.hnsw.efConstruction = params["ef_construction"]
+        index.hnsw.efSearch = params["ef_search"]
+        return index
+
+    quantizer = faiss.IndexFlatL2(dim)
+    if index_type == "ivf-flat":
+        index = faiss.IndexIVFFlat(quantizer, dim, params["nlist"])
+    else:
+        index = faiss.IndexIVFPQ(quantizer, dim, params["nlist"],
+                                 _pq_subvectors(dim, params["pq_m"]), params["pq_bits"])
+    index.nprobe = params["nprobe"]
+    return index
+
+def build_index(vectors, params):
+    """Tạo + train (nếu cần) index cho mẫu vectors -> (index, params đã fit)"""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    params = fit_params(params, len(vectors))
+    if params["index_type"] == "ivf-pq":
+        params["pq_m"] = _pq_subvectors(vectors.shape[1], params["pq_m"])
+    index = make_index(vectors.shape[1], params)
+    if not index.is_trained:
+        index.train(vectors)
+    return index, params
+
+def apply_search_params(index, params):
+    """Áp nprobe/efSearch lên index đã load (kể cả index đọc bằng mmap)"""
+    index_type = params.get("index_type", "flat")
+    if index_type in ("ivf-flat", "ivf-pq"):
+        faiss.extract_index_ivf(index).nprobe = params["nprobe"]
+    elif index_type == "hnsw":
+        faiss.downcast_index(index).hnsw.efSearch = params["ef_search"]
+
+def describe(params):
+    index_type = params["index_type"]
+    if index_type in ("ivf-flat", "ivf-pq"):
+        extra = f"nlist={params['nlist']}, nprobe={params['nprobe']}"
+        if index_type == "ivf-pq":
+            extra += f", pq={params['pq_m']}x{params['pq_bits']}bit"
+        return f"{index_type} ({extra})"
+    if index_type == "hnsw":
+        return f"hnsw (M={params['hnsw_m']}, efSearch={params['ef_search']})"
+    return index_type
+
+def load_index_params(path):
+    """Params của index đã lưu; index cũ chưa có file -> flat"""
+    try:
+        with open(os.path.join(path, INDEX_PARAMS_FILE), "r", encoding="utf-8") as f:
+            return make_params(json.load(f))
+    except FileNotFoundError:
+        return make_params()
+
+def save_index_params(path, params):
+    params_file = os.path.join(path, INDEX_PARAMS_FILE)
+    with open(params_file + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(params, f, indent=2)
+    os.replace(params_file + ".tmp", params_file)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Xem/đổi tham số search của index đã build")
+    parser.add_argument("--index", default="faiss_index")
+    parser.add_argument("--nprobe", type=int, default=None)
+    parser.add_argument("--ef-search", type=int, default=None)
+    args = parser.parse_args()
+
+    params = load_index_params(args.index)
+    if args.nprobe is not None or args.ef_search is not None:
+        params = make_params(params, nprobe=args.nprobe, ef_search=args.ef_search)
+        save_index_params(args.index, params)
+        print(f"✅ Đã lưu {INDEX_PARAMS_FILE}")
+    print(f"📦 Index: {describe(params)}")
@@ -0,0 +1,137 @@
+"""
+Reload index khi chạy lại ingest.py, không cần khởi động lại bot.
+
+ingest.py ghi index.faiss / docstore.sqlite ra file .tmp rồi os.replace, và ghi
+file VERSION sau cùng. Thread nền theo dõi VERSION; khi đổi thì load index mới
+(mmap + docstore mới), search thử 1 lần rồi mới thay vào. Index cũ không bị đóng:
+request đang chạy vẫn giữ snapshot cũ (file cũ vẫn mở qua mmap/connection) tới
+khi xong, rồi được GC dọn. Model embedding dùng chung (get_query_embeddings) nên
+không phải load lại. Chưa có index lúc khởi động thì `current` là None cho tới khi
+ingest ghi VERSION lần đầu.
+
+    index = ReloadableIndex(search_kwargs={"k": 3})
+    index.watch(2.0)
+    docs = index.current.invoke("Quy định sử dụng logo?")
+"""
+
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import metrics
+from database import (VECTOR_DB_PATH, get_documents_by_id, load_db, load_keyword_index, read_index_version,
+                      vector_search_ids)
+
+# Câu search thử trên index mới trước khi thay vào (embedding của nó nằm sẵn trong cache)
+WARM_QUERY = "Đại học Cần Thơ"
+
+class IndexSnapshot:
+    """1 phiên bản index đã load. Dùng thay retriever được (vectorstore, search_kwargs,
+    invoke), kèm BM25 index của đúng phiên bản đó"""
+
+    def __init__(self, vectorstore, keyword_index, search_kwargs: Dict[str, Any], version: Optional[str]):
+        self.vectorstore = vectorstore
+        self.keyword_index = keyword_index
+        self.search_kwargs = search_kwargs
+        self.version = version
+        self.retriever = vectorstore.as_retriever(search_kwargs=search_kwargs)
+
+    def invoke(self, query: str):
+        return self.retriever.invoke(query)
+
+class ReloadableIndex:
+    def __init__(self, path: str = VECTOR_DB_PATH, search_kwargs: Optional[Dict[str, Any]] = None):
+        self.path = path
+        self.search_kwargs = dict(search_kwargs or {"k": 3})
+        self._hooks: List[Callable[[IndexSnapshot], Any]] = []
+        self._reload_lock = threading.Lock()
+        self._stop = None
+        self._failed_version = None
+        # Thay snapshot = 1 phép gán thuộc tính; người đọc lấy `current` 1 lần cho mỗi request
+        self.current: Optional[IndexSnapshot] = None
+        version = read_index_version(path)
+        if not os.path.exists(os.path.join(path, "index.faiss")):
+            # Chưa có index: vẫn chạy, watch() load khi ingest ghi VERSION lần đầu
+            self._failed_version = version
+            print(f"ℹ️ Chưa có index {path}, sẽ tự load khi chạy xong ingest.py")
+            return
+        try:
+            self.current = self._load()
+        except Exception as e:
+            # Index hỏng: vẫn chạy, chỉ thử load lại khi có VERSION mới
+            self._failed_version = version
+            print(f"⚠️ Không load được index {path}, chờ ingest lại: {e}")
+
+    def _load(self) -> IndexSnapshot:
+        # Đọc VERSION trước khi load: nếu ingest xong trong lúc đang load thì lần
+        # kiểm tra sau thấy version mới hơn và load lại
+        version = read_index_version(self.path)
+        vectorstore = load_db(path=self.path)
+        return IndexSnapshot(vectorstore, load_keyword_index(self.path), dict(self.search_kwargs), version)
+
+    @staticmethod
+    def _warm(snapshot: IndexSnapshot):
+        """Search thử: mở docstore, chạm vào index đã mmap, đọc BM25 (đang ở thread nền nên
+        request đầu tiên sau reload không phải chờ); lỗi (file hỏng, thiếu) nổi lên ở đây"""
+        vectorstore = snapshot.vectorstore
+        if vectorstore.index.ntotal:
+            ranking = vector_search_ids(vectorstore, WARM_QUERY, 1)
+            get_documents_by_id(vectorstore, [chunk_id for chunk_id, _ in ranking])
+        if snapshot.keyword_index is not None:
+            snapshot.keyword_index.search(WARM_QUERY, 1)
+
+    def on_reload(self, callback: Callable[[IndexSnapshot], Any]):
+        """callback(snapshot mới) được gọi sau mỗi lần thay index"""
+        self._hooks.append(callback)
+
+    def reload(self, force: bool = False) -> bool:
+        """Load index mới nếu VERSION đổi (force: luôn load). True nếu đã thay snapshot"""
+        with self._reload_lock:
+            version = read_index_version(self.path)
+            current_version = self.current.version if self.current is not None else None
+            if not force and version in (current_version, self._failed_version):
+                return False
+            t0 = time.perf_counter()
+            try:
+                with metrics.stage("index_reload"):
+                    snapshot = self._load()
+                    self._warm(snapshot)
+            except Exception as e:
+                # Index hỏng -> giữ index cũ, chỉ thử lại khi có VERSION mới
+                self._failed_version = version
+                metrics.INDEX_RELOADS.inc(result="failed")
+                print(f"⚠️ Không reload được index {self.path}, vẫn dùng index cũ: {e}")
+                return False
+            previous, self.current = self.current, snapshot
+            metrics.INDEX_RELOADS.inc(result="ok")
+            print(f"🔄 Đã reload index {self.path} ({previous.version if previous else None} -> {snapshot.version}, "
+                  f"{snapshot.vectorstore.index.ntotal} chunk, {time.perf_counter() - t0:.2f}s)")
+
+        for hook in self._hooks:
+            try:
+                hook(snapshot)
+            except Exception as e:
+                print(f"⚠️ Lỗi khi xử lý reload index: {e}")
+        return True
+
+    def watch(self, interval: float = 2.0):
+        """Thread nền kiểm tra VERSION mỗi `interval` giây"""
+        if self._stop is not None:
+            return
+        stop = self._stop = threading.Event()
+
+        def loop():
+            while not stop.wait(interval):
+                self.reload()
+
+        threading.Thread(target=loop, name="rag-index-watch", daemon=True).start()
+
+    def close(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+
+def current_retriever(retriever):
+    """ReloadableIndex -> snapshot hiện tại (None nếu chưa có index); retriever thường giữ nguyên"""
+    return retriever.current if isinstance(retriever, ReloadableIndex) else retriever
@@ -1,33 +1,72 @@
 import os
+import argparse
+import hashlib
+import json
+import time
+from collections import Counter, deque
+from itertools import groupby
+from concurrent.futures import ProcessPoolExecutor
 import fitz  # PyMuPDF (Phải cài qua pip install pymupdf)
 import pytesseract
 from PIL import Image
 import io
 from langchain_community.vectorstores import FAISS
 from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 # THAY ĐỔI DÒNG NÀY:
 from langchain_core.documents import Document
+import metrics
+from chunking import ChunkDeduplicator, StructuredSplitter, extract_page_text, strip_furniture
+from database import (DEFAULT_COLLECTION, EMBEDDING_MODEL, build_keyword_index, collection_path, load_db_for_update,
+                      new_docstore, save_db, write_index_version)
+from index_config import (INDEX_TYPES, REMOVABLE_TYPES, build_index, describe, load_index_params,
+                          fit_search_params, make_params, needs_rebuild, save_index_params, training_size)
+from ocr_cache import OCRCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES
 
 # Không cần cấu hình tesseract_cmd trên Fedora vì nó nằm trong /usr/bin/tesseract
 
 DOCS_PATH = "docs/"
 VECTOR_DB_PATH = "faiss_index"
+MANIFEST_FILE = "manifest.json"
+EMBED_BATCH_SIZE = 64
+OCR_LANG = "vie+eng"
+# Chọn cách trích xuất từng trang (xem classify_page)
+EXTRACTION_MODES = ("auto", "ocr", "native")
+PAGE_PATHS = ("native", "image_ocr", "full_ocr", "empty")
+MIN_NATIVE_CHARS = 50          # text layer ít hơn -> coi là trang scan
+MIN_IMAGE_SIDE_PX = 100        # ảnh nhỏ hơn (icon, bullet, đường kẻ) không OCR
+MIN_IMAGE_AREA_RATIO = 0.03    # ảnh chiếm ít hơn 3% diện tích trang (logo, trang trí) không OCR
+SCAN_IMAGE_AREA_RATIO = 0.8    # trang scan = 1 ảnh phủ gần hết trang -> OCR thẳng ảnh đó
 
-def ocr_image_from_page(page):
+# OCR cache dùng chung (None = tắt cache), cấu hình qua configure_ocr_cache()
+_ocr_cache = None
+
+def configure_ocr_cache(cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+    global _ocr_cache
+    _ocr_cache = OCRCache(cache_dir, max_bytes) if cache_dir else None
+    return _ocr_cache
+
+def ocr_image(image_bytes, load_image, cache_tag=""):
+    """OCR 1 ảnh, qua cache nếu có. load_image() chỉ được gọi khi cache miss."""
+    def compute():
+        # OCR với cấu hình tối ưu cho tiếng Việt
+        return pytesseract.image_to_string(load_image(), lang=OCR_LANG)
+
+    if _ocr_cache is None:
+        return compute()
+    return _ocr_cache.get_or_compute(image_bytes, OCR_LANG + cache_tag, compute)
+
+def ocr_image_from_page(page, xrefs=None):
+    """OCR các ảnh trên trang (xrefs=None: mọi ảnh)"""
     ocr_text = ""
-    image_list = page.get_images(full=True)
-    
-    for img_index, img in enumerate(image_list):
+    if xrefs is None:
+        xrefs = [img[0] for img in page.get_images(full=True)]
+
+    for img_index, xref in enumerate(xrefs):
         try:
-            xref = img[0]
             base_image = page.parent.extract_image(xref)
             image_bytes = base_image["image"]
             
-            image = Image.open(io.BytesIO(image_bytes))
-            
-            # OCR với cấu hình tối ưu cho tiếng Việt
-            text = pytesseract.image_to_string(image, lang='vie+eng')
+            text = ocr_image(image_bytes, lambda: Image.open(io.BytesIO(image_bytes)))
             
             if text.strip():
                 ocr_text += f"\n[Nội dung từ hình ảnh {img_index+1}]:\n{text.strip()}"
@@ -36,38 +75,196 @@ def ocr_image_from_page(page):
             continue
     return ocr_text
 
-def process_pdf_with_ocr(pdf_path):
+def ocr_full_page(page):
+    # Chuyển trang thành ảnh (DPI=300 để rõ nét)
+    pix = page.get_pixmap(matrix=fitz.Matrix(300/72, 300/72))
+    return ocr_image(
+        pix.samples,
+        lambda: Image.frombytes("RGB", [pix.width, pix.height], pix.samples),
+        cache_tag=f":page{pix.width}x{pix.height}",
+    )
+
+def classify_page(page, page_text):
+    """Chọn cách trích xuất 1 trang -> (cách, [xref ảnh cần OCR], số ảnh bỏ qua)
+
+    - text layer ít hơn MIN_NATIVE_CHARS: trang scan. Nếu 1 ảnh phủ gần hết trang thì
+      OCR ảnh đó ở độ phân giải gốc (image_ocr), không thì render cả trang (full_ocr,
+      vd. chữ vẽ bằng vector); trang không có text, ảnh, hình vẽ nào -> empty
+    - ảnh nhỏ (icon, logo, đường kẻ) và ảnh đã có text layer phủ lên (PDF scan đã
+      OCR sẵn) bị bỏ qua; còn ảnh lớn chưa có text -> image_ocr, không thì native
+    """
+    images = [
+        (info["xref"], fitz.Rect(info["bbox"]) & page.rect, info["width"], info["height"])
+        for info in page.get_image_info(xrefs=True)
+        if info.get("xref")  # ảnh inline (xref 0) không extract được
+    ]
+    page_area = abs(page.rect)
+    if len(page_text) < MIN_NATIVE_CHARS:
+        if not page_text and not images and not page.get_drawings():
+            return "empty", [], 0
+        scans = [xref for xref, bbox, _, _ in images if abs(bbox) / page_area >= SCAN_IMAGE_AREA_RATIO]
+        if len(scans) == 1:
+            return "image_ocr", scans, len({xref for xref, _, _, _ in images}) - 1
+        return "full_ocr", [], 0
+
+    xrefs, seen, skipped = [], set(), 0
+    for xref, bbox, width, height in images:
+        if xref in seen:
+            continue
+        seen.add(xref)
+        tiny = bbox.is_empty or min(width, height) < MIN_IMAGE_SIDE_PX or abs(bbox) / page_area < MIN_IMAGE_AREA_RATIO
+        if tiny or len(page.get_text(clip=bbox).strip()) >= MIN_NATIVE_CHARS:
+            skipped += 1
+        else:
+            xrefs.append(xref)
+    return ("image_ocr" if xrefs else "native"), xrefs, skipped
+
+def process_page_with_ocr(page, source, mode="auto", stats=None):
+    """Xử lý 1 trang PDF, trả về Document hoặc None.
+
+    mode: auto = chọn cách trích xuất theo classify_page, ocr = OCR mọi ảnh và
+    OCR cả trang khi không có text (cách cũ), native = chỉ lấy text layer.
+    stats (Counter) đếm số trang theo từng cách, số ảnh đã OCR / bỏ qua.
+    """
+    stats = stats if stats is not None else Counter()
+    # 1. Lấy text thuần (theo đoạn, đánh dấu tiêu đề) + chọn cách xử lý phần còn lại
+    with metrics.stage("ingest_text_extraction"):
+        page_text = extract_page_text(page)
+        if mode == "auto":
+            path, xrefs, skipped = classify_page(page, page_text)
+        elif mode == "ocr":
+            xrefs = [img[0] for img in page.get_images(full=True)]
+            path, skipped = ("image_ocr" if xrefs else "native"), 0
+        else:
+            path, xrefs, skipped = ("native" if page_text else "empty"), [], len(page.get_images())
+    stats["images_skipped"] += skipped
+
+    # 2. Lấy text từ ảnh
+    image_text = ""
+    if path == "image_ocr":
+        with metrics.stage("ingest_ocr"):
+            image_text = ocr_image_from_page(page, xrefs)
+        stats["images_ocr"] += len(xrefs)
+
+    # 3. Trang scan: OCR toàn bộ trang (text layer ít ỏi nếu có cũng nằm trong ảnh trang)
+    if path == "full_ocr" or (mode == "ocr" and not page_text and not image_text):
+        path = "full_ocr"
+        with metrics.stage("ingest_ocr"):
+            page_text = ocr_full_page(page).strip() or page_text
+    stats[path] += 1
+
+    combined_content = f"{page_text}\n{image_text}".strip()
+
+    if not combined_content:
+        return None
+    return Document(
+        page_content=combined_content,
+        metadata={"source": source, "page": page.number + 1}
+    )
+
+def process_pdf_with_ocr(pdf_path, mode="auto", stats=None):
     doc = fitz.open(pdf_path)
     documents = []
     
     for page_num in range(len(doc)):
-        page = doc[page_num]
-        
-        # 1. Lấy text thuần
-        page_text = page.get_text().strip()
-        
-        # 2. Lấy text từ ảnh
-        image_text = ocr_image_from_page(page)
-        
-        # Nếu là trang scan hoàn toàn (không có text thuần), ta có thể cân nhắc 
-        # dùng thêm tính năng convert toàn bộ trang thành ảnh rồi OCR.
-        if not page_text and not image_text:
-            # Chuyển trang thành ảnh (DPI=300 để rõ nét)
-            pix = page.get_pixmap(matrix=fitz.Matrix(300/72, 300/72))
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-            page_text = pytesseract.image_to_string(img, lang='vie+eng')
-
-        combined_content = f"{page_text}\n{image_text}".strip()
-        
-        if combined_content:
-            documents.append(Document(
-                page_content=combined_content,
-                metadata={"source": os.path.basename(pdf_path), "page": page_num + 1}
-            ))
+        document = process_page_with_ocr(doc[page_num], os.path.basename(pdf_path), mode, stats)
+        if document is not None:
+            documents.append(document)
             
     doc.close()
     return documents
 
+# --- XỬ LÝ SONG SONG THEO TRANG ---
+# Mỗi worker (process con) giữ lại file PDF đang mở để không phải fitz.open() lại
+# cho từng trang; đường chạy tuần tự trong process cha mở/đóng theo từng file
+_worker_doc = {"path": None, "doc": None}
+
+def _init_ocr_worker(ocr_cache_config=None):
+    if ocr_cache_config is not None:
+        configure_ocr_cache(*ocr_cache_config)
+    # Tesseract tự dùng OpenMP đa luồng; khi đã chia trang cho nhiều process
+    # thì giới hạn 1 luồng/process để tránh tranh chấp CPU
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+def _open_worker_doc(pdf_path):
+    if _worker_doc["path"] != pdf_path:
+        if _worker_doc["doc"] is not None:
+            _worker_doc["doc"].close()
+        _worker_doc["doc"] = fitz.open(pdf_path)
+        _worker_doc["path"] = pdf_path
+    return _worker_doc["doc"]
+
+def _process_page_task(task):
+    """Task chạy trong worker: (pdf_path, page_num, mode) -> (Document hoặc None, spans, thống kê trang)
+
+    Thời gian các stage được trả về cùng kết quả vì histogram của process
+    worker không nhìn thấy được từ process cha.
+    """
+    return _process_page(_open_worker_doc(task[0]), task)
+
+def _process_page(doc, task):
+    pdf_path, page_num, mode = task
+    page_stats = Counter()
+    with metrics.collect_spans() as spans:
+        document = process_page_with_ocr(doc[page_num], os.path.basename(pdf_path), mode, page_stats)
+    return document, spans, page_stats
+
+def list_page_tasks(pdf_paths, mode="auto"):
+    """Liệt kê (pdf_path, page_num, mode) cho tất cả trang, theo thứ tự cố định"""
+    tasks = []
+    for pdf_path in pdf_paths:
+        with fitz.open(pdf_path) as doc:
+            tasks.extend((pdf_path, page_num, mode) for page_num in range(len(doc)))
+    return tasks
+
+def iter_page_documents(pdf_paths, workers=None, prefetch=4, mode="auto", stats=None):
+    """OCR tất cả trang của nhiều PDF bằng process pool, yield từng Document.
+
+    Kết quả giữ đúng thứ tự (file, trang) bất kể worker nào xong trước,
+    nên index FAISS tạo ra luôn giống nhau giữa các lần chạy. Chỉ có tối đa
+    workers * prefetch trang đang xử lý/chờ, nên bộ nhớ không tăng theo corpus
+    và bước embedding có thể chạy song song với OCR.
+
+    stats (dict, tuỳ chọn) nhận thống kê theo file: {tên file: Counter cách trích xuất}.
+    """
+    tasks = list_page_tasks(pdf_paths, mode)
+    workers = workers or os.cpu_count() or 1
+
+    def collect(task, result):
+        document, spans, page_stats = result
+        metrics.observe_spans(spans)
+        if stats is not None:
+            stats.setdefault(os.path.basename(task[0]), Counter()).update(page_stats)
+        return document
+
+    if workers <= 1 or len(tasks) <= 1:
+        for pdf_path, file_tasks in groupby(tasks, key=lambda task: task[0]):
+            with fitz.open(pdf_path) as doc:
+                for task in file_tasks:
+                    document = collect(task, _process_page(doc, task))
+                    if document is not None:
+                        yield document
+        return
+
+    cache_config = (_ocr_cache.cache_dir, _ocr_cache.max_bytes) if _ocr_cache else (None,)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_ocr_worker,
+                             initargs=(cache_config,)) as executor:
+        task_iter = iter(tasks)
+        pending = deque()
+        for task in task_iter:
+            pending.append((task, executor.submit(_process_page_task, task)))
+            if len(pending) >= workers * prefetch:
+                break
+
+        while pending:
+            task, future = pending.popleft()
+            document = collect(task, future.result())
+            next_task = next(task_iter, None)
+            if next_task is not None:
+                pending.append((next_task, executor.submit(_process_page_task, next_task)))
+            if document is not None:
+                yield document
+
 def process_pdf_simple(pdf_path):
     """Process PDF without OCR - just extract text directly"""
     doc = fitz.open(pdf_path)
@@ -76,60 +273,339 @@ def process_pdf_simple(pdf_path):
     for page_num in range(len(doc)):
         page = doc[page_num]
         
-        # Only extract text directly from PDF
-        page_text = page.get_text().strip()
+        # Only extract text directly from PDF, giữ cấu trúc đoạn/tiêu đề cho bước chia chunk
+        cleaned_text = extract_page_text(page)
         
-        # Clean up the text but preserve structure
-        if page_text:
-            # Remove excessive whitespace but keep some line breaks for structure
-            lines = page_text.split('\n')
-            cleaned_lines = []
-            for line in lines:
-                line = line.strip()
-                if line:  # Skip empty lines
-                    cleaned_lines.append(line)
-            
-            cleaned_text = ' '.join(cleaned_lines)
-            
-            # Only add if we have meaningful content
-            if len(cleaned_text) > 30:  # Lower threshold to catch more content
-                documents.append(Document(
-                    page_content=cleaned_text,
-                    metadata={"source": os.path.basename(pdf_path), "page": page_num + 1}
-                ))
+        # Only add if we have meaningful content
+        if len(cleaned_text) > 30:  # Lower threshold to catch more content
+            documents.append(Document(
+                page_content=cleaned_text,
+                metadata={"source": os.path.basename(pdf_path), "page": page_num + 1}
+            ))
             
     doc.close()
     return documents
 
-def build_vector_db():
-    print("--- 🚀 PDF Text Extraction with OCR Mode ---")
-    
-    if not os.path.exists(DOCS_PATH):
-        os.makedirs(DOCS_PATH)
-        return
+# --- MANIFEST CHO INCREMENTAL RE-INDEX ---
+# manifest.json nằm cạnh index: {file: {size, mtime, sha256, chunk_ids}}
 
-    all_docs = []
-    pdf_files = [f for f in os.listdir(DOCS_PATH) if f.endswith(".pdf")]
-    
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def load_manifest(index_path=VECTOR_DB_PATH):
+    path = os.path.join(index_path, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f).get("files", {})
+
+def save_manifest(files, index_path=VECTOR_DB_PATH):
+    path = os.path.join(index_path, MANIFEST_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": 1, "files": files}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def diff_against_manifest(pdf_files, manifest, docs_path=DOCS_PATH):
+    """So sánh docs/ với manifest -> (changed, unchanged, deleted).
+
+    Chỉ tính hash khi size/mtime khác manifest, để lần chạy không có thay đổi
+    không phải đọc lại toàn bộ corpus.
+    """
+    changed, unchanged = {}, {}
     for file in pdf_files:
-        print(f"📄 Đang xử lý với OCR: {file}...")
-        all_docs.extend(process_pdf_with_ocr(os.path.join(DOCS_PATH, file)))
+        stat = os.stat(os.path.join(docs_path, file))
+        entry = manifest.get(file)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            unchanged[file] = entry
+            continue
 
-    if not all_docs:
-        print("❌ Không tìm thấy nội dung nào để index!")
+        sha = file_sha256(os.path.join(docs_path, file))
+        info = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha}
+        if entry and entry["sha256"] == sha:
+            # Chỉ bị touch, nội dung không đổi
+            unchanged[file] = {**entry, **info}
+        else:
+            changed[file] = info
+
+    deleted = [file for file in manifest if file not in pdf_files]
+    return changed, unchanged, deleted
+
+def iter_chunks_with_ids(pages, file_info, stats=None):
+    """Chia chunk theo cấu trúc và gán ID ổn định theo (file, hash, thứ tự chunk).
+
+    Trang của cùng 1 file đến liền nhau (iter_page_documents giữ thứ tự) nên được
+    gom theo file để bỏ header/footer lặp lại; chunk trùng (giống hệt hoặc gần
+    giống) với chunk đã gặp trong cùng file bị bỏ trước khi embed. Không lọc trùng
+    giữa các file: manifest xoá chunk theo file, nên mỗi file phải giữ chunk của
+    riêng nó (xoá file A không được làm mất đoạn văn file B cũng có).
+    stats (Counter) đếm số đoạn header/footer và số chunk trùng đã bỏ.
+    """
+    splitter = StructuredSplitter(chunk_size=1500, chunk_overlap=150)
+    stats = stats if stats is not None else Counter()
+
+    counters = {}
+    for source, file_pages in groupby(pages, key=lambda page: page.metadata["source"]):
+        file_pages = list(file_pages)
+        deduplicator = ChunkDeduplicator()
+        with metrics.stage("ingest_splitting"):
+            file_pages = strip_furniture(file_pages, stats)
+        heading = None
+        for page in file_pages:
+            with metrics.stage("ingest_splitting"):
+                chunks, heading = splitter.split_document(page, heading)
+            for chunk in chunks:
+                with metrics.stage("ingest_dedup"):
+                    duplicate = deduplicator.check(chunk.page_content)
+                if duplicate:
+                    stats[f"duplicate_{duplicate}"] += 1
+                    continue
+                n = counters.get(source, 0)
+                counters[source] = n + 1
+                chunk_id = f"{source}:{file_info[source]['sha256'][:12]}:{n}"
+                file_info[source].setdefault("chunk_ids", []).append(chunk_id)
+                yield chunk, chunk_id
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _new_vectorstore(embeddings, docstore, pending, index_params):
+    """Tạo FAISS với index theo index_params, train trên các batch đang chờ"""
+    sample = [vector for _, vectors, _, _ in pending for vector in vectors]
+    with metrics.stage("ingest_index_training"):
+        index, fitted = build_index(sample, index_params)
+    # Ghi lại giá trị thực tế (vd. nlist tự chọn theo số vector train)
+    index_params.update(fitted)
+    return FAISS(embeddings, index, docstore, {})
+
+def add_chunk_batches(vectorstore, embeddings, chunks, batch_size=EMBED_BATCH_SIZE, docstore=None,
+                      index_params=None):
+    """Embed chunk theo từng batch rồi thêm dần vào index.
+
+    Trả về (vectorstore, số chunk đã thêm); nếu truyền vào None thì vectorstore
+    được tạo (khi đã biết số chiều vector) trên docstore cho trước, với loại index
+    theo index_params (mặc định flat). Index cần train (IVF, SQ8) thì các batch
+    đầu được giữ lại làm mẫu train rồi mới thêm vào index.
+    """
+    index_params = index_params if index_params is not None else make_params()
+    n_train = training_size(index_params)
+    pending = []
+    n_pending = 0
+    added = 0
+    for batch in iter_batches(chunks, batch_size):
+        texts = [chunk.page_content for chunk, _ in batch]
+        metadatas = [chunk.metadata for chunk, _ in batch]
+        ids = [chunk_id for _, chunk_id in batch]
+        with metrics.stage("ingest_embedding"):
+            vectors = embeddings.embed_documents(texts)
+
+        if vectorstore is None:
+            pending.append((texts, vectors, metadatas, ids))
+            n_pending += len(texts)
+            if n_pending < n_train:
+                continue
+            vectorstore = _new_vectorstore(embeddings, docstore, pending, index_params)
+        else:
+            pending = [(texts, vectors, metadatas, ids)]
+
+        for texts, vectors, metadatas, ids in pending:
+            vectorstore.add_embeddings(zip(texts, vectors), metadatas=metadatas, ids=ids)
+            added += len(texts)
+        pending = []
+
+    # Corpus nhỏ hơn mẫu train: train trên toàn bộ
+    if pending:
+        vectorstore = _new_vectorstore(embeddings, docstore, pending, index_params)
+        for texts, vectors, metadatas, ids in pending:
+            vectorstore.add_embeddings(zip(texts, vectors), metadatas=metadatas, ids=ids)
+            added += len(texts)
+    return vectorstore, added
+
+def format_extraction_stats(stats):
+    pages = ", ".join(f"{stats[path]} {path}" for path in PAGE_PATHS if stats.get(path))
+    return f"{pages or '0 trang'} | OCR {stats.get('images_ocr', 0)} ảnh, bỏ qua {stats.get('images_skipped', 0)} ảnh"
+
+def build_vector_db(workers=None, incremental=False, batch_size=EMBED_BATCH_SIZE, index_overrides=None,
+                    extraction="auto", docs_path=DOCS_PATH, index_path=VECTOR_DB_PATH):
+    """index_overrides: tham số index (index_type, nlist, nprobe...) khác None từ CLI
+    extraction: cách trích xuất trang (auto/ocr/native, xem process_page_with_ocr)
+    docs_path/index_path: thư mục PDF và thư mục index (mỗi collection 1 cặp riêng)"""
+    print(f"--- 🚀 PDF Text Extraction ({extraction}) ---")
+    
+    if not os.path.exists(docs_path):
+        os.makedirs(docs_path)
         return
 
-    # Increase chunk size for better context
-    splitter = RecursiveCharacterTextSplitter(chunk_size=1500, chunk_overlap=150)
-    texts = splitter.split_documents(all_docs)
+    # Sắp xếp để thứ tự chunk trong index luôn cố định
+    pdf_files = sorted(f for f in os.listdir(docs_path) if f.endswith(".pdf"))
+
+    index_exists = os.path.exists(os.path.join(index_path, "index.faiss"))
+    manifest = load_manifest(index_path) if incremental and index_exists else {}
+    if incremental and not manifest:
+        print("ℹ️ Chưa có manifest/index, chuyển sang build toàn bộ.")
+        incremental = False
 
+    index_overrides = index_overrides or {}
+    if incremental:
+        stored_params = load_index_params(index_path)
+        # nprobe/ef_search mới áp lên index đã train: nprobe không vượt nlist đã lưu
+        index_params = fit_search_params(make_params(stored_params, **index_overrides))
+        if needs_rebuild(stored_params, index_overrides):
+            print(f"ℹ️ Đổi loại/tham số index ({describe(stored_params)} -> {index_params['index_type']}), build lại toàn bộ.")
+            incremental = False
+            manifest = {}
+    else:
+        index_params = make_params(**index_overrides)
+
+    changed, unchanged, deleted = diff_against_manifest(pdf_files, manifest, docs_path)
+    if incremental and index_params["index_type"] not in REMOVABLE_TYPES and (
+            deleted or any(f in manifest for f in changed)):
+        print(f"ℹ️ Index {index_params['index_type']} không xoá được vector cũ, build lại toàn bộ.")
+        incremental = False
+        changed, unchanged, deleted = diff_against_manifest(pdf_files, {}, docs_path)
+
+    if incremental:
+        print(f"🔎 Thay đổi: {len(changed)} mới/sửa, {len(deleted)} bị xoá, {len(unchanged)} giữ nguyên")
+        if not changed and not deleted:
+            save_manifest(unchanged, index_path)
+            # Tham số search (nprobe, ef_search) vẫn có thể đổi mà không cần build lại;
+            # đổi VERSION để tiến trình đang phục vụ reload và áp tham số mới
+            if index_params != stored_params:
+                save_index_params(index_path, index_params)
+                write_index_version(index_path)
+                print(f"🔧 Đã đổi tham số search: {describe(index_params)}")
+            print("✅ Index đã cập nhật, không cần xử lý lại.")
+            return
+    
     # Use better embedding model for Vietnamese
     embeddings = HuggingFaceEmbeddings(
-        model_name="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+        model_name=EMBEDDING_MODEL,
+        encode_kwargs={"batch_size": batch_size},
+    )
+
+    vectorstore = None
+    docstore = None
+    if incremental:
+        vectorstore = load_db_for_update(embeddings, index_path)
+        # Xoá vector của file bị xoá hoặc bị sửa (file sửa sẽ được index lại bên dưới)
+        stale_ids = [
+            chunk_id
+            for file in deleted + [f for f in changed if f in manifest]
+            for chunk_id in manifest[file].get("chunk_ids", [])
+        ]
+        if stale_ids:
+            vectorstore.delete(stale_ids)
+            print(f"🗑️ Đã xoá {len(stale_ids)} chunks cũ")
+
+    else:
+        # Text/metadata chunk ghi thẳng xuống SQLite thay vì giữ trong RAM
+        docstore = new_docstore(index_path)
+
+    if not incremental:
+        print(f"📦 Loại index: {describe(index_params)}")
+    print(f"📄 Đang xử lý ({extraction}): {len(changed)} file ({workers or os.cpu_count()} workers)...")
+    t_start = time.perf_counter()
+    extraction_stats = {}
+    chunk_stats = Counter()
+    pages = iter_page_documents(
+        [os.path.join(docs_path, file) for file in changed], workers=workers,
+        mode=extraction, stats=extraction_stats
+    )
+    # OCR -> split -> embed theo batch -> thêm vào index, không giữ toàn bộ corpus trong RAM
+    vectorstore, n_chunks = add_chunk_batches(
+        vectorstore, embeddings, iter_chunks_with_ids(pages, changed, chunk_stats),
+        batch_size=batch_size, docstore=docstore, index_params=index_params
     )
-    vectorstore = FAISS.from_documents(texts, embeddings)
-    vectorstore.save_local(VECTOR_DB_PATH)
-    print(f"✅ Đã lưu thành công {len(texts)} chunks!")
+    elapsed = time.perf_counter() - t_start
+
+    if _ocr_cache is not None:
+        evicted = _ocr_cache.evict()
+        if evicted:
+            print(f"🧹 OCR cache: đã xoá {evicted} entry cũ")
+
+    if extraction_stats:
+        print("🔤 Cách trích xuất theo file:")
+        for file, stats in extraction_stats.items():
+            print(f"   {file}: {format_extraction_stats(stats)}")
+            changed[file]["extraction"] = dict(stats)
+        if len(extraction_stats) > 1:
+            print(f"   Tổng: {format_extraction_stats(sum(extraction_stats.values(), Counter()))}")
+
+    if chunk_stats:
+        print(f"✂️ Chunking: bỏ {chunk_stats['furniture_removed']} đoạn header/footer lặp lại, "
+              f"{chunk_stats['duplicate_exact'] + chunk_stats['duplicate_near']} chunk trùng "
+              f"({chunk_stats['duplicate_exact']} giống hệt, {chunk_stats['duplicate_near']} gần giống)")
+
+    if vectorstore is None:
+        docstore.close()
+        os.remove(docstore.path)
+        print("❌ Không tìm thấy nội dung nào để index!")
+        return
+
+    n_total = vectorstore.index.ntotal
+    save_db(vectorstore, index_path)
+    save_index_params(index_path, index_params)
+    # BM25 cho hybrid search, build lại từ docstore (không cần embed lại)
+    build_keyword_index(index_path)
+
+    for info in changed.values():
+        info.setdefault("chunk_ids", [])
+    save_manifest({**unchanged, **changed}, index_path)
+    # Báo cho các tiến trình đang phục vụ (answer cache...) biết index đã đổi
+    write_index_version(index_path)
+    print(f"✅ Đã lưu thành công {n_chunks} chunks mới (tổng {n_total}, {describe(index_params)})!")
+    if n_chunks:
+        print(f"⏱️ {elapsed:.1f}s, {n_chunks / elapsed:.1f} chunks/s (batch size {batch_size})")
+    summary = metrics.format_summary("ingest_")
+    if summary:
+        # OCR chạy song song nên tổng thời gian các stage có thể lớn hơn thời gian thực
+        print("📊 Thời gian theo stage (cộng dồn mọi worker):")
+        print(summary)
 
 if __name__ == "__main__":
-    build_vector_db()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Build FAISS index từ các file PDF trong docs/")
+    parser.add_argument("--collection", default=None,
+                        help="Build collection riêng: PDF trong docs/<tên>/, index trong indexes/<tên>/")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Số process OCR song song (mặc định: số CPU, 1 = chạy tuần tự)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Chỉ xử lý file mới/đã sửa theo manifest.json, xoá vector của file bị xoá")
+    parser.add_argument("--ocr-cache", default=DEFAULT_CACHE_DIR,
+                        help="Thư mục cache kết quả OCR (mặc định: ocr_cache/)")
+    parser.add_argument("--ocr-cache-size", type=int, default=DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help="Dung lượng tối đa của OCR cache (MB)")
+    parser.add_argument("--no-ocr-cache", action="store_true", help="Tắt OCR cache")
+    parser.add_argument("--extraction", choices=EXTRACTION_MODES, default="auto",
+                        help="auto: chỉ OCR trang scan và ảnh lớn chưa có text; ocr: OCR mọi ảnh; native: không OCR")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE,
+                        help="Số chunk embed mỗi batch")
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default=None,
+                        help="Loại index FAISS (mặc định: flat, hoặc loại đang dùng khi --incremental)")
+    parser.add_argument("--nlist", type=int, default=None, help="Số cluster IVF (0 = tự chọn)")
+    parser.add_argument("--nprobe", type=int, default=None, help="Số cluster IVF được duyệt khi search")
+    parser.add_argument("--pq-m", type=int, default=None, help="Số sub-vector PQ (ivf-pq)")
+    parser.add_argument("--hnsw-m", type=int, default=None, help="Số cạnh mỗi node HNSW")
+    parser.add_argument("--ef-search", type=int, default=None, help="efSearch của HNSW khi search")
+    args = parser.parse_args()
+    configure_ocr_cache(None if args.no_ocr_cache else args.ocr_cache, args.ocr_cache_size * 1024 * 1024)
+    paths = {}
+    if args.collection and args.collection != DEFAULT_COLLECTION:
+        paths = {"docs_path": os.path.join(DOCS_PATH, args.collection), "index_path": collection_path(args.collection)}
+    index_overrides = {
+        "index_type": args.index_type, "nlist": args.nlist, "nprobe": args.nprobe,
+        "pq_m": args.pq_m, "hnsw_m": args.hnsw_m, "ef_search": args.ef_search,
+    }
+    build_vector_db(workers=args.workers, incremental=args.incremental, batch_size=args.batch_size,
+                    index_overrides={key: value for key, value in index_overrides.items() if value is not None},
+                    extraction=args.extraction, **paths)
\ No newline at end of file
@@ -1,123 +1,246 @@
 import ollama
-from database import load_db
+import metrics
+from answer_cache import AnswerCache, replay
+from bm25 import reciprocal_rank_fusion
+from context import ContextBuilder
+from database import get_documents, get_documents_by_id, get_query_embeddings, vector_search_ids, vector_search_ids_batch
+from index_reload import ReloadableIndex
+from mcp_transport import MCPClientPool
+from semantic_router import SemanticRouter
+from sharding import ShardedIndex, parse_filter
 import time
+import threading
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 import json
+import argparse
 import asyncio
+import re
+import unicodedata
 from typing import Dict, List, Any, Optional
 
+OLLAMA_MODEL = "qwen2.5:1.5b"
+OLLAMA_OPTIONS = {
+    "temperature": 0.1,
+    "num_predict": 250  # Tăng lên 250 để trả lời chi tiết hơn
+}
+# Giữ model trong RAM của ollama giữa các câu hỏi (load lại model mất vài giây trên CPU)
+OLLAMA_KEEP_ALIVE = "30m"
+# Các stage tính vào thời gian search (xem metrics.stage)
+SEARCH_STAGES = ("query_embedding", "faiss_search", "hybrid_rescoring", "docstore_fetch")
+# Chỉ cache câu trả lời của tool phụ thuộc vào tài liệu (sensor/thiết bị thay đổi theo thời gian)
+ANSWER_CACHE_TOOLS = {"rag_search"}
+
 class MCPDispatcher:
     def __init__(self):
         self.tools = {
             "rag_search": {
                 "keywords": ["về", "là gì", "tài liệu", "thông tin", "quy định", "máy móc", "hướng dẫn", "ct", "đại học", "logo", "thương hiệu", "e-newsletter", "newsletter", "brand"],
                 "description": "Truy xuất kiến thức từ database nội bộ",
-                "handler": self._handle_rag_search
+                "examples": ["Trường Đại học Cần Thơ được thành lập năm nào?", "Quy định sử dụng logo của trường như thế nào?", "Cho tôi biết thông tin trong bản tin e-newsletter", "Hướng dẫn vận hành máy móc trong phòng thí nghiệm"],
+                "handler": self._handle_rag_search,
+                "speculative": True
             },
             "sensor_read": {
                 "keywords": ["đọc sensor", "đọc dữ liệu", "sensor", "nhiệt độ", "độ ẩm", "ánh sáng", "đọc", "nhiệt", "ẩm", "sáng"],
                 "description": "Đọc dữ liệu từ các cảm biến",
-                "handler": self._handle_sensor_read
+                "examples": ["Nhiệt độ phòng bây giờ là bao nhiêu?", "Trong phòng có nóng không?", "Độ ẩm không khí hiện tại", "Ngoài cửa sổ trời sáng hay tối?"],
+                "handler": self._handle_sensor_read,
+                "speculative": True
             },
             "device_control": {
                 "keywords": ["bật", "tắt", "điều khiển", "mở", "đóng", "thiết bị", "quạt", "đèn", "relay"],
                 "description": "Điều khiển các thiết bị",
-                "handler": self._handle_device_control
+                "examples": ["Bật đèn phòng khách lên", "Tắt quạt giúp tôi", "Mở máy bơm tưới cây", "Cho quạt chạy đi"],
+                "handler": self._handle_device_control,
+                "speculative": False  # Có tác dụng phụ (bật/tắt thiết bị), không chạy trước
             },
             "general_chat": {
                 "keywords": ["chào", "hi", "hello", "tạm biệt", "cảm ơn", "bạn là ai", "bạn tên", "ai"],
                 "description": "Tán gẫu hoặc chào hỏi",
-                "handler": self._handle_general_chat
+                "examples": ["Xin chào", "Bạn là ai vậy?", "Cảm ơn bạn nhiều", "Hẹn gặp lại nhé"],
+                "handler": self._handle_general_chat,
+                "speculative": True
             }
         }
         
+        self._compile_routes()
+        # Routing ngữ nghĩa (tuỳ chọn), bật bằng enable_semantic_routing()
+        self.semantic_router = None
+        # prepare_pipelined: chạy luôn tool hạng 2 khi score keyword 2 tool đầu chênh <= margin
+        self.speculation_margin = 1.0
+        # Tạo sẵn (thread chỉ được tạo khi có task): prepare_pipelined được gọi từ nhiều
+        # thread của engine, tạo lười không khoá sẽ sinh nhiều executor bị bỏ rơi
+        self._speculation_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rag-speculative")
+
+        # BM25 index cho leg từ khoá của hybrid search (None = chỉ dùng vector);
+        # snapshot của ReloadableIndex mang BM25 riêng, khớp với đúng phiên bản index
+        self.keyword_index = None
+        self.hybrid_fetch_k = 20
+        # Search trên nhiều collection (tuỳ chọn), bật bằng enable_sharding()
+        self.shards = None
+        self.search_filter = None
+        self.shard_k = 3
+        # Chọn câu liên quan nhất từ các chunk trong giới hạn token (xem context.py)
+        self.context_builder = ContextBuilder(get_query_embeddings())
+
         # MCP server registry cho mở rộng
         self.mcp_servers = {}
+        # Kết nối lâu dài tới các MCP server (xem mcp_transport.py)
+        self.mcp_pool = MCPClientPool()
+        # Tool của dispatcher -> hàm (query) -> [(MCP server, tool MCP, arguments)]
+        self.mcp_routes = {}
         self.register_builtin_servers()
 
     def register_builtin_servers(self):
         """Đăng ký các MCP server builtin"""
-        # Placeholder cho các MCP server tương lai
-        pass
+        # Cách gọi các server trong mcp_server_example.py; chỉ có tác dụng khi
+        # server tương ứng đã được register_mcp_server() với endpoint
+        self.mcp_routes["sensor_read"] = self._sensor_mcp_calls
+        self.mcp_routes["device_control"] = self._device_mcp_calls
     
     def register_mcp_server(self, name: str, server_config: Dict[str, Any]):
-        """Đăng ký MCP server mới"""
+        """Đăng ký MCP server mới, vd. {"endpoint": "tcp://127.0.0.1:9101", "pool_size": 1, "timeout": 2.0}"""
         self.mcp_servers[name] = server_config
-        print(f"✅ Đã đăng ký MCP server: {name}")
+        self.mcp_pool.add_server(name, server_config["endpoint"],
+                                 size=server_config.get("pool_size"), timeout=server_config.get("timeout"))
+        print(f"✅ Đã đăng ký MCP server: {name} ({server_config['endpoint']})")
+
+    @staticmethod
+    def _sensor_mcp_calls(query: str) -> List[tuple]:
+        query_lower = query.lower()
+        if "trung bình" in query_lower or "thống kê" in query_lower:
+            return [("sensor_server", "read_stats", {"minutes": 5})]
+        tools = [
+            tool for keyword, tool in [("nhiệt", "read_temperature"), ("ẩm", "read_humidity"), ("sáng", "read_light")]
+            if keyword in query_lower
+        ]
+        return [("sensor_server", tool, {}) for tool in tools or ["read_all_sensors"]]
+
+    @staticmethod
+    def _device_mcp_calls(query: str) -> List[tuple]:
+        query_lower = query.lower()
+        devices = list(dict.fromkeys(
+            device for keyword, device in [("đèn", "led"), ("led", "led"), ("quạt", "fan"), ("bơm", "pump")]
+            if keyword in query_lower
+        ))
+        if "tắt" in query_lower:
+            action = "turn_off"
+        elif "bật" in query_lower or "mở" in query_lower:
+            action = "turn_on"
+        else:
+            action = None
+        if not devices or action is None:
+            return [("device_server", "get_status", {})]
+        # Nhiều thiết bị trong 1 request, server ghi GPIO 1 lần
+        return [("device_server", action, {"devices": devices})]
     
     def route_to_mcp_server(self, tool_name: str, query: str) -> Optional[str]:
-        """Route request đến MCP server tương ứng"""
-        if tool_name in self.mcp_servers:
-            # Gọi MCP server (mock implementation)
-            return f"[MCP Response from {tool_name}] Đã xử lý: {query}"
-        return None
+        """Gọi các MCP server liên quan tới tool (song song), None nếu không có server nào"""
+        route = self.mcp_routes.get(tool_name)
+        calls = [call for call in route(query) if call[0] in self.mcp_servers] if route else []
+        if not calls:
+            return None
+
+        lines = []
+        for (server, tool, _), result in zip(calls, self.mcp_pool.call_many_sync(calls)):
+            if isinstance(result, BaseException):
+                lines.append(f"[{server}.{tool}] lỗi: {result or type(result).__name__}")
+            elif result.get("success"):
+                lines.append(str(result["result"]))
+            else:
+                lines.append(f"[{server}.{tool}] lỗi: {result.get('error')}")
+        return "\n".join(lines)
     
     def _handle_rag_search(self, query: str, retriever) -> str:
         """Handler cho RAG search với hybrid search (vector + keyword)"""
-        if not retriever:
+        if not retriever and self.shards is None:
             return "Xin lỗi, database tìm kiếm chưa được tải. Vui lòng kiểm tra lại file FAISS index."
         
         try:
-            query_lower = query.lower()
-            relevant_docs = []
-            
-            # First try vector search
-            docs = retriever.invoke(query)
-            
-            for d in docs:
-                content = d.page_content.strip().lower()
-                relevance_score = 0
-                
-                # Exact phrase matching
-                if query_lower in content:
-                    relevance_score += 10
-                
-                # Word matching
-                query_words = query_lower.split()
-                for word in query_words:
-                    if len(word) > 2 and word in content:
-                        relevance_score += 2
-                
-                if relevance_score >= 2:
-                    relevant_docs.append((d, relevance_score))
-            
-            # If no good results, do keyword search across more documents
-            if not relevant_docs:
-                # Get more documents and filter by keywords
-                all_docs = retriever.vectorstore.similarity_search('đại học', k=50)
-                
-                for d in all_docs:
-                    content = d.page_content.strip().lower()
-                    relevance_score = 0
-                    
-                    # More lenient keyword matching
-                    query_words = query_lower.split()
-                    for word in query_words:
-                        if len(word) > 2 and word in content:
-                            relevance_score += 1
-                    
-                    if relevance_score >= 1:
-                        relevant_docs.append((d, relevance_score))
-            
-            # Sort by relevance score
-            relevant_docs.sort(key=lambda x: x[1], reverse=True)
+            if self.shards is not None:
+                relevant_docs = self.sharded_search(query)
+            else:
+                relevant_docs = self.hybrid_search(query, retriever)
             
-            if relevant_docs:
-                context_parts = []
-                for doc, score in relevant_docs[:3]:
-                    content = doc.page_content.strip()
-                    if len(content) > 50:
-                        context_parts.append(content[:500])
-                
-                context_text = "\n\n".join(context_parts)
-                
+            context_text = self.context_builder.build(query, relevant_docs) if relevant_docs else ""
+            if context_text:
                 return f"Dựa trên thông tin trong database, đây là câu trả lời cho câu hỏi '{query}':\n\n{context_text}"
             else:
                 return f"Xin lỗi, tôi không tìm thấy thông tin liên quan đến '{query}' trong database. Database hiện có thông tin về Đại học Cần Thơ, thương hiệu, logo, và các tài liệu liên quan. Bạn có thể thử hỏi về các chủ đề này."
                 
         except Exception as e:
             return f"Xin lỗi, có lỗi xảy ra khi tìm kiếm thông tin: {str(e)}"
+
+    def hybrid_search(self, query: str, retriever) -> List[Any]:
+        """Hybrid search: FAISS + BM25, gộp bằng reciprocal-rank fusion"""
+        vectorstore = retriever.vectorstore
+        k = retriever.search_kwargs.get("k", 3)
+        keyword_index = getattr(retriever, "keyword_index", self.keyword_index)
+
+        vector_ranking = [chunk_id for chunk_id, _ in vector_search_ids(vectorstore, query, self.hybrid_fetch_k)]
+        with metrics.stage("hybrid_rescoring"):
+            keyword_ranking = []
+            if keyword_index is not None:
+                keyword_ranking = [chunk_id for chunk_id, _ in keyword_index.search(query, self.hybrid_fetch_k)]
+
+            fused = reciprocal_rank_fusion(vector_ranking, keyword_ranking)
+        chunk_ids = [chunk_id for chunk_id, _ in fused[:k]]
+        # Ghi lại ngữ cảnh đã dùng vào trace (trace log + key của answer cache)
+        trace = metrics.current_trace()
+        if trace is not None:
+            trace.attrs["chunk_ids"] = chunk_ids
+        return get_documents(vectorstore, chunk_ids)
+
+    def enable_sharding(self, collections=None, search_filter=None, k: int = 3):
+        """Search trên các collection (mặc định: mọi collection đã build), lọc theo metadata"""
+        self.shards = ShardedIndex(collections)
+        self.search_filter = search_filter or None
+        self.shard_k = k
+        print(f"✅ Search trên {len(self.shards.collections)} collection: {', '.join(self.shards.collections)}")
+
+    def watch_indexes(self, index=None, interval: float = 2.0):
+        """Reload nền index chính và các collection khi ingest ghi VERSION mới"""
+        if index is not None:
+            index.watch(interval)
+        if self.shards is not None:
+            self.shards.watch(interval)
+
+    def sharded_search(self, query: str) -> List[Any]:
+        """Hybrid search (vector + BM25) song song trên các collection, gộp bằng RRF"""
+        results = self.shards.search(query, self.shard_k, filter=self.search_filter)
+        trace = metrics.current_trace()
+        if trace is not None:
+            trace.attrs["chunk_ids"] = [f"{doc.metadata['collection']}/{doc.id}" for doc, _ in results]
+        return [doc for doc, _ in results]
+
+    def hybrid_search_batch(self, queries: List[str], retriever) -> List[List[tuple[Any, float]]]:
+        """Hybrid search cho nhiều câu hỏi (đánh giá offline, trả lời FAQ hàng loạt).
+
+        Embed + FAISS chạy 1 lần cho cả batch, docstore đọc 1 lần cho mọi chunk;
+        trả về mỗi câu 1 list [(Document, điểm RRF)] đã xếp hạng.
+        """
+        vectorstore = retriever.vectorstore
+        k = retriever.search_kwargs.get("k", 3)
+        keyword_index = getattr(retriever, "keyword_index", self.keyword_index)
+
+        vector_rankings = vector_search_ids_batch(vectorstore, queries, self.hybrid_fetch_k)
+        fused_rankings = []
+        with metrics.stage("hybrid_rescoring"):
+            for query, vector_ranking in zip(queries, vector_rankings):
+                keyword_ranking = []
+                if keyword_index is not None:
+                    keyword_ranking = [chunk_id for chunk_id, _ in keyword_index.search(query, self.hybrid_fetch_k)]
+                fused = reciprocal_rank_fusion([chunk_id for chunk_id, _ in vector_ranking], keyword_ranking)
+                fused_rankings.append(fused[:k])
+
+        ids = list(dict.fromkeys(chunk_id for fused in fused_rankings for chunk_id, _ in fused))
+        documents = get_documents_by_id(vectorstore, ids)
+        return [
+            [(documents[chunk_id], score) for chunk_id, score in fused if chunk_id in documents]
+            for fused in fused_rankings
+        ]
     
     def _handle_general_chat(self, query: str) -> str:
         """Handler cho general chat"""
@@ -160,38 +283,228 @@ class MCPDispatcher:
         # Mock response cho device control
         return f"Điều khiển thiết bị: {query}. Đã thực hiện thành công."
     
-    def smart_route(self, query: str) -> tuple[str, str]:
+    def _compile_routes(self):
+        """Biên dịch bảng routing thành 1 regex + ma trận keyword x tool.
+
+        Gọi lại hàm này nếu sửa keywords trong self.tools sau khi khởi tạo.
+        """
+        self._tool_names = list(self.tools)
+        self._rag_column = self._tool_names.index("rag_search")
+        keywords = sorted(
+            {unicodedata.normalize("NFC", kw.lower()) for config in self.tools.values() for kw in config["keywords"]},
+            key=len, reverse=True
+        )
+        keyword_ids = {kw: i for i, kw in enumerate(keywords)}
+
+        self._route_matrix = np.zeros((len(keywords), len(self._tool_names)), dtype=np.float32)
+        for column, tool_name in enumerate(self._tool_names):
+            for kw in self.tools[tool_name]["keywords"]:
+                self._route_matrix[keyword_ids[unicodedata.normalize("NFC", kw.lower())], column] += 1
+
+        # Có word boundary nên "ai" không khớp bên trong "tài liệu"; keyword dài đứng
+        # trước trong regex nên "nhiệt độ" thắng "nhiệt"
+        self._route_regex = re.compile(r"(?<!\w)(?:" + "|".join(map(re.escape, keywords)) + r")(?!\w)")
+
+        # Regex chỉ trả về keyword dài nhất tại mỗi vị trí, nên gộp sẵn các keyword
+        # con (vd. "nhiệt độ" -> "nhiệt", "đọc sensor" -> "đọc", "sensor")
+        patterns = {kw: re.compile(r"(?<!\w)" + re.escape(kw) + r"(?!\w)") for kw in keywords}
+        self._keyword_closure = {
+            kw: [keyword_ids[sub] for sub in keywords if patterns[sub].search(kw)]
+            for kw in keywords
+        }
+
+    _WORD_START = re.compile(r"(?<!\w)\w")
+
+    def _keyword_indicator(self, query: str, out=None):
+        """Vector 0/1 đánh dấu các keyword có trong query.
+
+        Thử khớp tại mọi đầu từ (không chỉ sau match trước), nên các keyword
+        chồng lên nhau như "đọc dữ liệu" / "dữ liệu" đều được tính.
+        """
+        if out is None:
+            out = np.zeros(len(self._route_matrix), dtype=np.float32)
+        for word in self._WORD_START.finditer(query):
+            match = self._route_regex.match(query, word.start())
+            if match:
+                out[self._keyword_closure[match.group()]] = 1
+        return out
+
+    @staticmethod
+    def _normalize_for_routing(query: str) -> str:
+        return unicodedata.normalize("NFC", query).lower()
+
+    def route_scores(self, query: str) -> np.ndarray:
+        """Score của từng tool (theo thứ tự self.tools) cho 1 query"""
+        query_lower = self._normalize_for_routing(query)
+        scores = self._keyword_indicator(query_lower) @ self._route_matrix
+        # Bonus cho câu hỏi dài (RAG)
+        if len(query_lower.split()) > 6:
+            scores[self._rag_column] += 2
+        return scores
+
+    def _pick_tool(self, scores: np.ndarray) -> tuple[str, float]:
+        # Chọn tool có score cao nhất (hoà thì lấy tool khai báo trước)
+        best = int(np.argmax(scores))
+        best_score = float(scores[best])
+        confidence = 1.0 if best_score > 0 else 0
+        return self._tool_names[best], confidence
+
+    def smart_route(self, query: str) -> tuple[str, float]:
         """Smart routing với confidence scoring"""
-        query_lower = query.lower()
-        scores = {}
-        
-        for tool_name, config in self.tools.items():
-            score = 0
-            for keyword in config["keywords"]:
-                if keyword in query_lower:
-                    score += 1
-            
-            # Bonus cho câu hỏi dài (RAG)
-            if tool_name == "rag_search" and len(query_lower.split()) > 6:
-                score += 2
-                
-            scores[tool_name] = score
-        
-        # Chọn tool có score cao nhất
-        best_tool = max(scores, key=scores.get)
-        confidence = scores[best_tool] / max(scores.values()) if max(scores.values()) > 0 else 0
-        
-        return best_tool, confidence
+        with metrics.stage("routing"):
+            return self._smart_route(query)
+
+    def _smart_route(self, query: str) -> tuple[str, float]:
+        if self.semantic_router is not None:
+            tool_name, similarity = self.semantic_router.route(query)
+            if similarity >= self.semantic_router.threshold:
+                return tool_name, similarity
+            # Không đủ chắc chắn -> fallback sang keyword
+        return self._pick_tool(self.route_scores(query))
+
+    def enable_semantic_routing(self, embeddings=None, threshold: float = 0.45):
+        """Bật routing theo embedding (dùng chung model MiniLM + cache query của database)"""
+        self.semantic_router = SemanticRouter(self.tools, embeddings or get_query_embeddings(), threshold)
+
+    def smart_route_batch(self, queries: List[str]) -> List[tuple[str, float]]:
+        """Route nhiều query cùng lúc: 1 phép nhân ma trận (query x keyword) @ (keyword x tool)"""
+        normalized = [self._normalize_for_routing(q) for q in queries]
+        indicators = np.zeros((len(queries), len(self._route_matrix)), dtype=np.float32)
+        for row, query_lower in enumerate(normalized):
+            self._keyword_indicator(query_lower, out=indicators[row])
+
+        scores = indicators @ self._route_matrix
+        long_queries = np.array([len(q.split()) > 6 for q in normalized], dtype=bool)
+        scores[long_queries, self._rag_column] += 2
+        return [self._pick_tool(row) for row in scores]
+
+    def prepare(self, query: str, retriever) -> tuple[str, float, str]:
+        """Route + chạy handler + gọi MCP server -> (tool, confidence, prompt cho LLM)"""
+        selected_tool, confidence = self.smart_route(query)
+        metrics.REQUESTS.inc(tool=selected_tool)
+        return selected_tool, confidence, self.run_tool(selected_tool, query, retriever)
+
+    def run_tool(self, tool_name: str, query: str, retriever) -> str:
+        """Chạy handler + MCP server của 1 tool -> prompt cho LLM"""
+        if tool_name not in self.tools:
+            return query
+
+        # Xử lý với handler tương ứng
+        handler = self.tools[tool_name]["handler"]
+        if tool_name == "rag_search":
+            prompt = handler(query, retriever)
+        else:
+            prompt = handler(query)
+
+        # Thử route đến MCP server nếu có
+        with metrics.stage("mcp_routing"):
+            mcp_response = self.route_to_mcp_server(tool_name, query)
+        if mcp_response:
+            prompt = f"{prompt}\n\nAdditional MCP Response: {mcp_response}"
+        return prompt
+
+    def _run_branch(self, tool_name: str, query: str, retriever):
+        """1 nhánh speculative: stage/attrs ghi vào trace riêng, chỉ gộp vào request nếu thắng"""
+        with metrics.collect_trace() as branch_trace:
+            prompt = self.run_tool(tool_name, query, retriever)
+        return prompt, branch_trace
+
+    def prepare_pipelined(self, query: str, retriever) -> tuple[str, float, str]:
+        """Như prepare, nhưng chạy handler song song với routing.
+
+        Route keyword (vài µs) đoán trước tool và chạy handler của nó ngay, trong
+        lúc smart_route embed câu hỏi cho routing semantic. Khi 2 tool đầu theo
+        keyword chênh nhau <= speculation_margin thì chạy luôn tool hạng 2. Route
+        xong thì dùng nhánh thắng, huỷ (hoặc bỏ kết quả) nhánh thua. Chỉ chạy
+        trước các tool "speculative" (không có tác dụng phụ).
+        """
+        if self.semantic_router is None:
+            # Route keyword chính là quyết định cuối, không có gì để chạy trước
+            return self.prepare(query, retriever)
+
+        scores = self.route_scores(query)
+        order = np.argsort(-scores, kind="stable")
+        guesses = [self._tool_names[order[0]]]
+        if scores[order[0]] - scores[order[1]] <= self.speculation_margin:
+            guesses.append(self._tool_names[order[1]])
+
+        branches = {
+            tool: self._speculation_pool.submit(self._run_branch, tool, query, retriever)
+            for tool in guesses if self.tools[tool].get("speculative")
+        }
+
+        selected_tool, confidence = self.smart_route(query)
+        metrics.REQUESTS.inc(tool=selected_tool)
+        winner = branches.pop(selected_tool, None)
+        for future in branches.values():
+            metrics.SPECULATION.inc(result="cancelled" if future.cancel() else "wasted")
+
+        # Nhánh thắng chưa kịp chạy (pool đang bận) thì chạy luôn ở thread này
+        if winner is None or winner.cancel():
+            metrics.SPECULATION.inc(result="miss")
+            return selected_tool, confidence, self.run_tool(selected_tool, query, retriever)
+        metrics.SPECULATION.inc(result="hit")
+        with metrics.stage("speculation_wait"):
+            prompt, branch_trace = winner.result()
+        trace = metrics.current_trace()
+        if trace is not None:
+            trace.merge(branch_trace)
+        else:
+            metrics.observe_spans(branch_trace.spans)
+        return selected_tool, confidence, prompt
 
 # --- KHỞI TẠO HỆ THỐNG ---
 print("Khởi tạo hệ thống MCP...")
+t_init = time.perf_counter()
 dispatcher = MCPDispatcher()
 
-try:
-    vectorstore = load_db()
-    retriever = vectorstore.as_retriever(search_kwargs={"k": 3, "fetch_k": 8})  # Tăng lại k lên 3
-except:
-    retriever = None
+# Index mmap + docstore/model load lười, nên khởi động gần như tức thì.
+# Chạy lại ingest.py thì index được reload nền (index.watch), không cần khởi động lại;
+# chưa có faiss_index thì index.current là None cho tới lần ingest đầu tiên.
+# Không giữ snapshot trong biến global (sẽ giữ index cũ sau khi reload); mỗi request lấy index.current
+index = ReloadableIndex(search_kwargs={"k": 3, "fetch_k": 8})  # Tăng lại k lên 3
+if index.current is not None:
+    dispatcher.keyword_index = index.current.keyword_index
+index.on_reload(lambda snapshot: setattr(dispatcher, "keyword_index", snapshot.keyword_index))
+answer_cache = AnswerCache(get_query_embeddings())
+
+def clear_answer_cache(snapshot):
+    """Câu trả lời cache dựa trên chunk của index cũ -> xoá ngay khi thay index"""
+    if answer_cache is not None:
+        answer_cache.clear()
+
+index.on_reload(clear_answer_cache)
+
+class ModelWarmer:
+    """Load model vào RAM của ollama (generate rỗng + keep_alive) trong thread nền,
+    để model load song song với routing/retrieval thay vì sau đó"""
+
+    def __init__(self, model: str, keep_alive=OLLAMA_KEEP_ALIVE, interval: float = 60.0):
+        self.model = model
+        self.keep_alive = keep_alive
+        self.interval = interval
+        self._next_warm = 0.0
+        self._lock = threading.Lock()
+
+    def warm_async(self):
+        """Không chặn; bỏ qua nếu vừa warm trong `interval` giây"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._next_warm:
+                return
+            self._next_warm = now + self.interval
+        threading.Thread(target=self._warm, daemon=True).start()
+
+    def _warm(self):
+        try:
+            with metrics.stage("llm_warmup"):
+                ollama.generate(model=self.model, prompt="", keep_alive=self.keep_alive)
+        except Exception as e:
+            self._next_warm = 0.0
+            print(f"\n⚠️ Không load trước được model {self.model}: {e}")
+
+model_warmer = ModelWarmer(OLLAMA_MODEL)
+print(f"✅ Khởi động xong sau {time.perf_counter() - t_init:.3f}s")
 
 def ask_bot():
     while True:
@@ -199,51 +512,99 @@ def ask_bot():
         if not user_query: continue
         if user_query.lower() in ['exit', 'quit']: break
 
-        t_start = time.perf_counter()
+        with metrics.start_trace(query=user_query) as trace:
+            t_start = time.perf_counter()
+            model_warmer.warm_async()
 
-        
-        selected_tool, confidence = dispatcher.smart_route(user_query)
-        
-        # Xử lý với handler tương ứng
-        if selected_tool in dispatcher.tools:
-            handler = dispatcher.tools[selected_tool]["handler"]
-            
-            if selected_tool == "rag_search":
-                prompt = handler(user_query, retriever)
-                t_search = 0  # Sẽ được tính trong handler
-            else:
-                prompt = handler(user_query)
-                t_search = 0
-                
-            # Thử route đến MCP server nếu có
-            mcp_response = dispatcher.route_to_mcp_server(selected_tool, user_query)
-            if mcp_response:
-                prompt = f"{prompt}\n\nAdditional MCP Response: {mcp_response}"
-        else:
-            prompt = user_query
-            t_search = 0
+            # Lấy snapshot 1 lần: index có reload giữa chừng thì request này vẫn dùng bản cũ
+            selected_tool, confidence, prompt = dispatcher.prepare_pipelined(user_query, index.current)
+            trace.attrs["tool"] = selected_tool
 
-        t_prep = time.perf_counter() - t_start
+            t_prep = time.perf_counter() - t_start
+            t_search = trace.total(*SEARCH_STAGES)
 
-        print(f"Bot ({selected_tool} | conf: {confidence:.2f} | prep: {t_prep:.3f}s): ", end="", flush=True)
+            print(f"Bot ({selected_tool} | conf: {confidence:.2f} | prep: {t_prep:.3f}s | search: {t_search:.3f}s): ", end="", flush=True)
 
-        try:
-            stream = ollama.chat(
-                model="qwen2.5:1.5b",
-                messages=[{"role": "user", "content": prompt}],
-                stream=True,
-                options={
-                    "temperature": 0.1,
-                    "num_predict": 250  # Tăng lên 250 để trả lời chi tiết hơn
-                }
-            )
-
-            for chunk in stream:
-                print(chunk['message']['content'], end="", flush=True)
-            print()
+            chunk_ids = trace.attrs.get("chunk_ids")
+            cacheable = answer_cache is not None and selected_tool in ANSWER_CACHE_TOOLS
+            cached = answer_cache.lookup(user_query, chunk_ids) if cacheable else None
 
-        except Exception as e:
-            print(f"\nLỗi: {e}")
+            try:
+                if cached is not None:
+                    trace.attrs["answer_cache"] = "hit"
+                    for chunk in replay(cached):
+                        print(chunk['message']['content'], end="", flush=True)
+                    print()
+                    continue
+
+                t_llm = time.perf_counter()
+                stream = ollama.chat(
+                    model=OLLAMA_MODEL,
+                    messages=[{"role": "user", "content": prompt}],
+                    stream=True,
+                    options=OLLAMA_OPTIONS,
+                    keep_alive=OLLAMA_KEEP_ALIVE
+                )
+
+                first_token = True
+                tokens = []
+                for chunk in stream:
+                    if first_token:
+                        metrics.record("llm_ttft", time.perf_counter() - t_llm)
+                        first_token = False
+                    tokens.append(chunk['message']['content'])
+                    print(tokens[-1], end="", flush=True)
+                print()
+                metrics.record("llm_generation", time.perf_counter() - t_llm)
+                if cacheable:
+                    answer_cache.put(user_query, chunk_ids, tokens)
+
+            except Exception as e:
+                print(f"\nLỗi: {e}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RAG-MCP chatbot")
+    parser.add_argument("--route", choices=["keyword", "semantic"], default="keyword",
+                        help="semantic: route theo embedding, fallback keyword khi độ tương đồng thấp")
+    parser.add_argument("--route-threshold", type=float, default=0.45)
+    parser.add_argument("--metrics-port", type=int, default=None, help="Mở /metrics (Prometheus) trên port này")
+    parser.add_argument("--trace-log", default=None, help="Ghi trace từng request (JSON lines) vào file")
+    parser.add_argument("--answer-cache-threshold", type=float, default=0.95,
+                        help="Cosine tối thiểu để dùng lại câu trả lời đã cache")
+    parser.add_argument("--answer-cache-ttl", type=float, default=3600, help="Thời gian sống của câu trả lời cache (giây)")
+    parser.add_argument("--no-answer-cache", action="store_true", help="Tắt cache câu trả lời")
+    parser.add_argument("--mcp", action="append", default=[], metavar="NAME=ENDPOINT",
+                        help="Kết nối MCP server, vd. sensor_server=tcp://127.0.0.1:9101 (lặp lại được)")
+    parser.add_argument("--collections", default=None,
+                        help="Search trên các collection này (cách nhau bằng dấu phẩy, 'all' = tất cả) thay vì faiss_index")
+    parser.add_argument("--filter", action="append", default=[], metavar="KEY=VALUE",
+                        help="Chỉ lấy chunk có metadata khớp, vd. source=a.pdf (dùng với --collections)")
+    parser.add_argument("--context-tokens", type=int, default=dispatcher.context_builder.max_tokens,
+                        help="Số token tối đa của ngữ cảnh tài liệu gửi cho LLM")
+    parser.add_argument("--reload-interval", type=float, default=2.0,
+                        help="Kiểm tra index mới (file VERSION) mỗi N giây, 0 = tắt reload")
+    args = parser.parse_args()
+    dispatcher.context_builder.max_tokens = args.context_tokens
+    if args.collections:
+        dispatcher.enable_sharding(None if args.collections == "all" else args.collections.split(","),
+                                   parse_filter(args.filter))
+    if args.reload_interval > 0:
+        if dispatcher.shards is not None:
+            dispatcher.shards.on_reload(clear_answer_cache)
+        dispatcher.watch_indexes(index, args.reload_interval)
+    for spec in args.mcp:
+        name, _, endpoint = spec.partition("=")
+        dispatcher.register_mcp_server(name, {"endpoint": endpoint})
+    if args.metrics_port:
+        metrics.serve_metrics(args.metrics_port)
+    metrics.configure_trace_log(args.trace_log)
+    if args.no_answer_cache:
+        answer_cache = None
+    else:
+        answer_cache.threshold = args.answer_cache_threshold
+        answer_cache.ttl = args.answer_cache_ttl
+    if args.route == "semantic":
+        dispatcher.enable_semantic_routing(threshold=args.route_threshold)
+    # Model load trong lúc người dùng gõ câu hỏi đầu tiên
+    model_warmer.warm_async()
     ask_bot()
\ No newline at end of file
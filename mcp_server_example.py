@@ -1,14 +1,23 @@
 """
 Ví dụ về MCP Server cho Sensor Reading và Device Control
 Đây là template để bạn phát triển MCP server thực tế
+
+Chạy như process riêng (xem mcp_transport.py):
+    python mcp_server_example.py --serve sensor --endpoint tcp://127.0.0.1:9101
+    python mcp_server_example.py --serve device --endpoint http://127.0.0.1:9102
+    python mcp_server_example.py --serve sensor            (stdio, client tự chạy process)
 """
 
+import argparse
 import asyncio
 import json
-from typing import Dict, Any, Optional
+import sys
+from typing import Dict, Any, List, Optional, Tuple
 import random
 import time
 
+from sensor_buffer import SensorRingBuffer
+
 class MCPServer:
     """Base class cho MCP Server"""
     
@@ -30,94 +39,260 @@ class MCPServer:
             return {"success": False, "error": str(e)}
 
 class SensorMCPServer(MCPServer):
-    """MCP Server cho Sensor Reading"""
+    """MCP Server cho Sensor Reading
+
+    Sensor được đọc bởi 1 sampler chạy nền (mỗi sample_interval giây) vào ring
+    buffer; các tool đọc trả về mẫu mới nhất nếu chưa cũ quá max_staleness giây,
+    nên nhiều người hỏi cùng lúc không tốn thêm lần đọc phần cứng nào. Khi mẫu
+    đã cũ, các request đang chờ dùng chung 1 lần đọc.
+    """
     
-    def __init__(self):
+    FIELDS = ("temperature", "humidity", "light")
+
+    def __init__(self, sample_interval: float = 2.0, history_seconds: float = 3600,
+                 max_staleness: float = 5.0, hardware_delay: float = 0.1):
         super().__init__("sensor_server", "Server for reading sensor data")
+        self.sample_interval = sample_interval
+        self.max_staleness = max_staleness
+        self.hardware_delay = hardware_delay
+        self.buffer = SensorRingBuffer(self.FIELDS, int(history_seconds / sample_interval) + 1)
+        self.hardware_reads = 0
+        self._inflight: Optional[asyncio.Future] = None
+        self._sampler: Optional[asyncio.Task] = None
         self.tools = {
             "read_temperature": self._read_temperature,
             "read_humidity": self._read_humidity,
             "read_light": self._read_light,
-            "read_all_sensors": self._read_all_sensors
+            "read_all_sensors": self._read_all_sensors,
+            "read_stats": self._read_stats,
         }
+
+    async def handle_request(self, tool_name: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        # Sampler chạy trên event loop của server, khởi động ở request đầu tiên
+        if self._sampler is None or self._sampler.done():
+            self._sampler = asyncio.create_task(self._sample_loop())
+        return await super().handle_request(tool_name, params)
+
+    async def _read_hardware(self) -> Dict[str, float]:
+        """1 lần đọc phần cứng cho tất cả sensor (mock DHT22 + photoresistor)"""
+        self.hardware_reads += 1
+        await asyncio.sleep(self.hardware_delay)
+        return {
+            "temperature": round(random.uniform(20, 35), 1),
+            "humidity": round(random.uniform(40, 80), 1),
+            "light": random.randint(100, 1000),
+        }
+
+    async def _sample(self):
+        """Đọc sensor và ghi vào buffer; các lời gọi trùng lúc dùng chung 1 lần đọc"""
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._read_and_store())
+        # shield: 1 request bị huỷ không làm huỷ lần đọc mà các request khác đang chờ
+        await asyncio.shield(self._inflight)
+
+    async def _read_and_store(self):
+        try:
+            self.buffer.append(await self._read_hardware())
+        finally:
+            self._inflight = None
+
+    async def _sample_loop(self):
+        while True:
+            try:
+                await self._sample()
+            except Exception as e:
+                print(f"⚠️ Lỗi đọc sensor: {e}", file=sys.stderr)
+            await asyncio.sleep(self.sample_interval)
+
+    async def _latest(self, params: Dict[str, Any]) -> Dict[str, float]:
+        max_staleness = float(params.get("max_staleness", self.max_staleness))
+        latest = self.buffer.latest()
+        if latest is None or time.time() - latest[0] > max_staleness:
+            await self._sample()
+            latest = self.buffer.latest()
+        return latest[1]
     
     async def _read_temperature(self, params: Dict[str, Any]) -> str:
-        """Đọc nhiệt độ (mock)"""
-        # Mock: Giả lập đọc sensor DHT22
-        temp = round(random.uniform(20, 35), 1)
-        return f"Nhiệt độ hiện tại: {temp}°C"
+        """Đọc nhiệt độ"""
+        values = await self._latest(params)
+        return f"Nhiệt độ hiện tại: {values['temperature']:.1f}°C"
     
     async def _read_humidity(self, params: Dict[str, Any]) -> str:
-        """Đọc độ ẩm (mock)"""
-        # Mock: Giả lập đọc sensor DHT22
-        humidity = round(random.uniform(40, 80), 1)
-        return f"Độ ẩm hiện tại: {humidity}%"
+        """Đọc độ ẩm"""
+        values = await self._latest(params)
+        return f"Độ ẩm hiện tại: {values['humidity']:.1f}%"
     
     async def _read_light(self, params: Dict[str, Any]) -> str:
-        """Đọc ánh sáng (mock)"""
-        # Mock: Giả lập đọc photoresistor
-        light = random.randint(100, 1000)
-        return f"Cường độ ánh sáng: {light} lux"
+        """Đọc ánh sáng"""
+        values = await self._latest(params)
+        return f"Cường độ ánh sáng: {values['light']:.0f} lux"
     
     async def _read_all_sensors(self, params: Dict[str, Any]) -> str:
-        """Đọc tất cả sensors"""
-        temp = round(random.uniform(20, 35), 1)
-        humidity = round(random.uniform(40, 80), 1)
-        light = random.randint(100, 1000)
+        """Đọc tất cả sensors (cùng 1 mẫu)"""
+        values = await self._latest(params)
         
         return f"""Dữ liệu sensors:
-- Nhiệt độ: {temp}°C
-- Độ ẩm: {humidity}%
-- Ánh sáng: {light} lux
-- Thời gian: {time.strftime('%H:%M:%S')}"""
+- Nhiệt độ: {values['temperature']:.1f}°C
+- Độ ẩm: {values['humidity']:.1f}%
+- Ánh sáng: {values['light']:.0f} lux
+- Thời gian: {time.strftime('%H:%M:%S', time.localtime(self.buffer.latest()[0]))}"""
+
+    async def _read_stats(self, params: Dict[str, Any]) -> str:
+        """min/max/mean trong N phút gần nhất, params: {"minutes": 5, "sensor": "temperature"}"""
+        minutes = float(params.get("minutes", 5))
+        stats = self.buffer.aggregate(minutes * 60)
+        fields = [params["sensor"]] if params.get("sensor") else list(self.FIELDS)
+        lines = [f"Thống kê {minutes:g} phút gần nhất ({self.hardware_reads} lần đọc phần cứng):"]
+        for field in fields:
+            if field in stats:
+                s = stats[field]
+                lines.append(f"- {field}: min {s['min']:.1f}, max {s['max']:.1f}, tb {s['mean']:.1f} ({s['n']} mẫu)")
+            else:
+                lines.append(f"- {field}: chưa có dữ liệu")
+        return "\n".join(lines)
+
+class SimulatedGPIO:
+    """GPIO giả lập để test/benchmark không cần phần cứng.
+
+    Mỗi write_pins() là 1 lần ghi cả cổng (như ghi thanh ghi GPIO), đổi được
+    nhiều pin cùng lúc, với độ trễ cấu hình được.
+    """
+
+    def __init__(self, write_delay: float = 0.002):
+        self.write_delay = write_delay
+        self.pins: Dict[int, bool] = {}
+        self.writes = 0
+        self.pin_changes = 0
+
+    async def write_pins(self, states: Dict[int, bool]):
+        self.writes += 1
+        self.pin_changes += len(states)
+        await asyncio.sleep(self.write_delay)
+        self.pins.update(states)
 
 class DeviceMCPServer(MCPServer):
-    """MCP Server cho Device Control"""
+    """MCP Server cho Device Control
+
+    Lệnh được đưa vào hàng đợi và áp dụng theo tick: trong 1 tick, lệnh sau
+    cùng cho mỗi thiết bị thắng (last-write-wins), toàn bộ thay đổi được ghi
+    xuống GPIO bằng 1 lần write_pins. Hàng đợi và trạng thái được bảo vệ bởi
+    asyncio.Lock nên các lệnh toggle đồng thời không bị race.
+    """
     
-    def __init__(self):
+    def __init__(self, gpio: Optional[SimulatedGPIO] = None, tick: float = 0.01):
         super().__init__("device_server", "Server for controlling devices")
         self.devices = {
             "led": {"state": "off", "pin": 18},
             "fan": {"state": "off", "pin": 19},
             "pump": {"state": "off", "pin": 20}
         }
+        self.gpio = gpio or SimulatedGPIO()
+        self.tick = tick
+        self.commands = 0
+        self._lock = asyncio.Lock()
+        self._pending: Dict[str, str] = {}  # thiết bị -> trạng thái mong muốn trong tick hiện tại
+        self._batch_done: Optional[asyncio.Future] = None
+        self._flush_task: Optional[asyncio.Task] = None
         self.tools = {
             "turn_on": self._turn_on,
             "turn_off": self._turn_off,
             "toggle": self._toggle,
+            "set_states": self._set_states,
             "get_status": self._get_status
         }
+
+    async def _submit(self, commands: List[Tuple[str, str]]) -> Dict[str, str]:
+        """Đưa [(thiết bị, "on" | "off" | "toggle")] vào tick hiện tại, chờ tới khi đã ghi GPIO"""
+        async with self._lock:
+            for device, action in commands:
+                # toggle tính theo trạng thái sẽ có sau các lệnh trước đó trong cùng tick
+                current = self._pending.get(device, self.devices[device]["state"])
+                if action == "toggle":
+                    action = "off" if current == "on" else "on"
+                self._pending[device] = action
+            self.commands += len(commands)
+            if self._batch_done is None:
+                self._batch_done = asyncio.get_running_loop().create_future()
+                self._flush_task = asyncio.create_task(self._flush_after_tick(self._batch_done))
+            batch_done = self._batch_done
+        await asyncio.shield(batch_done)
+        return {device: self.devices[device]["state"] for device, _ in commands}
+
+    async def _flush_after_tick(self, batch_done: asyncio.Future):
+        written = False
+        error = None
+        try:
+            await asyncio.sleep(self.tick)
+            async with self._lock:
+                pending, self._pending = self._pending, {}
+                self._batch_done = None
+                changes = {
+                    self.devices[device]["pin"]: state == "on"
+                    for device, state in pending.items() if self.devices[device]["state"] != state
+                }
+                if changes:
+                    await self.gpio.write_pins(changes)
+                for device, state in pending.items():
+                    self.devices[device]["state"] = state
+                written = True
+        except Exception as e:
+            error = e
+        finally:
+            # Kể cả khi task bị huỷ (CancelledError không phải Exception): mọi _submit đang
+            # chờ batch_done phải nhận kết quả, và tick sau phải bắt đầu batch mới
+            if self._batch_done is batch_done:
+                self._batch_done, self._pending = None, {}
+            if not batch_done.done():
+                if written:
+                    batch_done.set_result(None)
+                else:
+                    batch_done.set_exception(error or RuntimeError("Tick ghi GPIO bị huỷ trước khi ghi xong"))
+
+    def _devices_from(self, params: Dict[str, Any]) -> List[str]:
+        """params {"device": "led"} hoặc {"devices": ["led", "fan"]}"""
+        devices = params.get("devices") or [params.get("device")]
+        unknown = [device for device in devices if device not in self.devices]
+        if unknown:
+            raise ValueError(f"Thiết bị {', '.join(map(str, unknown))} không tồn tại")
+        return list(dict.fromkeys(devices))
+
+    def _describe(self, states: Dict[str, str]) -> str:
+        return ", ".join(
+            f"{'bật' if state == 'on' else 'tắt'} {device} (PIN {self.devices[device]['pin']})"
+            for device, state in states.items()
+        )
+
+    async def _run(self, params: Dict[str, Any], action: str) -> str:
+        try:
+            devices = self._devices_from(params)
+        except ValueError as e:
+            return str(e)
+        states = await self._submit([(device, action) for device in devices])
+        return f"Đã {self._describe(states)}"
     
     async def _turn_on(self, params: Dict[str, Any]) -> str:
         """Bật thiết bị"""
-        device = params.get("device")
-        if device not in self.devices:
-            return f"Thiết bị {device} không tồn tại"
-        
-        self.devices[device]["state"] = "on"
-        return f"Đã bật {device} (PIN {self.devices[device]['pin']})"
+        return await self._run(params, "on")
     
     async def _turn_off(self, params: Dict[str, Any]) -> str:
         """Tắt thiết bị"""
-        device = params.get("device")
-        if device not in self.devices:
-            return f"Thiết bị {device} không tồn tại"
-        
-        self.devices[device]["state"] = "off"
-        return f"Đã tắt {device} (PIN {self.devices[device]['pin']})"
+        return await self._run(params, "off")
     
     async def _toggle(self, params: Dict[str, Any]) -> str:
         """Chuyển đổi trạng thái thiết bị"""
-        device = params.get("device")
-        if device not in self.devices:
-            return f"Thiết bị {device} không tồn tại"
-        
-        current_state = self.devices[device]["state"]
-        new_state = "on" if current_state == "off" else "off"
-        self.devices[device]["state"] = new_state
-        
-        action = "bật" if new_state == "on" else "tắt"
-        return f"Đã {action} {device} (PIN {self.devices[device]['pin']})"
+        return await self._run(params, "toggle")
+
+    async def _set_states(self, params: Dict[str, Any]) -> str:
+        """Đặt trạng thái nhiều thiết bị trong 1 request, params: {"states": {"led": "on", "fan": "off"}}"""
+        states = params.get("states") or {}
+        unknown = [device for device in states if device not in self.devices]
+        if unknown:
+            return f"Thiết bị {', '.join(unknown)} không tồn tại"
+        invalid = [state for state in states.values() if state not in ("on", "off", "toggle")]
+        if invalid:
+            return f"Trạng thái không hợp lệ: {', '.join(map(str, invalid))}"
+        result = await self._submit(list(states.items()))
+        return f"Đã {self._describe(result)}"
     
     async def _get_status(self, params: Dict[str, Any]) -> str:
         """Lấy trạng thái tất cả thiết bị"""
@@ -128,6 +303,11 @@ class DeviceMCPServer(MCPServer):
         
         return "Trạng thái thiết bị:\n" + "\n".join(status_list)
 
+SERVERS = {
+    "sensor": SensorMCPServer,
+    "device": DeviceMCPServer,
+}
+
 # Example usage
 async def main():
     # Tạo servers
@@ -162,5 +342,44 @@ async def main():
     led_off = await device_server.handle_request("turn_off", {"device": "led"})
     print(led_off)
 
+    print("\n=== Test qua transport (TCP, pipelining) ===")
+    from mcp_transport import open_connection, serve
+    server_task = asyncio.create_task(serve(sensor_server, "tcp://127.0.0.1:9101"))
+    await asyncio.sleep(0.1)
+    connection = await open_connection("tcp://127.0.0.1:9101")
+    print(await connection.request("tools/list"))
+    # Gửi liên tiếp nhiều request trên cùng 1 kết nối
+    results = await asyncio.gather(*(
+        connection.request("tools/call", {"name": tool, "arguments": {}})
+        for tool in ["read_temperature", "read_humidity", "read_light"]
+    ))
+    for result in results:
+        print(result)
+    await connection.close()
+    server_task.cancel()
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="MCP server ví dụ")
+    parser.add_argument("--serve", choices=sorted(SERVERS), default=None,
+                        help="Chạy server như process riêng (không có thì chạy demo)")
+    parser.add_argument("--endpoint", default="stdio:",
+                        help="stdio: | tcp://host:port | unix:///path.sock | http://host:port/")
+    parser.add_argument("--sample-interval", type=float, default=2.0, help="Chu kỳ đọc sensor (giây)")
+    parser.add_argument("--max-staleness", type=float, default=5.0,
+                        help="Mẫu cũ hơn số giây này thì đọc lại sensor khi có request")
+    args = parser.parse_args()
+
+    if args.serve is None:
+        asyncio.run(main())
+    else:
+        from mcp_transport import serve
+        if args.serve == "sensor":
+            server = SensorMCPServer(sample_interval=args.sample_interval, max_staleness=args.max_staleness)
+        else:
+            server = SERVERS[args.serve]()
+        # stdout dành cho JSON-RPC khi chạy qua stdio, log in ra stderr
+        print(f"✅ {server.name} đang chạy tại {args.endpoint}", file=sys.stderr)
+        try:
+            asyncio.run(serve(server, args.endpoint))
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,489 @@
+"""
+Transport JSON-RPC 2.0 cho MCPServer: stdio, socket (TCP/unix) và HTTP.
+
+Endpoint được viết dạng chuỗi:
+    stdio:python mcp_server_example.py --serve sensor     (client tự chạy process con)
+    tcp://127.0.0.1:9101
+    unix:///tmp/sensor.sock
+    http://127.0.0.1:9102/
+
+Method hỗ trợ: "ping", "tools/list", "tools/call" {"name": tool, "arguments": {...}}.
+Với stdio/socket mỗi message là 1 dòng JSON; server xử lý các request song song
+và trả về theo id nên client gửi nhiều request liên tiếp trên 1 kết nối
+(pipelining). HTTP dùng keep-alive, mỗi kết nối 1 request tại một thời điểm.
+
+Phía client, MCPClientPool giữ kết nối lâu dài tới từng server trên 1 event
+loop chạy ở thread nền, nên code đồng bộ (MCPDispatcher) gọi được mà không phải
+connect lại mỗi query.
+"""
+
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import shlex
+import sys
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+JSONRPC = "2.0"
+DEFAULT_TIMEOUT = 5.0
+# Độ dài tối đa 1 dòng JSON (mặc định của asyncio chỉ 64 KiB)
+STREAM_LIMIT = 16 * 1024 * 1024
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INTERNAL_ERROR = -32603
+
+class MCPError(Exception):
+    """Lỗi JSON-RPC do server trả về"""
+
+    def __init__(self, code: int, message: str):
+        super().__init__(f"{message} (code {code})")
+        self.code = code
+
+def _dump(message) -> bytes:
+    return json.dumps(message, ensure_ascii=False).encode("utf-8")
+
+def _error(request_id, code, message):
+    return {"jsonrpc": JSONRPC, "id": request_id, "error": {"code": code, "message": message}}
+
+def _unwrap(response):
+    if "error" in response:
+        error = response["error"]
+        raise MCPError(error.get("code", INTERNAL_ERROR), error.get("message", ""))
+    return response.get("result")
+
+def parse_endpoint(endpoint: str) -> Dict[str, Any]:
+    """Chuỗi endpoint -> {"transport": ..., ...}"""
+    if endpoint.startswith("stdio:"):
+        return {"transport": "stdio", "command": shlex.split(endpoint[len("stdio:"):])}
+    parts = urlsplit(endpoint)
+    if parts.scheme == "tcp":
+        return {"transport": "tcp", "host": parts.hostname, "port": parts.port}
+    if parts.scheme == "unix":
+        return {"transport": "unix", "path": parts.path}
+    if parts.scheme == "http":
+        return {"transport": "http", "host": parts.hostname, "port": parts.port or 80, "path": parts.path or "/"}
+    raise ValueError(f"Endpoint không hợp lệ: {endpoint}")
+
+# --- SERVER ---
+
+async def handle_message(server, message) -> Optional[Dict[str, Any]]:
+    """1 request JSON-RPC -> response (None nếu là notification)"""
+    if not isinstance(message, dict) or message.get("jsonrpc") != JSONRPC or "method" not in message:
+        request_id = message.get("id") if isinstance(message, dict) else None
+        return _error(request_id, INVALID_REQUEST, "Invalid Request")
+
+    request_id = message.get("id")
+    method = message["method"]
+    params = message.get("params") or {}
+    try:
+        if method == "ping":
+            result = {}
+        elif method == "tools/list":
+            result = {"server": server.name, "description": server.description, "tools": sorted(server.tools)}
+        elif method == "tools/call":
+            result = await server.handle_request(params.get("name"), params.get("arguments") or {})
+        else:
+            response = _error(request_id, METHOD_NOT_FOUND, f"Method not found: {method}")
+            return response if request_id is not None else None
+    except Exception as e:
+        response = _error(request_id, INTERNAL_ERROR, str(e))
+        return response if request_id is not None else None
+
+    if request_id is None:
+        return None
+    return {"jsonrpc": JSONRPC, "id": request_id, "result": result}
+
+async def handle_payload(server, payload: bytes) -> bytes:
+    """1 message (request đơn hoặc batch) -> response đã encode (b"" nếu không cần trả lời)"""
+    try:
+        message = json.loads(payload)
+    except ValueError:
+        return _dump(_error(None, PARSE_ERROR, "Parse error"))
+
+    if isinstance(message, list):
+        responses = await asyncio.gather(*(handle_message(server, item) for item in message))
+        responses = [response for response in responses if response is not None]
+        return _dump(responses) if responses else b""
+    response = await handle_message(server, message)
+    return _dump(response) if response is not None else b""
+
+async def serve_stream(server, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Phục vụ 1 kết nối JSON lines; request xử lý song song, response trả về khi xong"""
+    write_lock = asyncio.Lock()
+    tasks = set()
+
+    async def process(line):
+        data = await handle_payload(server, line)
+        if data:
+            async with write_lock:
+                writer.write(data + b"\n")
+                await writer.drain()
+
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            task = asyncio.create_task(process(line))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    except (ConnectionError, asyncio.CancelledError):
+        # CancelledError: server đang dừng
+        pass
+    finally:
+        writer.close()
+
+async def serve_stdio(server):
+    """Đọc request từ stdin, ghi response ra stdout (log phải in ra stderr)"""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=STREAM_LIMIT)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, sys.stdout)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    await serve_stream(server, reader, writer)
+
+async def _serve_http_connection(server, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """HTTP/1.1 tối giản: POST body là JSON-RPC, giữ kết nối (keep-alive)"""
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line.strip():
+                break
+            method, _, version = request_line.decode("latin-1").strip().split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            if method != "POST":
+                status, data = "405 Method Not Allowed", b""
+            else:
+                data = await handle_payload(server, body)
+                status = "200 OK" if data else "204 No Content"
+            keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(data)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                .encode("latin-1") + data
+            )
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError, asyncio.CancelledError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(server, endpoint: str):
+    """Chạy server trên endpoint cho tới khi bị dừng"""
+    config = parse_endpoint(endpoint)
+    transport = config["transport"]
+    if transport == "stdio":
+        await serve_stdio(server)
+        return
+
+    if transport == "http":
+        async def handler(reader, writer):
+            await _serve_http_connection(server, reader, writer)
+    else:
+        async def handler(reader, writer):
+            await serve_stream(server, reader, writer)
+
+    if transport == "unix":
+        listener = await asyncio.start_unix_server(handler, config["path"], limit=STREAM_LIMIT)
+    else:
+        listener = await asyncio.start_server(handler, config["host"], config["port"], limit=STREAM_LIMIT)
+    async with listener:
+        await listener.serve_forever()
+
+# --- CLIENT ---
+
+class StreamConnection:
+    """Kết nối JSON lines (stdio/TCP/unix) tới 1 server.
+
+    Nhiều request có thể cùng chờ trên 1 kết nối; response được ghép với
+    request theo id nên không cần chờ request trước xong mới gửi request sau.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, process=None):
+        self._reader = reader
+        self._writer = writer
+        self._process = process
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count(1)
+        self.closed = False
+        self._reader_task = asyncio.create_task(self._read_loop())
+
+    @classmethod
+    async def open_tcp(cls, host: str, port: int):
+        return cls(*await asyncio.open_connection(host, port, limit=STREAM_LIMIT))
+
+    @classmethod
+    async def open_unix(cls, path: str):
+        return cls(*await asyncio.open_unix_connection(path, limit=STREAM_LIMIT))
+
+    @classmethod
+    async def open_stdio(cls, command: Sequence[str]):
+        process = await asyncio.create_subprocess_exec(
+            *command, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, limit=STREAM_LIMIT
+        )
+        return cls(process.stdout, process.stdin, process)
+
+    async def _read_loop(self):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+                for response in message if isinstance(message, list) else [message]:
+                    future = self._pending.pop(response.get("id"), None)
+                    if future is not None and not future.done():
+                        future.set_result(response)
+        except ConnectionError:
+            pass
+        finally:
+            self.closed = True
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Mất kết nối tới MCP server"))
+            self._pending.clear()
+
+    async def request(self, method: str, params: Optional[Dict[str, Any]] = None,
+                      timeout: float = DEFAULT_TIMEOUT):
+        if self.closed:
+            raise ConnectionError("Kết nối MCP đã đóng")
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            self._writer.write(_dump({"jsonrpc": JSONRPC, "id": request_id, "method": method,
+                                      "params": params or {}}) + b"\n")
+            await self._writer.drain()
+            response = await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(request_id, None)
+        return _unwrap(response)
+
+    async def close(self):
+        self.closed = True
+        self._writer.close()
+        self._reader_task.cancel()
+        if self._process is not None and self._process.returncode is None:
+            try:
+                await asyncio.wait_for(self._process.wait(), 1.0)
+            except asyncio.TimeoutError:
+                self._process.kill()
+
+class HTTPConnection:
+    """Kết nối HTTP keep-alive; tự kết nối lại nếu server đã đóng kết nối cũ"""
+
+    def __init__(self, host: str, port: int, path: str = "/"):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.closed = False
+        self._reader = None
+        self._writer = None
+        self._ids = itertools.count(1)
+        self._lock = asyncio.Lock()
+
+    def _drop_socket(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def _roundtrip(self, body: bytes):
+        for attempt in range(2):
+            if self._writer is None:
+                self._reader, self._writer = await asyncio.open_connection(self.host, self.port, limit=STREAM_LIMIT)
+            try:
+                self._writer.write(
+                    f"POST {self.path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode("latin-1") + body
+                )
+                await self._writer.drain()
+                status_line = await self._reader.readline()
+                if not status_line:
+                    raise ConnectionError("Server đóng kết nối")
+                headers = {}
+                while True:
+                    line = await self._reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                data = await self._reader.readexactly(int(headers.get("content-length", 0)))
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # Kết nối keep-alive cũ có thể đã bị server đóng: mở lại và gửi lại 1 lần
+                self._drop_socket()
+                if attempt:
+                    raise
+                continue
+
+            if headers.get("connection", "").lower() == "close":
+                self._drop_socket()
+            status = int(status_line.split()[1])
+            if status != 200:
+                raise MCPError(status, status_line.decode("latin-1").strip())
+            return json.loads(data)
+
+    async def request(self, method: str, params: Optional[Dict[str, Any]] = None,
+                      timeout: float = DEFAULT_TIMEOUT):
+        body = _dump({"jsonrpc": JSONRPC, "id": next(self._ids), "method": method, "params": params or {}})
+        async with self._lock:
+            try:
+                response = await asyncio.wait_for(self._roundtrip(body), timeout)
+            except asyncio.TimeoutError:
+                # Response trễ sẽ làm lệch các request sau trên kết nối này
+                self._drop_socket()
+                raise
+        return _unwrap(response)
+
+    async def close(self):
+        self.closed = True
+        self._drop_socket()
+
+async def open_connection(endpoint: str):
+    config = parse_endpoint(endpoint)
+    transport = config["transport"]
+    if transport == "stdio":
+        return await StreamConnection.open_stdio(config["command"])
+    if transport == "tcp":
+        return await StreamConnection.open_tcp(config["host"], config["port"])
+    if transport == "unix":
+        return await StreamConnection.open_unix(config["path"])
+    return HTTPConnection(config["host"], config["port"], config["path"])
+
+class MCPClientPool:
+    """Pool kết nối lâu dài tới nhiều MCP server.
+
+    Mỗi server có `size` kết nối dùng xoay vòng (stdio/socket thường chỉ cần 1
+    nhờ pipelining, HTTP cần nhiều hơn để chạy song song). Kết nối được mở khi
+    dùng lần đầu và mở lại nếu bị đứt. Mọi I/O chạy trên event loop của pool
+    (thread nền); code đồng bộ dùng call_tool_sync/call_many_sync.
+    """
+
+    def __init__(self, default_timeout: float = DEFAULT_TIMEOUT):
+        self.default_timeout = default_timeout
+        self._servers: Dict[str, Dict[str, Any]] = {}
+        self._connections: Dict[str, List[Any]] = {}
+        self._slot_locks: Dict[Tuple[str, int], asyncio.Lock] = {}
+        self._round_robin: Dict[str, int] = {}
+        self._loop = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def add_server(self, name: str, endpoint: str, size: Optional[int] = None, timeout: Optional[float] = None):
+        transport = parse_endpoint(endpoint)["transport"]
+        self._servers[name] = {
+            "endpoint": endpoint,
+            "size": size or (4 if transport == "http" else 1),
+            "timeout": timeout or self.default_timeout,
+        }
+        # Đăng ký lại cùng tên: đóng kết nối tới endpoint cũ
+        old_connections = self._connections.pop(name, None)
+        if old_connections and self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._close_connections(old_connections), self._loop)
+
+    def _ensure_loop(self):
+        with self._start_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="mcp-client", daemon=True)
+                self._thread.start()
+        return self._loop
+
+    async def _get_connection(self, name: str, timeout: Optional[float] = None):
+        config = self._servers[name]
+        slots = self._connections.setdefault(name, [None] * config["size"])
+        slot = self._round_robin[name] = (self._round_robin.get(name, -1) + 1) % len(slots)
+        lock = self._slot_locks.setdefault((name, slot), asyncio.Lock())
+        async with lock:
+            connection = slots[slot]
+            if connection is None or connection.closed:
+                # Endpoint không phản hồi (blackhole) không được giữ slot lock mãi
+                connection = slots[slot] = await asyncio.wait_for(
+                    open_connection(config["endpoint"]), timeout or config["timeout"])
+        return connection
+
+    async def request(self, name: str, method: str, params: Optional[Dict[str, Any]] = None,
+                      timeout: Optional[float] = None):
+        if name not in self._servers:
+            raise KeyError(f"MCP server {name} chưa được đăng ký")
+        timeout = timeout or self._servers[name]["timeout"]
+        connection = await self._get_connection(name, timeout)
+        return await connection.request(method, params, timeout)
+
+    async def call_tool(self, name: str, tool: str, arguments: Optional[Dict[str, Any]] = None,
+                        timeout: Optional[float] = None):
+        return await self.request(name, "tools/call", {"name": tool, "arguments": arguments or {}}, timeout)
+
+    async def call_many(self, calls: Sequence[Tuple[str, str, Dict[str, Any]]], timeout: Optional[float] = None):
+        """Gọi song song nhiều (server, tool, arguments); lỗi/timeout được trả về thay vì raise"""
+        return await asyncio.gather(
+            *(self.call_tool(name, tool, arguments, timeout) for name, tool, arguments in calls),
+            return_exceptions=True,
+        )
+
+    def run(self, coro, timeout: Optional[float] = None):
+        """Chạy coroutine trên loop của pool từ code đồng bộ (không gọi từ chính loop đó)"""
+        future = asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def _sync_timeout(self, names: Sequence[str], timeout: Optional[float]) -> float:
+        """Thời gian chờ tối đa từ code đồng bộ: mở kết nối + request, mỗi bước tối đa `timeout`"""
+        step = timeout or max((self._servers[name]["timeout"] for name in names if name in self._servers),
+                              default=self.default_timeout)
+        return 2 * step + 1.0
+
+    def call_tool_sync(self, name: str, tool: str, arguments: Optional[Dict[str, Any]] = None,
+                       timeout: Optional[float] = None):
+        return self.run(self.call_tool(name, tool, arguments, timeout), self._sync_timeout([name], timeout))
+
+    def call_many_sync(self, calls: Sequence[Tuple[str, str, Dict[str, Any]]], timeout: Optional[float] = None):
+        try:
+            return self.run(self.call_many(calls, timeout),
+                            self._sync_timeout([name for name, _, _ in calls], timeout))
+        except concurrent.futures.TimeoutError as e:
+            # Như call_many: lỗi trả về theo từng call thay vì raise
+            return [e] * len(calls)
+
+    @staticmethod
+    async def _close_connections(connections):
+        for connection in connections:
+            if connection is not None:
+                await connection.close()
+
+    async def _close_all(self):
+        for slots in self._connections.values():
+            await self._close_connections(slots)
+        self._connections.clear()
+
+    def close(self):
+        if self._loop is None:
+            return
+        self.run(self._close_all(), timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+        self._loop = None
@@ -0,0 +1,247 @@
+"""
+Đo thời gian từng stage của pipeline RAG (routing, embed query, FAISS, hybrid,
+MCP, LLM, các bước ingest) và xuất ra dạng Prometheus text.
+
+    with metrics.stage("faiss_search"):
+        ...
+
+Nếu đang trong 1 request (start_trace), thời gian được ghi vào trace đó và chỉ
+cộng vào histogram khi trace.finish(); trace có thể được ghi ra file JSON lines
+(configure_trace_log). Ngoài request thì ghi thẳng vào histogram.
+"""
+
+import contextvars
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + list(extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # key -> [số đếm theo bucket..., sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def snapshot(self):
+        """{label values: (sum, count)}"""
+        with self._lock:
+            return {key: (state[-2], state[-1]) for key, state in self._values.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, state in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, state):
+                    labels = _format_labels(self.labelnames, key, [("le", bound)])
+                    lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _format_labels(self.labelnames, key, [("le", "+Inf")])
+                lines.append(f"{self.name}_bucket{labels} {state[-1]}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {state[-2]}")
+                lines.append(f"{self.name}_count{labels} {state[-1]}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+STAGE_SECONDS = REGISTRY.histogram("rag_stage_seconds", "Thời gian từng stage của pipeline", ("stage",))
+REQUESTS = REGISTRY.counter("rag_requests_total", "Số request theo tool", ("tool",))
+QUERY_CACHE = REGISTRY.counter("rag_query_embedding_cache_total", "Cache embedding câu hỏi", ("result",))
+ANSWER_CACHE = REGISTRY.counter("rag_answer_cache_total", "Cache câu trả lời LLM", ("result",))
+SPECULATION = REGISTRY.counter("rag_speculative_prefetch_total", "Nhánh retrieval chạy trước khi route xong", ("result",))
+INDEX_RELOADS = REGISTRY.counter("rag_index_reloads_total", "Số lần reload index khi VERSION đổi", ("result",))
+
+# --- TRACE THEO REQUEST ---
+
+_current_trace = contextvars.ContextVar("rag_trace", default=None)
+_trace_log = {"path": None, "lock": threading.Lock()}
+
+def configure_trace_log(path):
+    """Ghi mỗi trace thành 1 dòng JSON vào path (None = tắt)"""
+    _trace_log["path"] = path
+
+class Trace:
+    def __init__(self, name="request", log=True, **attrs):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.log = log
+        self.attrs = attrs
+        self.spans = []  # [(stage, giây)]
+        self.started = time.time()
+        self._t0 = time.perf_counter()
+        self._token = None
+
+    def add(self, stage_name, seconds):
+        self.spans.append((stage_name, seconds))
+
+    def total(self, *stage_names):
+        return sum(seconds for name, seconds in self.spans if name in stage_names)
+
+    def merge(self, other):
+        """Gộp spans + attrs của 1 trace con (vd. nhánh chạy trong thread khác) vào trace này"""
+        self.spans.extend(other.spans)
+        self.attrs.update(other.attrs)
+
+    def __enter__(self):
+        self._token = _current_trace.set(self)
+        return self
+
+    def __exit__(self, *exc):
+        _current_trace.reset(self._token)
+        self.finish()
+
+    def finish(self):
+        observe_spans(self.spans)
+        if not (self.log and _trace_log["path"]):
+            return
+        record = {
+            "trace_id": self.id,
+            "name": self.name,
+            "start": self.started,
+            "duration_s": round(time.perf_counter() - self._t0, 6),
+            **self.attrs,
+            "spans": [{"stage": name, "seconds": round(seconds, 6)} for name, seconds in self.spans],
+        }
+        with _trace_log["lock"]:
+            with open(_trace_log["path"], "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+def start_trace(name="request", log=True, **attrs) -> Trace:
+    """Dùng với `with`: các stage bên trong được gom vào trace này"""
+    return Trace(name, log, **attrs)
+
+def current_trace():
+    return _current_trace.get()
+
+@contextmanager
+def collect_trace():
+    """Gom stage + attrs vào 1 Trace riêng, không ghi histogram (gộp lại bằng Trace.merge)"""
+    trace = Trace("spans", log=False)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+@contextmanager
+def collect_spans():
+    """Gom các stage vào list thay vì histogram (vd. trong process worker,
+    process cha gọi observe_spans với list này)"""
+    with collect_trace() as trace:
+        yield trace.spans
+
+def observe_spans(spans):
+    for stage_name, seconds in spans:
+        STAGE_SECONDS.observe(seconds, stage=stage_name)
+
+def record(stage_name, seconds):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(stage_name, seconds)
+    else:
+        STAGE_SECONDS.observe(seconds, stage=stage_name)
+
+@contextmanager
+def stage(stage_name):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage_name, time.perf_counter() - t0)
+
+def format_summary(prefix=""):
+    """Bảng tóm tắt tổng thời gian/số lần của các stage bắt đầu bằng prefix"""
+    lines = []
+    for (stage_name,), (total, count) in sorted(STAGE_SECONDS.snapshot().items()):
+        if stage_name.startswith(prefix) and count:
+            lines.append(f"{stage_name:<28}{count:>8} lần {total:>10.3f}s  (tb {total / count * 1000:.2f} ms)")
+    return "\n".join(lines)
+
+# --- HTTP /metrics ---
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        data = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def serve_metrics(port, host="127.0.0.1"):
+    """Mở endpoint /metrics (Prometheus) trong thread nền"""
+    httpd = ThreadingHTTPServer((host, port), _MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print(f"📈 Metrics tại http://{host}:{port}/metrics")
+    return httpd
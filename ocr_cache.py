@@ -0,0 +1,176 @@
+"""
+Cache kết quả OCR trên đĩa, dùng chung giữa các lần chạy ingest và giữa các worker.
+
+Key = sha256(bytes ảnh + lang), nên logo/letterhead lặp lại ở nhiều trang,
+nhiều file chỉ phải chạy Tesseract đúng 1 lần.
+"""
+
+import hashlib
+import os
+import time
+
+DEFAULT_CACHE_DIR = "ocr_cache"
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+class OCRCache:
+    """OCR cache dạng file: <dir>/<2 ký tự đầu key>/<key>.txt, evict theo LRU (mtime)"""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, lock_timeout=120):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock_timeout = lock_timeout
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(image_bytes, lang):
+        h = hashlib.sha256(image_bytes)
+        h.update(b"\0" + lang.encode("utf-8"))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".txt")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+        except FileNotFoundError:
+            return None
+        # Cập nhật mtime để eviction biết entry vừa được dùng
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return text
+
+    def put(self, key, text):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def get_or_compute(self, image_bytes, lang, compute):
+        """Trả về text OCR đã cache, hoặc gọi compute() rồi lưu lại.
+
+        Khi nhiều worker gặp cùng 1 ảnh cùng lúc, chỉ worker giữ file .lock
+        chạy OCR; các worker khác chờ kết quả thay vì OCR lặp lại. Lock của
+        worker đã chết (SIGKILL, pool bị terminate) bị phá thay vì chờ hết lock_timeout.
+        """
+        key = self.make_key(image_bytes, lang)
+        text = self.get(key)
+        if text is not None:
+            self.hits += 1
+            return text
+
+        lock_path = self._path(key) + ".lock"
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        fd = self._lock(lock_path)
+        if fd is None:
+            text = self._wait_for(key, lock_path)
+            if text is not None:
+                self.hits += 1
+                return text
+            # Lock cũ đã bị phá hoặc hết thời gian chờ -> thử giữ lock rồi tự OCR
+            fd = self._lock(lock_path)
+
+        self.misses += 1
+        try:
+            text = compute()
+            self.put(key, text)
+            return text
+        finally:
+            if fd is not None:
+                os.close(fd)
+                try:
+                    os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+
+    @staticmethod
+    def _lock(lock_path):
+        """Tạo file .lock chứa pid của process giữ lock; None nếu process khác đang giữ"""
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        os.write(fd, str(os.getpid()).encode())
+        return fd
+
+    def _is_stale(self, lock_path):
+        """Lock do process đã chết để lại, hoặc giữ lâu hơn lock_timeout"""
+        try:
+            with open(lock_path) as f:
+                owner = f.read().strip()
+            age = time.time() - os.path.getmtime(lock_path)
+        except FileNotFoundError:
+            return False
+        if age > self.lock_timeout:
+            return True
+        if not owner.isdigit():
+            # Process giữ lock chưa kịp ghi pid, hoặc chết ngay sau khi tạo file
+            return age > 1.0
+        if os.name == "nt":
+            # os.kill(pid, 0) trên Windows là kill thật -> chỉ dựa vào tuổi của lock
+            return False
+        try:
+            os.kill(int(owner), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    def _wait_for(self, key, lock_path):
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            text = self.get(key)
+            if text is not None:
+                return text
+            if not os.path.exists(lock_path):
+                # Worker kia lỗi và đã nhả lock mà không ghi kết quả
+                return self.get(key)
+            if self._is_stale(lock_path):
+                # Worker giữ lock đã chết: xoá lock để lần chạy này (và các lần sau) không phải chờ.
+                # 2 worker cùng phá lock thì cùng lắm OCR 2 lần, kết quả vẫn ghi nguyên tử
+                try:
+                    os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+                return self.get(key)
+            time.sleep(0.05)
+        return None
+
+    def evict(self):
+        """Xoá entry ít dùng nhất cho đến khi tổng dung lượng <= max_bytes"""
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".txt"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        removed = 0
+        if total > self.max_bytes:
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                total -= size
+                removed += 1
+        return removed
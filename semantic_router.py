@@ -0,0 +1,45 @@
+"""
+Routing theo ngữ nghĩa: so khớp embedding câu hỏi với embedding mô tả/câu mẫu của từng tool.
+
+Embedding của các câu mẫu được tính 1 lần lúc khởi tạo; mỗi query chỉ tốn 1 phép
+nhân ma trận-vector NumPy. Embedding của query đi qua cache của database, nên
+khi tool được chọn là rag_search thì bước retrieval dùng lại đúng vector đó.
+"""
+
+from typing import Any, Dict, List
+
+import numpy as np
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+class SemanticRouter:
+    def __init__(self, tools: Dict[str, Dict[str, Any]], embeddings, threshold: float = 0.45):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.tool_names: List[str] = list(tools)
+
+        texts, owners = [], []
+        for column, (tool_name, config) in enumerate(tools.items()):
+            for text in [config["description"], *config.get("examples", [])]:
+                texts.append(text)
+                owners.append(column)
+
+        # Ma trận (số câu mẫu x số chiều), mỗi hàng đã chuẩn hoá L2 -> dot = cosine
+        self._exemplars = _normalize_rows(np.asarray(embeddings.embed_documents(texts), dtype=np.float32))
+        self._owners = np.asarray(owners, dtype=np.intp)
+
+    def route_scores(self, query: str) -> np.ndarray:
+        """Cosine cao nhất giữa query và các câu mẫu của từng tool"""
+        vector = _normalize_rows(np.asarray(self.embeddings.embed_query(query), dtype=np.float32))
+        similarities = self._exemplars @ vector
+        scores = np.full(len(self.tool_names), -1.0, dtype=np.float32)
+        np.maximum.at(scores, self._owners, similarities)
+        return scores
+
+    def route(self, query: str) -> tuple[str, float]:
+        """-> (tool, cosine); cosine < threshold nghĩa là nên fallback sang keyword"""
+        scores = self.route_scores(query)
+        best = int(np.argmax(scores))
+        return self.tool_names[best], float(scores[best])
@@ -0,0 +1,60 @@
+"""
+Ring buffer dạng NumPy cho chuỗi thời gian của sensor.
+
+Kích thước cố định (capacity mẫu), mỗi mẫu là 1 timestamp + 1 hàng giá trị
+float32 cho các trường (nhiệt độ, độ ẩm, ...). Ghi đè mẫu cũ nhất khi đầy,
+không cấp phát thêm bộ nhớ sau khi khởi tạo.
+"""
+
+import time
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+
+class SensorRingBuffer:
+    def __init__(self, fields: Sequence[str], capacity: int):
+        self.fields = tuple(fields)
+        self.capacity = capacity
+        self._times = np.zeros(capacity, dtype=np.float64)
+        self._values = np.full((capacity, len(self.fields)), np.nan, dtype=np.float32)
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, values: Dict[str, float], timestamp: Optional[float] = None):
+        self._times[self._next] = time.time() if timestamp is None else timestamp
+        self._values[self._next] = [values.get(field, np.nan) for field in self.fields]
+        self._next = (self._next + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def latest(self):
+        """-> (timestamp, {field: giá trị}) của mẫu mới nhất, hoặc None nếu chưa có mẫu"""
+        if not self._count:
+            return None
+        i = (self._next - 1) % self.capacity
+        return float(self._times[i]), dict(zip(self.fields, self._values[i].tolist()))
+
+    def window(self, seconds: float, now: Optional[float] = None):
+        """Các mẫu trong `seconds` giây gần nhất -> (timestamps, ma trận giá trị)"""
+        now = time.time() if now is None else now
+        times = self._times[:self._count]
+        mask = times >= now - seconds
+        return times[mask], self._values[:self._count][mask]
+
+    def aggregate(self, seconds: float, now: Optional[float] = None) -> Dict[str, Dict[str, float]]:
+        """min/max/mean từng trường trong cửa sổ thời gian (bỏ qua giá trị NaN)"""
+        _, values = self.window(seconds, now)
+        stats = {}
+        for column, field in enumerate(self.fields):
+            column_values = values[:, column]
+            column_values = column_values[~np.isnan(column_values)]
+            if len(column_values):
+                stats[field] = {
+                    "min": float(column_values.min()),
+                    "max": float(column_values.max()),
+                    "mean": float(column_values.mean()),
+                    "n": int(len(column_values)),
+                }
+        return stats
@@ -0,0 +1,187 @@
+"""
+Search trên nhiều collection (shard) độc lập, mỗi collection là 1 index riêng
+(faiss_index hoặc indexes/<tên>/, build bằng `python ingest.py --collection <tên>`).
+
+- Collection chỉ được load (mmap) ở lần search đầu tiên dùng tới nó; watch() reload
+  collection đã load khi chạy lại ingest cho nó (xem index_reload.py)
+- Các collection được search song song trong thread pool; mỗi shard trả về ứng viên
+  vector (khoảng cách L2) và từ khoá (BM25 của shard), gộp toàn cục như hybrid_search:
+  xếp vector theo L2 (cùng model embedding nên so sánh được giữa các shard), từ khoá
+  theo điểm BM25, rồi reciprocal-rank fusion
+- Filter metadata (vd. {"source": "a.pdf", "page": [1, 2]}) được áp trên các
+  ứng viên của từng shard trước khi xếp hạng; thiếu kết quả thì lấy thêm ứng viên
+
+    python sharding.py "Quy định sử dụng logo?" --collections daotao,tuyensinh --filter source=a.pdf
+"""
+
+import argparse
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence
+
+from langchain_core.documents import Document
+
+import metrics
+from bm25 import reciprocal_rank_fusion
+from database import collection_path, get_documents_by_id, get_query_embeddings, list_collections, vector_search_ids
+from index_reload import ReloadableIndex
+
+def matches(metadata: Dict[str, Any], filter: Dict[str, Any]) -> bool:
+    """filter: {key: giá trị | list/tuple/set các giá trị | hàm (giá trị) -> bool}"""
+    for key, expected in filter.items():
+        value = metadata.get(key)
+        if callable(expected):
+            ok = expected(value)
+        elif isinstance(expected, (list, tuple, set, frozenset)):
+            ok = value in expected
+        else:
+            ok = value == expected
+        if not ok:
+            return False
+    return True
+
+def parse_filter(specs: Sequence[str]) -> Dict[str, Any]:
+    """["source=a.pdf", "page=3", "source=b.pdf"] -> {"source": ["a.pdf", "b.pdf"], "page": 3}"""
+    filter = {}
+    for spec in specs:
+        key, _, value = spec.partition("=")
+        value = int(value) if value.isdigit() else value
+        if key in filter:
+            previous = filter[key]
+            filter[key] = (previous if isinstance(previous, list) else [previous]) + [value]
+        else:
+            filter[key] = value
+    return filter
+
+class ShardedIndex:
+    def __init__(self, collections: Optional[Sequence[str]] = None, workers: int = 4, fetch_k: int = 20):
+        names = list(collections) if collections else list_collections()
+        self.paths = {name: collection_path(name) for name in names}
+        self.fetch_k = fetch_k
+        self._shards = {}
+        self._load_locks = {name: threading.Lock() for name in names}
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rag-shard")
+        self._hooks = []
+        self._stop = None
+
+    @property
+    def collections(self) -> List[str]:
+        return list(self.paths)
+
+    def shard(self, name: str):
+        """Snapshot hiện tại (vectorstore + BM25) của 1 collection, load ở lần đầu được dùng
+        (None nếu chưa build)"""
+        index = self._shards.get(name)
+        if index is None:
+            with self._load_locks[name]:
+                index = self._shards.get(name)
+                if index is None:
+                    with metrics.stage("shard_load"):
+                        index = ReloadableIndex(self.paths[name])
+                    for hook in self._hooks:
+                        index.on_reload(hook)
+                    self._shards[name] = index
+        return index.current
+
+    def on_reload(self, callback):
+        """callback(snapshot mới) khi 1 collection được reload"""
+        self._hooks.append(callback)
+        for index in list(self._shards.values()):
+            index.on_reload(callback)
+
+    def watch(self, interval: float = 2.0):
+        """1 thread nền kiểm tra VERSION của các collection đã load"""
+        if self._stop is not None:
+            return
+        stop = self._stop = threading.Event()
+
+        def loop():
+            while not stop.wait(interval):
+                for index in list(self._shards.values()):
+                    index.reload()
+
+        threading.Thread(target=loop, name="rag-shard-watch", daemon=True).start()
+
+    def _search_shard(self, name: str, query: str, k: int, filter: Optional[Dict[str, Any]]):
+        """-> ({chunk_id: Document}, [(chunk_id, khoảng cách L2)], [(chunk_id, điểm BM25)]) đã lọc"""
+        snapshot = self.shard(name)
+        if snapshot is None or not snapshot.vectorstore.index.ntotal:
+            return {}, [], []
+        vectorstore = snapshot.vectorstore
+        ntotal = vectorstore.index.ntotal
+        fetch = max(k, self.fetch_k)
+        while True:
+            vector_ranking = vector_search_ids(vectorstore, query, min(fetch, ntotal))
+            keyword_ranking = []
+            if snapshot.keyword_index is not None:
+                with metrics.stage("hybrid_rescoring"):
+                    keyword_ranking = snapshot.keyword_index.search(query, fetch)
+            ids = list(dict.fromkeys(chunk_id for chunk_id, _ in vector_ranking + keyword_ranking))
+            documents = {}
+            for chunk_id, doc in get_documents_by_id(vectorstore, ids).items():
+                if not filter or matches(doc.metadata, filter):
+                    # Document mới: docstore trong RAM (index.pkl cũ) trả về chính object nó giữ
+                    documents[chunk_id] = Document(page_content=doc.page_content, id=doc.id or chunk_id,
+                                                   metadata={**doc.metadata, "collection": name})
+            vector_hits = [(chunk_id, distance) for chunk_id, distance in vector_ranking if chunk_id in documents]
+            keyword_hits = [(chunk_id, score) for chunk_id, score in keyword_ranking if chunk_id in documents]
+            # Filter loại quá nhiều ứng viên -> lấy thêm (tối đa toàn bộ shard)
+            if len(vector_hits) >= k or fetch >= ntotal:
+                return documents, vector_hits, keyword_hits
+            fetch *= 4
+
+    def search(self, query: str, k: int = 3, collections: Optional[Sequence[str]] = None,
+               filter: Optional[Dict[str, Any]] = None) -> List[tuple]:
+        """-> [(Document, điểm RRF)] tốt nhất trên các collection; metadata có thêm "collection" """
+        names = list(collections) if collections else self.collections
+        unknown = [name for name in names if name not in self.paths]
+        if unknown:
+            raise KeyError(f"Collection chưa được cấu hình: {', '.join(unknown)}")
+
+        # Embed 1 lần (vào cache), các shard dùng lại vector từ cache
+        get_query_embeddings().embed_query(query)
+        # Mỗi task 1 bản copy context để stage của các shard vẫn ghi vào trace của request
+        futures = [
+            self._pool.submit(contextvars.copy_context().run, self._search_shard, name, query, k, filter)
+            for name in names
+        ]
+        documents, vector_hits, keyword_hits = {}, [], []
+        for name, future in zip(names, futures):
+            shard_documents, shard_vector, shard_keyword = future.result()
+            # ID chunk chỉ duy nhất trong 1 collection -> gắn thêm tên collection
+            documents.update((f"{name}/{chunk_id}", doc) for chunk_id, doc in shard_documents.items())
+            vector_hits.extend((f"{name}/{chunk_id}", distance) for chunk_id, distance in shard_vector)
+            keyword_hits.extend((f"{name}/{chunk_id}", score) for chunk_id, score in shard_keyword)
+
+        with metrics.stage("hybrid_rescoring"):
+            vector_ranking = [key for key, _ in sorted(vector_hits, key=lambda hit: hit[1])]
+            keyword_ranking = [key for key, _ in sorted(keyword_hits, key=lambda hit: -hit[1])]
+            fused = reciprocal_rank_fusion(vector_ranking, keyword_ranking)
+        return [(documents[key], score) for key, score in fused[:k]]
+
+    def close(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+        self._pool.shutdown(wait=False)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search trên nhiều collection")
+    parser.add_argument("query", nargs="?", default=None)
+    parser.add_argument("--collections", default=None, help="Danh sách collection, cách nhau bằng dấu phẩy (mặc định: tất cả)")
+    parser.add_argument("--filter", action="append", default=[], metavar="KEY=VALUE",
+                        help="Lọc theo metadata, vd. source=a.pdf (lặp lại được)")
+    parser.add_argument("-k", type=int, default=3)
+    args = parser.parse_args()
+
+    collections = args.collections.split(",") if args.collections else None
+    if args.query is None:
+        print("📚 Collection:", ", ".join(list_collections()) or "(chưa có)")
+    else:
+        index = ShardedIndex(collections)
+        for doc, score in index.search(args.query, args.k, filter=parse_filter(args.filter)):
+            meta = doc.metadata
+            print(f"[{score:.4f}] {meta['collection']} / {meta.get('source')} tr.{meta.get('page')}: "
+                  f"{' '.join(doc.page_content.split())[:120]}")
+        index.close()
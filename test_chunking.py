@@ -0,0 +1,38 @@
+from langchain_core.documents import Document
+
+from chunking import split_paragraphs, strip_furniture
+
+def _pages(paragraphs_per_page):
+    return [Document(page_content="\n\n".join(paragraphs), metadata={"source": "a.pdf", "page": i})
+            for i, paragraphs in enumerate(paragraphs_per_page)]
+
+def test_strip_furniture_removes_header_and_page_number():
+    pages = _pages([
+        ["TRƯỜNG ĐẠI HỌC CẦN THƠ", f"Nội dung riêng của trang {i}, không lặp lại ở trang khác.", f"Trang {i}/4"]
+        for i in range(1, 5)
+    ])
+    cleaned = strip_furniture(pages)
+    assert [split_paragraphs(page.page_content) for page in cleaned] == [
+        [f"Nội dung riêng của trang {i}, không lặp lại ở trang khác."] for i in range(1, 5)
+    ]
+
+def test_strip_furniture_keeps_body_paragraphs_differing_only_in_numbers():
+    paragraphs_per_page = [
+        [
+            f"Điều {i}. Sinh viên đóng học phí học kỳ {i} trước ngày 15.",
+            f"Mức phí: {i * 100} nghìn đồng/tín chỉ.",
+            f"Chi tiết số {i}",
+            f"Khoản {i}.{i} áp dụng cho sinh viên khoá {40 + i} trở về sau.",
+        ]
+        for i in range(1, 7)
+    ]
+    cleaned = strip_furniture(_pages(paragraphs_per_page))
+    assert [split_paragraphs(page.page_content) for page in cleaned] == paragraphs_per_page
+
+def test_strip_furniture_keeps_numbered_headings():
+    paragraphs_per_page = [
+        [f"# Chương {i}", f"Nội dung chương {i} trình bày các quy định chung của trường."]
+        for i in range(1, 5)
+    ]
+    cleaned = strip_furniture(_pages(paragraphs_per_page))
+    assert [split_paragraphs(page.page_content) for page in cleaned] == paragraphs_per_page
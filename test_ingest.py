@@ -0,0 +1,55 @@
+import hashlib
+import os
+
+import fitz
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+import ingest
+from database import load_db
+
+SHARED = "Sinh viên phải đeo thẻ khi vào thư viện và giữ trật tự trong phòng đọc chung."
+
+class FakeEmbeddings(Embeddings):
+    def _vector(self, text):
+        vector = np.zeros(384, dtype=np.float32)
+        for word in text.lower().split():
+            vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % 384] += 1
+        return (vector / (np.linalg.norm(vector) + 1e-9)).tolist()
+
+    def embed_documents(self, texts):
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._vector(text)
+
+def _write_pdf(path, paragraphs):
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_textbox(fitz.Rect(50, 50, 550, 800), "\n\n".join(paragraphs), fontname="helv")
+    doc.save(path)
+    doc.close()
+
+def _contents(index_path):
+    vectorstore = load_db(path=index_path)
+    ids = [vectorstore.index_to_docstore_id[i] for i in range(vectorstore.index.ntotal)]
+    return [vectorstore.docstore.search(chunk_id).page_content for chunk_id in ids]
+
+def test_incremental_delete_keeps_paragraph_shared_with_other_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, "HuggingFaceEmbeddings", lambda **kwargs: FakeEmbeddings())
+    docs_path, index_path = str(tmp_path / "docs"), str(tmp_path / "index")
+    os.makedirs(docs_path)
+    # Chỉ có chữ không dấu: font helv không có glyph tiếng Việt
+    shared = SHARED.encode("ascii", "ignore").decode()
+    _write_pdf(os.path.join(docs_path, "a.pdf"), [shared])
+    _write_pdf(os.path.join(docs_path, "b.pdf"), [shared])
+
+    ingest.build_vector_db(workers=1, extraction="native", docs_path=docs_path, index_path=index_path)
+    assert len(_contents(index_path)) == 2
+
+    os.remove(os.path.join(docs_path, "a.pdf"))
+    ingest.build_vector_db(workers=1, incremental=True, extraction="native",
+                           docs_path=docs_path, index_path=index_path)
+    contents = _contents(index_path)
+    assert len(contents) == 1
+    assert shared.split()[0] in contents[0]